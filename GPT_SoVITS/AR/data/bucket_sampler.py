@@ -4,7 +4,7 @@ import itertools
 import math
 import random
 from random import shuffle
-from typing import Iterator, Optional, TypeVar
+from typing import Iterator, List, Optional, Sequence, TypeVar
 
 import torch
 import torch.distributed as dist
@@ -12,6 +12,7 @@ from torch.utils.data import Dataset, Sampler
 
 __all__ = [
     "DistributedBucketSampler",
+    "DistributedTokenBatchSampler",
 ]
 
 T_co = TypeVar("T_co", covariant=True)
@@ -147,3 +148,148 @@ class DistributedBucketSampler(Sampler[T_co]):
             epoch (int): Epoch number.
         """
         self.epoch = epoch
+
+
+class DistributedTokenBatchSampler(Sampler[List[int]]):
+    r"""
+    Batch sampler that packs samples of similar length into batches whose padded size
+    (longest length in the batch * batch size) stays within ``max_tokens``, so short
+    samples form large batches and long samples form small ones.
+
+    Samples are sorted by length with a small per-epoch random jitter, packed greedily
+    and the batch order is shuffled, all driven by ``seed + epoch`` so every replica
+    builds the same batches. The batch list is padded (or truncated with ``drop_last``)
+    to a multiple of ``num_replicas`` and each replica takes every ``num_replicas``-th batch.
+
+    Samples with ``length <= min_length`` or ``length > max_length`` are dropped. A sample
+    longer than ``max_tokens`` on its own becomes a single-sample batch.
+
+    Use as ``DataLoader(dataset, batch_sampler=sampler)``.
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        max_tokens: int,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        shuffle: bool = True,
+        seed: int = 0,
+        drop_last: bool = False,
+        max_batch_size: Optional[int] = None,
+        min_length: Optional[int] = None,
+        max_length: Optional[int] = None,
+        length_jitter: float = 0.1,
+    ) -> None:
+        distributed = dist.is_available() and dist.is_initialized()
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if distributed else 1
+        if rank is None:
+            rank = dist.get_rank() if distributed else 0
+        if rank >= num_replicas or rank < 0:
+            raise ValueError("Invalid rank {}, rank should be in the interval [0, {}]".format(rank, num_replicas - 1))
+        if max_tokens <= 0:
+            raise ValueError("max_tokens should be a positive integer, but got max_tokens={}".format(max_tokens))
+        self.lengths = torch.as_tensor(lengths, dtype=torch.float64)
+        self.max_tokens = max_tokens
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.max_batch_size = max_batch_size
+        self.length_jitter = length_jitter if shuffle else 0.0
+        keep = torch.ones(len(self.lengths), dtype=torch.bool)
+        if min_length is not None:
+            keep &= self.lengths > min_length
+        if max_length is not None:
+            keep &= self.lengths <= max_length
+        self.indices = torch.nonzero(keep).flatten()
+        if len(self.indices) == 0:
+            raise ValueError("No samples left after length filtering")
+        self.num_dropped = len(self.lengths) - len(self.indices)
+        self.epoch = 0
+        self._epoch_batches = None
+        self.stats = {}
+
+    def _make_batches(self, epoch: int) -> List[List[int]]:
+        g = torch.Generator()
+        g.manual_seed(self.seed + epoch)
+        lengths = self.lengths[self.indices]
+        if self.shuffle:
+            # random jitter mixes samples of close length between epochs while keeping padding low
+            perm = torch.randperm(len(lengths), generator=g)
+            noise = torch.rand(len(perm), generator=g, dtype=torch.float64) * 2 - 1
+            keys = lengths[perm] * (1 + self.length_jitter * noise)
+            order = perm[torch.sort(keys, stable=True)[1]]
+        else:
+            order = torch.sort(lengths, stable=True)[1]
+        sorted_indices = self.indices[order].tolist()
+        sorted_lengths = lengths[order].tolist()
+
+        batches = []
+        batch = []
+        batch_max = 0.0
+        real_tokens = 0.0
+        padded_tokens = 0.0
+        num_oversized = 0
+        for idx, length in zip(sorted_indices, sorted_lengths):
+            new_max = max(batch_max, length)
+            full = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+            if batch and (new_max * (len(batch) + 1) > self.max_tokens or full):
+                batches.append(batch)
+                padded_tokens += batch_max * len(batch)
+                batch, new_max = [], length
+            if not batch and length > self.max_tokens:
+                num_oversized += 1
+            batch.append(idx)
+            batch_max = new_max
+            real_tokens += length
+        if batch:
+            batches.append(batch)
+            padded_tokens += batch_max * len(batch)
+
+        if self.shuffle:
+            batch_ids = torch.randperm(len(batches), generator=g).tolist()
+            batches = [batches[i] for i in batch_ids]
+        if self.drop_last and len(batches) >= self.num_replicas:
+            batches = batches[: len(batches) - len(batches) % self.num_replicas]
+        else:
+            rem = (self.num_replicas - len(batches) % self.num_replicas) % self.num_replicas
+            batches = batches + (batches * math.ceil(rem / len(batches)))[:rem]
+
+        self.stats = {
+            "epoch": epoch,
+            "num_batches": len(batches),
+            "num_samples": len(sorted_indices),
+            "num_dropped": self.num_dropped,
+            "num_oversized": num_oversized,
+            "mean_batch_size": len(sorted_indices) / max(1, len(batches)),
+            "padding_efficiency": real_tokens / max(1.0, padded_tokens),
+        }
+        return batches
+
+    def batches(self) -> List[List[int]]:
+        if self._epoch_batches is None or self._epoch_batches[0] != self.epoch:
+            self._epoch_batches = (self.epoch, self._make_batches(self.epoch))
+            if self.rank == 0:
+                print(self.report())
+        return self._epoch_batches[1]
+
+    def report(self) -> str:
+        stats = self.stats
+        return (
+            "token batch sampler epoch {epoch}: {num_batches} batches, {mean_batch_size:.1f} samples/batch, "
+            "padding efficiency {efficiency:.1%}, dropped {num_dropped}, oversized {num_oversized}".format(
+                efficiency=stats["padding_efficiency"], **stats
+            )
+        )
+
+    def __iter__(self) -> Iterator[List[int]]:
+        return iter(self.batches()[self.rank :: self.num_replicas])
+
+    def __len__(self) -> int:
+        return len(self.batches()) // self.num_replicas
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
@@ -3,7 +3,7 @@
 from pytorch_lightning import LightningDataModule
 from torch.utils.data import DataLoader
 
-from AR.data.bucket_sampler import DistributedBucketSampler
+from AR.data.bucket_sampler import DistributedBucketSampler, DistributedTokenBatchSampler
 from AR.data.dataset import Text2SemanticDataset
 
 
@@ -49,6 +49,21 @@ class Text2SemanticDataModule(LightningDataModule):
             else self.config["train"]["batch_size"]
         )
         batch_size = max(min(batch_size, len(self._train_dataset) // 4), 1)  # 防止不保存
+        max_tokens = self.config["train"].get("max_tokens_per_batch", None)
+        if max_tokens:
+            # 按 token 预算组 batch: 每个 batch 的 (最长 音素+语义 token 数 × 条数) 不超过 max_tokens_per_batch
+            lengths = [
+                len(semantic_ids) + len(phoneme_ids) for semantic_ids, phoneme_ids in self._train_dataset.semantic_phoneme
+            ]
+            batch_sampler = DistributedTokenBatchSampler(lengths, max_tokens=max_tokens)
+            return DataLoader(
+                self._train_dataset,
+                batch_sampler=batch_sampler,
+                collate_fn=self._train_dataset.collate,
+                num_workers=self.num_workers,
+                persistent_workers=True,
+                prefetch_factor=16,
+            )
         sampler = DistributedBucketSampler(self._train_dataset, batch_size=batch_size)
         return DataLoader(
             self._train_dataset,
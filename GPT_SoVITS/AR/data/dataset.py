@@ -14,6 +14,9 @@ from torch.utils.data import DataLoader, Dataset
 version = os.environ.get("version", None)
 
 from text import cleaned_text_to_sequence
+from AR.data.feature_shards import ShardReader, has_shards
+from module.dataset_index import load_or_build
+from module.packed_dataset import open_packed
 
 # from config import exp_dir
 
@@ -54,11 +57,6 @@ class Text2SemanticDataset(Dataset):
     ) -> None:
         super().__init__()
 
-        self.semantic_data = pd.read_csv(
-            semantic_path,
-            delimiter="\t",
-            encoding="utf-8",
-        )
         # get dict
         self.path2 = phoneme_path  # "%s/2-name2text.txt"%exp_dir#phoneme_path
         self.path3 = "%s/3-bert" % (
@@ -67,17 +65,12 @@ class Text2SemanticDataset(Dataset):
             )
         )  # "%s/3-bert"%exp_dir#bert_dir
         self.path6 = semantic_path  # "%s/6-name2semantic.tsv"%exp_dir#semantic_path
+        # 批量预处理写出的 BERT 特征分片, 与逐条 .pt 并存时优先读 .pt
+        self.bert_shards = ShardReader(self.path3) if has_shards(self.path3) else None
+        # module/packed_dataset.py 打包过的数据集优先从 8-packed 读 bert
+        self.packed = open_packed(os.path.dirname(phoneme_path))
         assert os.path.exists(self.path2)
         assert os.path.exists(self.path6)
-        self.phoneme_data = {}
-        with open(self.path2, "r", encoding="utf8") as f:
-            lines = f.read().strip("\n").split("\n")
-
-        for line in lines:
-            tmp = line.split("\t")
-            if len(tmp) != 4:
-                continue
-            self.phoneme_data[tmp[0]] = [tmp[1], tmp[2], tmp[3]]
 
         # self.phoneme_data = np.load(phoneme_path, allow_pickle=True).item()
         # pad for semantic tokens
@@ -92,9 +85,7 @@ class Text2SemanticDataset(Dataset):
         self.max_sec = max_sec
         self.min_ps_ratio = min_ps_ratio
         self.max_ps_ratio = max_ps_ratio
-
-        if max_sample is not None:
-            self.semantic_data = self.semantic_data[:max_sample]
+        self.max_sample = max_sample
 
         # {idx: (semantic, phoneme)}
         # semantic list, phoneme list
@@ -107,35 +98,63 @@ class Text2SemanticDataset(Dataset):
             # 调用初始化函数
             self.init_batch()
             self.inited = True
-            del self.semantic_data
-            del self.phoneme_data
         # self.tokenizer = AutoTokenizer.from_pretrained("hfl/chinese-roberta-wwm-ext-large")
         # self.tokenizer = AutoTokenizer.from_pretrained("/data/docker/liujing04/bert-vits2/Bert-VITS2-master20231106/bert/chinese-roberta-wwm-ext-large")
 
     def init_batch(self):
-        semantic_data_len = len(self.semantic_data)
-        phoneme_data_len = len(self.phoneme_data.keys())
+        """解析、过滤结果缓存在实验目录的 index 下 (见 module/dataset_index.py), 源文件不变时直接复用"""
+        params = {
+            "version": version,
+            "hz": self.hz,
+            "max_sec": self.max_sec,
+            "min_ps_ratio": self.min_ps_ratio,
+            "max_ps_ratio": self.max_ps_ratio,
+            "max_sample": self.max_sample,
+        }
+        self.semantic_phoneme, self.item_names = load_or_build(
+            os.path.dirname(self.path2), "t2s", params, [self.path2, self.path6], self.build_index
+        )
+        # 345410 for LibriTTS
+        print("dataset.__len__():", self.__len__())
+
+    def build_index(self):
+        semantic_data = pd.read_csv(
+            self.path6,
+            delimiter="\t",
+            encoding="utf-8",
+        )
+        if self.max_sample is not None:
+            semantic_data = semantic_data[: self.max_sample]
+        phoneme_data = {}
+        with open(self.path2, "r", encoding="utf8") as f:
+            lines = f.read().strip("\n").split("\n")
+
+        for line in lines:
+            tmp = line.split("\t")
+            if len(tmp) != 4:
+                continue
+            phoneme_data[tmp[0]] = [tmp[1], tmp[2], tmp[3]]
+
+        semantic_data_len = len(semantic_data)
+        phoneme_data_len = len(phoneme_data.keys())
         print("semantic_data_len:", semantic_data_len)
         print("phoneme_data_len:", phoneme_data_len)
-        print(self.semantic_data)
-        idx = 0
+        print(semantic_data)
+        semantic_phoneme = []
+        item_names = []
         num_not_in = 0
         num_deleted_bigger = 0
         num_deleted_ps = 0
-        for i in range(semantic_data_len):
-            # 先依次遍历
-            # get str
-            item_name = self.semantic_data.iloc[i, 0]
-            # print(self.phoneme_data)
+        # 整列取出后遍历, 逐行 iloc 在大数据集上很慢
+        for item_name, semantic_str in zip(semantic_data.iloc[:, 0].tolist(), semantic_data.iloc[:, 1].tolist()):
             try:
-                phoneme, word2ph, text = self.phoneme_data[item_name]
+                phoneme, word2ph, text = phoneme_data[item_name]
             except Exception:
                 traceback.print_exc()
                 # print(f"{item_name} not in self.phoneme_data !")
                 num_not_in += 1
                 continue
 
-            semantic_str = self.semantic_data.iloc[i, 1]
             # get token list
             semantic_ids = [int(idx) for idx in semantic_str.split(" ")]
             # (T), 是否需要变成 (1, T) -> 不需要，因为需要求 len
@@ -159,9 +178,6 @@ class Text2SemanticDataset(Dataset):
             if len(phoneme_ids) > self.max_sec * self.hz / 2.5:  ###########2：改为恒定限制为semantic/2.5就行
                 num_deleted_ps += 1
                 continue
-            # if len(semantic_ids) > 1000:###########3
-            #     num_deleted_bigger += 1
-            #     continue
 
             ps_ratio = len(phoneme_ids) / (len(semantic_ids) / self.hz)
 
@@ -170,20 +186,19 @@ class Text2SemanticDataset(Dataset):
                 # print(item_name)
                 continue
 
-            self.semantic_phoneme.append((semantic_ids, phoneme_ids))
-            idx += 1
-            self.item_names.append(item_name)
+            semantic_phoneme.append((semantic_ids, phoneme_ids))
+            item_names.append(item_name)
 
         min_num = 100  # 20直接不补#30补了也不存ckpt
-        leng = len(self.semantic_phoneme)
+        leng = len(semantic_phoneme)
         if leng < min_num:
-            tmp1 = self.semantic_phoneme
-            tmp2 = self.item_names
-            self.semantic_phoneme = []
-            self.item_names = []
+            tmp1 = semantic_phoneme
+            tmp2 = item_names
+            semantic_phoneme = []
+            item_names = []
             for _ in range(max(2, int(min_num / leng))):
-                self.semantic_phoneme += tmp1
-                self.item_names += tmp2
+                semantic_phoneme += tmp1
+                item_names += tmp2
         if num_not_in > 0:
             print(f"there are {num_not_in} semantic datas not in phoneme datas")
         if num_deleted_bigger > 0:
@@ -202,8 +217,7 @@ class Text2SemanticDataset(Dataset):
         dataset.__len__(): 366463
 
         """
-        # 345410 for LibriTTS
-        print("dataset.__len__():", self.__len__())
+        return semantic_phoneme, item_names
 
     def __get_item_names__(self) -> List[str]:
         return self.item_names
@@ -220,8 +234,12 @@ class Text2SemanticDataset(Dataset):
 
         flag = 0
         path_bert = "%s/%s.pt" % (self.path3, item_name)
-        if os.path.exists(path_bert) == True:
+        if self.packed is not None and self.packed.has("bert", item_name):
+            bert_feature = self.packed.get("bert", item_name)
+        elif os.path.exists(path_bert) == True:
             bert_feature = torch.load(path_bert, map_location="cpu")
+        elif self.bert_shards is not None and item_name in self.bert_shards:
+            bert_feature = self.bert_shards.get(item_name)
         else:
             flag = 1
         if flag == 1:
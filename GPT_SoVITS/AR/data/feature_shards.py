@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+特征分片容器
+
+数据集预处理时每条语音一个 .pt 小文件 (如 3-bert/<name>.pt), 上万条时文件系统开销很大.
+分片容器把多条特征顺序写进一个 .bin, 旁边的 .json 记录每条的偏移/形状/dtype:
+    <root>/<prefix>-0000.bin   原始数据
+    <root>/<prefix>-0000.json  {name: [offset, shape, dtype]}
+.json 在 .bin 写完后才落盘, 所以只有带 .json 的分片才算完整, 中断后可据此续跑.
+读取用 np.memmap, 训练时按名字随机读取不需要把整个分片读进内存.
+
+python GPT_SoVITS/AR/data/feature_shards.py <逐文件特征目录> <分片特征目录>
+可逐条比对两种输出是否一致.
+"""
+
+import glob
+import json
+import os
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+import torch
+
+SHARD_BYTES = 256 * 1024 * 1024
+
+
+class ShardWriter:
+    def __init__(self, root: str, prefix: str, max_bytes: int = SHARD_BYTES):
+        self.root = root
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        self.shard_id = len(glob.glob(os.path.join(root, "%s-*.json" % prefix)))
+        self.items = []
+        self.nbytes = 0
+
+    def add(self, name: str, tensor: torch.Tensor):
+        array = tensor.detach().cpu().contiguous().numpy()
+        self.items.append((name, array))
+        self.nbytes += array.nbytes
+        if self.nbytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.items:
+            return
+        base = os.path.join(self.root, "%s-%04d" % (self.prefix, self.shard_id))
+        index = {}
+        offset = 0
+        with open(base + ".bin", "wb") as f:
+            for name, array in self.items:
+                f.write(array.tobytes())
+                index[name] = [offset, list(array.shape), array.dtype.str]
+                offset += array.nbytes
+        tmp_path = base + ".json.tmp"
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_path, base + ".json")
+        self.shard_id += 1
+        self.items = []
+        self.nbytes = 0
+
+    def close(self):
+        self.flush()
+
+
+class ShardReader:
+    def __init__(self, root: str, prefix: Optional[str] = None):
+        self.index: Dict[str, tuple] = {}
+        self._maps: Dict[str, np.memmap] = {}
+        pattern = "%s-*.json" % prefix if prefix else "*.json"
+        for index_path in sorted(glob.glob(os.path.join(root, pattern))):
+            bin_path = index_path[: -len(".json")] + ".bin"
+            if not os.path.exists(bin_path):
+                continue
+            with open(index_path, "r", encoding="utf8") as f:
+                for name, (offset, shape, dtype) in json.load(f).items():
+                    self.index[name] = (bin_path, offset, tuple(shape), dtype)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.index
+
+    def names(self) -> Iterable[str]:
+        return self.index.keys()
+
+    def get(self, name: str, copy: bool = True) -> Optional[torch.Tensor]:
+        """copy=False 时直接返回 memmap 上的张量 (零拷贝, 写入只影响本进程的私有页)"""
+        entry = self.index.get(name)
+        if entry is None:
+            return None
+        bin_path, offset, shape, dtype = entry
+        data = self._maps.get(bin_path)
+        if data is None:
+            data = self._maps[bin_path] = np.memmap(bin_path, dtype=np.uint8, mode="c")
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        array = np.frombuffer(data, dtype=dtype, count=count, offset=offset).reshape(shape)
+        return torch.from_numpy(array.copy() if copy else array)
+
+    def __getstate__(self):
+        # DataLoader 多进程时各 worker 自己重新打开 memmap
+        state = self.__dict__.copy()
+        state["_maps"] = {}
+        return state
+
+
+def has_shards(root: str, prefix: Optional[str] = None) -> bool:
+    pattern = "%s-*.json" % prefix if prefix else "*.json"
+    return len(glob.glob(os.path.join(root, pattern))) > 0
+
+
+def verify(file_dir: str, shard_dir: str) -> dict:
+    """逐条比对逐文件 .pt 与分片中的同名特征, 返回统计"""
+    reader = ShardReader(shard_dir)
+    stats = {"compared": 0, "mismatched": [], "max_abs_diff": 0.0, "missing_in_shards": [], "only_in_shards": 0}
+    file_names = set()
+    for path in sorted(glob.glob(os.path.join(file_dir, "*.pt"))):
+        name = os.path.basename(path)[: -len(".pt")]
+        file_names.add(name)
+        sharded = reader.get(name)
+        if sharded is None:
+            stats["missing_in_shards"].append(name)
+            continue
+        stats["compared"] += 1
+        fea = torch.load(path, map_location="cpu")
+        if fea.dtype != sharded.dtype or fea.shape != sharded.shape:
+            stats["mismatched"].append(name)
+        elif not torch.equal(fea, sharded):
+            stats["mismatched"].append(name)
+            diff = (fea.float() - sharded.float()).abs().max().item()
+            stats["max_abs_diff"] = max(stats["max_abs_diff"], diff)
+    stats["only_in_shards"] = len([name for name in reader.names() if name not in file_names])
+    return stats
+
+
+if __name__ == "__main__":
+    import sys
+
+    result = verify(sys.argv[1], sys.argv[2])
+    print("compared: %s" % result["compared"])
+    print("mismatched: %s %s" % (len(result["mismatched"]), result["mismatched"][:20]))
+    print("max abs diff: %s" % result["max_abs_diff"])
+    print("missing in shards: %s %s" % (len(result["missing_in_shards"]), result["missing_in_shards"][:20]))
+    print("only in shards: %s" % result["only_in_shards"])
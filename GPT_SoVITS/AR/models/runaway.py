@@ -0,0 +1,152 @@
+"""
+T2S 失控生成检测
+
+early_stop_num 固定为 hz * max_sec (最多约 1500 个 token), 模型陷入循环或胡乱发音时会一直跑到上限, 是最差的延迟来源.
+这里在解码循环里在线检测三类信号, 每 sync_interval 步检查一次, 只在检查点与主机同步:
+- 重复: 最近 window 个 token 中不同 n-gram 所占比例低于 min_distinct (循环复读、过长的停顿)
+- 长度: 生成的 token 数超过 min_tokens + ratio * 目标文本音素数 (all_phoneme_lens 减去参考文本音素数),
+  ratio 取 tokens_per_phoneme 与参考音频语速 (每音素 token 数) 3 倍中的较大者
+- 趋势: 每步输出分布的熵与 EOS 概率的指数滑动平均, 熵持续过高 (胡乱发音) 或 EOS 概率持续偏高却一直没采到 EOS
+触发后按每条序列的 action 处理:
+- stop: 当作在此处生成了 EOS; 重复触发时截到重复片段第一次出现处
+- resample: 回退到重复片段开始之前 (检查点) 换随机数重新采样, 每条最多 max_resamples 次, 之后按 stop 处理;
+  只对重复触发生效, 其余信号回退也无济于事, 按 stop 处理
+- flag: 只记录, 不干预
+每次推理触发的记录保存在模型的 runaway_events 里. 阈值尚未在各版本的正式权重上验证, 可能截断正常输出,
+因此默认动作为 flag (只记录); 确认阈值合适后再用 t2s_runaway_action=stop/resample 干预. t2s_runaway=0 关闭检测.
+"""
+
+import os
+from typing import List, Optional, Sequence, Tuple, Union
+
+import torch
+
+RUNAWAY_ENABLED = os.environ.get("t2s_runaway", "1") != "0"
+RUNAWAY_ACTION = os.environ.get("t2s_runaway_action", "flag")
+RUNAWAY_WINDOW = int(os.environ.get("t2s_runaway_window", 150))
+RUNAWAY_NGRAM = int(os.environ.get("t2s_runaway_ngram", 4))
+RUNAWAY_MIN_DISTINCT = float(os.environ.get("t2s_runaway_min_distinct", 0.2))
+RUNAWAY_TOKENS_PER_PHONEME = float(os.environ.get("t2s_runaway_tokens_per_phoneme", 6.0))
+RUNAWAY_MIN_TOKENS = int(os.environ.get("t2s_runaway_min_tokens", 75))
+RUNAWAY_ENTROPY_MAX = float(os.environ.get("t2s_runaway_entropy_max", 5.5))
+RUNAWAY_EOS_THRESHOLD = float(os.environ.get("t2s_runaway_eos_threshold", 0.3))
+RUNAWAY_EMA_DECAY = float(os.environ.get("t2s_runaway_ema_decay", 0.9))
+RUNAWAY_MAX_RESAMPLES = int(os.environ.get("t2s_runaway_max_resamples", 1))
+
+ACTIONS = ("stop", "resample", "flag")
+# check() 返回的触发原因编号, 0 表示未触发
+REASONS = (None, "repeat", "length", "entropy", "eos")
+REPEAT, LENGTH, ENTROPY, EOS = 1, 2, 3, 4
+
+
+class RunawayDetector:
+    def __init__(
+        self,
+        x_lens: torch.Tensor,
+        prefix_len: int,
+        vocab_size: int,
+        eos: int,
+        prompt_phone_len: Optional[int] = None,
+        action: Union[str, Sequence[str], None] = None,
+    ):
+        """
+        x_lens: [B] 每条的音素数 (含参考文本); prefix_len: 参考音频的 semantic token 数;
+        action: 所有序列共用的动作, 或按原始 batch 顺序给出每条序列的动作
+        """
+        x_lens = x_lens.view(-1).long()
+        bsz = x_lens.shape[0]
+        device = x_lens.device
+        actions = action or RUNAWAY_ACTION
+        if isinstance(actions, str):
+            actions = [actions] * bsz
+        for item in actions:
+            if item not in ACTIONS:
+                raise ValueError("unknown runaway action: %s" % item)
+        self.actions = list(actions)
+        self.resamples = [0] * bsz
+        self.events = []
+        self.prefix_len = prefix_len
+        self.eos = eos
+
+        ratio = RUNAWAY_TOKENS_PER_PHONEME
+        text_phones = x_lens
+        if prompt_phone_len:
+            text_phones = (x_lens - prompt_phone_len).clamp(min=1)
+            ratio = max(ratio, 3 * prefix_len / prompt_phone_len)
+        self.limit = RUNAWAY_MIN_TOKENS + (ratio * text_phones).long()
+        # 每条序列有效的生成 token 数 (回退后会变小), 也用来计算下一步的位置编码
+        self.length = torch.zeros(bsz, dtype=torch.long, device=device)
+        # 每条序列当前连续生成段的起始列, 回退之前的列不再参与重复检测
+        self.since = torch.full((bsz,), prefix_len, dtype=torch.long, device=device)
+        self.entropy = torch.zeros(bsz, dtype=torch.float32, device=device)
+        self.eos_prob = torch.zeros(bsz, dtype=torch.float32, device=device)
+        self.flagged = torch.zeros(bsz, dtype=torch.bool, device=device)
+        self.powers = vocab_size ** torch.arange(RUNAWAY_NGRAM - 1, -1, -1, device=device)
+
+    def observe(self, logits: torch.Tensor):
+        """每步采样前调用, logits: [B, vocab]; 不含 EOS 的前几步只计数"""
+        self.length += 1
+        if logits.shape[-1] <= self.eos:
+            return
+        logp = torch.log_softmax(logits.float(), dim=-1)
+        entropy = -(logp.exp() * logp).sum(-1)
+        self.entropy.mul_(RUNAWAY_EMA_DECAY).add_(entropy, alpha=1 - RUNAWAY_EMA_DECAY)
+        self.eos_prob.mul_(RUNAWAY_EMA_DECAY).add_(logp[:, self.eos].exp(), alpha=1 - RUNAWAY_EMA_DECAY)
+
+    def check(self, tokens: torch.Tensor, cur_len: int, active: torch.Tensor) -> List[Tuple[int, int, int]]:
+        """
+        tokens: [B, >cur_len] 含参考音频 token 的缓冲区, cur_len 为最新 token 所在列; active: [B] 尚未结束的序列.
+        返回新触发的 (行, 原因, 重复片段首次出现的列)
+        """
+        reason = torch.zeros_like(self.length)
+        first = torch.zeros_like(self.length)
+        start = cur_len + 1 - RUNAWAY_WINDOW
+        if start >= self.prefix_len:
+            window = tokens[:, start : cur_len + 1].long()
+            hashes = (window.unfold(1, RUNAWAY_NGRAM, 1) * self.powers).sum(-1)
+            distinct = (hashes.sort(dim=1).values.diff(dim=1) != 0).sum(1) + 1
+            repeat = (distinct < RUNAWAY_MIN_DISTINCT * hashes.shape[1]).logical_and(self.since <= start)
+            reason = reason.masked_fill(repeat, REPEAT)
+            first = (hashes == hashes[:, -1:]).long().argmax(dim=1) + start
+        ready = self.length >= RUNAWAY_MIN_TOKENS
+        reason = reason.masked_fill((reason == 0).logical_and(self.length > self.limit), LENGTH)
+        reason = reason.masked_fill(
+            (reason == 0).logical_and(ready).logical_and(self.entropy > RUNAWAY_ENTROPY_MAX), ENTROPY
+        )
+        reason = reason.masked_fill(
+            (reason == 0).logical_and(ready).logical_and(self.eos_prob > RUNAWAY_EOS_THRESHOLD), EOS
+        )
+        rows = (reason > 0).logical_and(active).logical_and(~self.flagged).nonzero(as_tuple=True)[0]
+        if rows.numel() == 0:
+            return []
+        return list(zip(rows.tolist(), reason[rows].tolist(), first[rows].tolist()))
+
+    def decide(self, row: int, batch_idx: int, reason: int, first: int, step: int) -> str:
+        """按序列的 action 与回退次数决定处理方式并记录; first 之前至少要留一个生成的 token 才能回退"""
+        action = self.actions[batch_idx]
+        if action == "resample" and (
+            reason != REPEAT or self.resamples[batch_idx] >= RUNAWAY_MAX_RESAMPLES or first <= self.prefix_len
+        ):
+            action = "stop"
+        if action == "flag":
+            self.flagged[row] = True
+        elif action == "resample":
+            self.resamples[batch_idx] += 1
+        self.events.append({"index": batch_idx, "reason": REASONS[reason], "step": step, "action": action})
+        print("T2S 失控检测: 第 %s 条, 原因 %s, 第 %s 步, 处理 %s" % (batch_idx, REASONS[reason], step, action))
+        return action
+
+    def rollback(self, row: int, length: int, since: int):
+        """回退后该行只剩 length 个有效 token, since 为新的连续生成段起始列"""
+        self.length[row] = length
+        self.since[row] = since
+        self.entropy[row] = 0
+        self.eos_prob[row] = 0
+
+    def index_select(self, keep: torch.Tensor):
+        self.limit = self.limit.index_select(0, keep)
+        self.length = self.length.index_select(0, keep)
+        self.since = self.since.index_select(0, keep)
+        self.entropy = self.entropy.index_select(0, keep)
+        self.eos_prob = self.eos_prob.index_select(0, keep)
+        self.flagged = self.flagged.index_select(0, keep)
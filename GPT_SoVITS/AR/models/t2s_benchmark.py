@@ -0,0 +1,327 @@
+"""
+T2S 并行推理 (infer_panel_batch_infer) 的一致性检查与速度测试
+
+python GPT_SoVITS/AR/models/t2s_benchmark.py [-c s1权重.ckpt] [-b batch] [-n 重复次数] [--device cuda]
+不给权重时用随机初始化的模型, 并把每步 EOS 的 logit 设为其余 token 中第 eos_rank 大的值,
+EOS 以较小的概率被采到, 各条序列在不同步数结束 (parity 检查要求至少一条序列提前结束).
+- parity: 同一 seed 下 sync_interval=1 的解码与逐步移除已结束序列的参考实现 reference_batch_infer 输出完全一致
+- speed: 不同 sync_interval 下的 steps/sec 与 tokens/sec, CUDA 上另给出峰值显存
+  (参考实现按 [B, num_head, src_len, src_len] 复制掩码并逐步 F.pad, 新实现只用按长度构造的可广播掩码)
+- sampler: 同一 seed 下融合采样 (SamplerState) 与 logits_to_probs 逐步采样的结果对比, 以及不同历史长度下每步的耗时.
+  参考实现用的是未融合的采样, 两者只在浮点误差恰好改变候选集合或采样结果时才会不同.
+  融合采样默认关闭, 在目标设备上各历史长度都快于 logits_to_probs 时再设 t2s_fused_sampler=1 开启
+- --compile: 对比编译解码模式 (enable_compiled_decode) 与普通解码的 steps/sec, 以及两者输出一致的序列数
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+from torch.nn import functional as F
+
+# to import modules from GPT_SoVITS when run as a script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from AR.models.t2s_model import Text2SemanticDecoder
+from AR.models.utils import SamplerState, make_pad_mask_left, sample
+
+random_config = {
+    "model": {
+        "embedding_dim": 512,
+        "hidden_dim": 512,
+        "head": 16,
+        "n_layer": 24,
+        "dropout": 0,
+        "vocab_size": 1025,
+        "phoneme_vocab_size": 732,
+        "EOS": 1024,
+    }
+}
+
+
+def bias_eos(model, eos_rank):
+    """随机权重下 EOS 的 logit 与其他 token 无异, 几乎采不到; 改为每步其余 token 中第 eos_rank 大的 logit"""
+    eos = model.EOS
+
+    def hook(module, inputs, logits):
+        logits = logits.clone()
+        logits[..., eos] = logits[..., :eos].topk(eos_rank, dim=-1).values[..., -1]
+        return logits
+
+    model.ar_predict_layer.register_forward_hook(hook)
+
+
+def build_model(ckpt_path, device, is_half, eos_rank=8):
+    if ckpt_path:
+        dict_s1 = torch.load(ckpt_path, map_location="cpu", weights_only=False)
+        model = Text2SemanticDecoder(dict_s1["config"], top_k=3)
+        weights = {k[len("model.") :]: v for k, v in dict_s1["weight"].items() if k.startswith("model.")}
+        model.load_state_dict(weights)
+    else:
+        torch.manual_seed(0)
+        model = Text2SemanticDecoder(random_config, top_k=3)
+        bias_eos(model, eos_rank)
+    model = model.to(device).eval()
+    return model.half() if is_half else model
+
+
+def make_inputs(model, batch_size, device, dtype, prompt_len=100, seed=1234):
+    generator = torch.Generator().manual_seed(seed)
+    lens = torch.randint(20, 80, (batch_size,), generator=generator)
+    x = [torch.randint(0, model.phoneme_vocab_size, (int(n),), generator=generator).to(device) for n in lens]
+    bert = [(torch.randn(1024, int(n), generator=generator) * 0.1).to(device, dtype) for n in lens]
+    prompts = torch.randint(0, model.EOS, (batch_size, prompt_len), generator=generator).to(device)
+    return x, lens.to(device), prompts, bert
+
+
+def reference_batch_infer(
+    model, x, x_lens, prompts, bert_feature, top_k, top_p, early_stop_num, temperature, repetition_penalty
+):
+    """改用预分配缓冲区之前的解码循环: 每步拼接 y, 有序列结束时立即移出 batch"""
+    max_len = x_lens.max()
+    x_list = []
+    for x_item, bert_item in zip(x, bert_feature):
+        x_item = model.ar_text_embedding(x_item.unsqueeze(0))
+        x_item = x_item + model.bert_proj(bert_item.transpose(0, 1).unsqueeze(0))
+        x_item = model.ar_text_position(x_item).squeeze(0)
+        x_item = F.pad(x_item, (0, 0, max_len - x_item.shape[0], 0), value=0) if x_item.shape[0] < max_len else x_item
+        x_list.append(x_item)
+    x = torch.stack(x_list, dim=0)
+
+    y = prompts
+    x_len = x.shape[1]
+    y_emb = model.ar_audio_embedding(y)
+    y_len = y_emb.shape[1]
+    prefix_len = y.shape[1]
+    y_lens = torch.LongTensor([y_emb.shape[1]] * y_emb.shape[0]).to(x.device)
+    y_pos = model.ar_audio_position(y_emb)
+    xy_pos = torch.concat([x, y_pos], dim=1)
+
+    bsz = x.shape[0]
+    src_len = x_len + y_len
+    padding_mask = torch.concat([make_pad_mask_left(x_lens, max_len), make_pad_mask_left(y_lens, y_len)], dim=1)
+    x_mask = F.pad(torch.zeros(x_len, x_len, dtype=torch.bool, device=x.device), (0, y_len), value=True)
+    y_mask = F.pad(
+        torch.triu(torch.ones(y_len, y_len, dtype=torch.bool, device=x.device), diagonal=1), (x_len, 0), value=False
+    )
+    causal_mask = torch.concat([x_mask, y_mask], dim=0).view(1, src_len, src_len).repeat(bsz, 1, 1).to(x.device)
+    padding_mask = padding_mask.view(bsz, 1, src_len).repeat(1, src_len, 1)
+    attn_mask = causal_mask.logical_or(padding_mask)
+    attn_mask = attn_mask.unsqueeze(1).expand(-1, model.num_head, -1, -1).bool()
+
+    y_list = [None] * y.shape[0]
+    batch_idx_map = list(range(y.shape[0]))
+    idx_list = [None] * y.shape[0]
+    for idx in range(1500):
+        if idx == 0:
+            xy_dec, k_cache, v_cache = model.t2s_transformer.process_prompt(xy_pos, attn_mask, None)
+        else:
+            xy_dec, k_cache, v_cache = model.t2s_transformer.decode_next_token(xy_pos, k_cache, v_cache, attn_mask)
+        logits = model.ar_predict_layer(xy_dec[:, -1])
+        if idx == 0:
+            attn_mask = F.pad(attn_mask[:, :, -1].unsqueeze(-2), (0, 1), value=False)
+            logits = logits[:, :-1]
+        else:
+            attn_mask = F.pad(attn_mask, (0, 1), value=False)
+
+        samples = sample(
+            logits, y, top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty, temperature=temperature
+        )[0]
+        y = torch.concat([y, samples], dim=1)
+
+        tokens = torch.argmax(logits, dim=-1)
+        reserved = None
+        if (model.EOS in samples[:, 0]) or (model.EOS in tokens):
+            l = (samples[:, 0] == model.EOS).logical_or(tokens == model.EOS)
+            for i in torch.where(l == True)[0].tolist():
+                idx_list[batch_idx_map[i]] = idx
+                y_list[batch_idx_map[i]] = y[i, :-1]
+            reserved = torch.where(l == False)[0]
+            batch_idx_map = [batch_idx_map[i] for i in reserved.tolist()]
+        if reserved is not None:
+            y = torch.index_select(y, dim=0, index=reserved)
+            attn_mask = torch.index_select(attn_mask, dim=0, index=reserved)
+            for i in range(len(k_cache)):
+                k_cache[i] = torch.index_select(k_cache[i], dim=0, index=reserved)
+                v_cache[i] = torch.index_select(v_cache[i], dim=0, index=reserved)
+
+        if (early_stop_num != -1 and (y.shape[1] - prefix_len) > early_stop_num) or idx == 1499:
+            for i, batch_index in enumerate(batch_idx_map):
+                idx_list[batch_index] = idx
+                y_list[batch_index] = y[i, :-1]
+        if None not in idx_list:
+            break
+
+        y_emb = model.ar_audio_embedding(y[:, -1:])
+        xy_pos = y_emb * model.ar_audio_position.x_scale + model.ar_audio_position.alpha * model.ar_audio_position.pe[
+            :, y_len + idx
+        ].to(dtype=y_emb.dtype, device=y_emb.device)
+    return y_list, idx_list
+
+
+def sync(device):
+    if str(device).startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def peak_memory(device):
+    if str(device).startswith("cuda"):
+        return torch.cuda.max_memory_allocated() / 1024**2
+    return 0.0
+
+
+def timed(fn, device, seed):
+    torch.manual_seed(seed)
+    if str(device).startswith("cuda"):
+        torch.cuda.reset_peak_memory_stats()
+    sync(device)
+    t0 = time.perf_counter()
+    with torch.no_grad():
+        y_list, idx_list = fn()
+    sync(device)
+    return y_list, idx_list, time.perf_counter() - t0
+
+
+def sampler_parity(batch_size, vocab_size, history, device, options, steps=200):
+    """返回 (采样结果一致的步数, 总步数, probs 最大误差)"""
+    generator = torch.Generator().manual_seed(0)
+    tokens = torch.randint(0, vocab_size - 1, (batch_size, history), generator=generator).to(device)
+    state = SamplerState(tokens, vocab_size)
+    same, max_diff = 0, 0.0
+    for step in range(steps):
+        logits = (torch.randn(batch_size, vocab_size, generator=generator) * 3).to(device)
+        torch.manual_seed(step)
+        ref_idx, ref_probs = sample(logits.clone(), tokens, **options)
+        torch.manual_seed(step)
+        idx, probs = sample(logits.clone(), state=state, **options)
+        same += int(torch.equal(ref_idx, idx))
+        max_diff = max(max_diff, (ref_probs - probs).abs().max().item())
+        tokens = torch.cat([tokens, idx.to(tokens.dtype)], dim=1)
+    return same, steps, max_diff
+
+
+def sampler_speed(batch_size, vocab_size, history, device, options, iters=200):
+    """返回 logits_to_probs 与融合采样每步的耗时 (us)"""
+    tokens = torch.randint(0, vocab_size - 1, (batch_size, history), device=device)
+    logits = torch.randn(batch_size, vocab_size, device=device) * 3
+    state = SamplerState(tokens, vocab_size)
+    steps = [
+        lambda: sample(logits.clone(), tokens, **options),
+        lambda: sample(logits.clone(), state=state, **options),
+    ]
+    times = []
+    for fn in steps:
+        fn()
+        sync(device)
+        t0 = time.perf_counter()
+        for _ in range(iters):
+            fn()
+        sync(device)
+        times.append((time.perf_counter() - t0) / iters * 1e6)
+    return times
+
+
+def same_outputs(a, b):
+    return a[1] == b[1] and all(torch.equal(ya, yb) for ya, yb in zip(a[0], b[0]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parity check and steps/sec benchmark for batched T2S decoding")
+    parser.add_argument("-c", "--ckpt", default=None, help="s1 checkpoint, random weights when omitted")
+    parser.add_argument("-b", "--batch_size", type=int, default=20)
+    parser.add_argument("-n", "--repeat", type=int, default=3)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--half", action="store_true")
+    parser.add_argument("--early_stop_num", type=int, default=500)
+    parser.add_argument("--top_k", type=int, default=15)
+    parser.add_argument("--top_p", type=float, default=1.0)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--repetition_penalty", type=float, default=1.35)
+    parser.add_argument("--sync_intervals", default="1,4,16")
+    parser.add_argument("--sampler_only", action="store_true", help="only run the sampler parity/microbenchmark")
+    parser.add_argument("--compile", action="store_true", help="also benchmark the compiled decode step")
+    parser.add_argument("--compile_mode", default=None, help="torch.compile mode, e.g. reduce-overhead")
+    args = parser.parse_args()
+
+    sampler_options = dict(
+        top_k=args.top_k, top_p=args.top_p, temperature=args.temperature, repetition_penalty=args.repetition_penalty
+    )
+    for top_p in sorted(set([args.top_p, 0.8])):
+        same, steps, max_diff = sampler_parity(
+            args.batch_size, 1025, 100, args.device, dict(sampler_options, top_p=top_p)
+        )
+        print("sampler parity (top_p=%s): %s/%s steps same, max prob diff %.2e" % (top_p, same, steps, max_diff))
+    for history in (100, 500, 1500):
+        ref_us, fused_us = sampler_speed(args.batch_size, 1025, history, args.device, sampler_options)
+        print(
+            "sampler history %5d: logits_to_probs %8.1f us/step, fused %8.1f us/step (%.2fx)"
+            % (history, ref_us, fused_us, ref_us / fused_us)
+        )
+    if args.sampler_only:
+        sys.exit(0)
+
+    model = build_model(args.ckpt, args.device, args.half)
+    x, x_lens, prompts, bert = make_inputs(model, args.batch_size, args.device, next(model.parameters()).dtype)
+    options = dict(
+        top_k=args.top_k,
+        top_p=args.top_p,
+        early_stop_num=args.early_stop_num,
+        temperature=args.temperature,
+        repetition_penalty=args.repetition_penalty,
+    )
+
+    def reference():
+        return reference_batch_infer(model, x, x_lens, prompts, bert, **options)
+
+    def batched(sync_interval, runaway=False):
+        # 随机权重下失控检测几乎必然触发, 一致性与速度对比默认关闭, 单独一行测它的开销
+        return lambda: model.infer_panel_batch_infer(
+            x, x_lens, prompts, bert, max_len=x_lens.max(), sync_interval=sync_interval, runaway=runaway, **options
+        )
+
+    ref = timed(reference, args.device, 0)
+    new = timed(batched(1), args.device, 0)
+    print("parity (sync_interval=1 vs reference): %s" % ("OK" if same_outputs(ref, new) else "MISMATCH"))
+    print("end steps: %s" % ref[1])
+    # 所有序列都跑到 early_stop_num 时不会经过移出已结束序列、压缩 KV cache 的路径, parity 没有意义
+    assert min(ref[1]) < max(ref[1]), "no row retired before the others, parity does not cover KV compaction"
+    assert same_outputs(ref, new), "batched decode differs from the reference"
+
+    results = [("reference", reference)] + [
+        ("sync_interval=%s" % k, batched(int(k))) for k in args.sync_intervals.split(",")
+    ]
+    results.append(("runaway detector", batched(4, runaway=True)))
+    for name, fn in results:
+        elapsed = []
+        for i in range(args.repeat):
+            y_list, idx_list, t = timed(fn, args.device, i)
+            elapsed.append(t)
+        t = min(elapsed)
+        print(
+            "%-18s %8.1f steps/sec %10.1f tokens/sec %8.1f MB peak"
+            % (name, (max(idx_list) + 1) / t, sum(i + 1 for i in idx_list) / t, peak_memory(args.device))
+        )
+
+    if args.compile:
+        eager = timed(batched(4), args.device, 0)
+        t0 = time.perf_counter()
+        model.enable_compiled_decode(
+            mode=args.compile_mode,
+            warmup_batch_sizes=[args.batch_size],
+            warmup_kv_lens=[prompts.shape[1] + int(x_lens.max()) + i for i in range(0, args.early_stop_num + 256, 256)],
+        )
+        print("compile + warmup: %.1fs" % (time.perf_counter() - t0))
+        elapsed = []
+        for i in range(args.repeat):
+            y_list, idx_list, t = timed(batched(4), args.device, i)
+            elapsed.append(t)
+        t = min(elapsed)
+        print(
+            "%-18s %8.1f steps/sec %10.1f tokens/sec %8.1f MB peak"
+            % ("compiled", (max(idx_list) + 1) / t, sum(i + 1 for i in idx_list) / t, peak_memory(args.device))
+        )
+        compiled = timed(batched(4), args.device, 0)
+        same = sum(int(torch.equal(a, b)) for a, b in zip(eager[0], compiled[0]))
+        print("compiled vs eager: %s/%s sequences identical" % (same, len(eager[0])))
@@ -0,0 +1,193 @@
+"""
+T2S 解码步的编译模式 (可选)
+
+逐 token 解码时每步都要为 24 层分别调度 qkv/SDPA/out-proj/layernorm/MLP, Python 与算子调度开销占了大头.
+这里把一步中所有层写成一个函数交给 torch.compile:
+- KV cache 预分配成 [batch 桶, KV 长度桶, hidden] 的静态缓冲区, 新的 k/v 按位置写入, 注意力按长度掩码,
+  形状只随桶变化, 重新编译的次数有上限
+- batch 向上取到 batch_buckets 中的桶, 多出的行复制第一行, 结果丢弃; KV 长度按 kv_bucket 取整, 用满后换下一个桶
+- warmup 在启动时预先编译常用的桶
+- 每个 (batch 桶, KV 长度桶) 都是一份单独的编译结果, 远多于 dynamo 默认的 cache_size_limit (8),
+  超出后会静默退回不编译的执行, 因此按桶的个数调大上限
+torch.compile 不可用或编译失败 (如 CPU 上没有可用的 C++ 编译器) 时退回不编译的同一函数, 仍可正常推理.
+静态缓冲区按整桶长度计算注意力 (多出的位置被掩码), 与逐步拼接的解码在浮点误差内一致, 不保证逐位相同.
+"""
+
+import math
+import time
+import traceback
+from typing import List, Sequence
+
+import torch
+from torch.nn import functional as F
+
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+KV_BUCKET = 256
+# 预计最长的 KV 长度 (文本 + 参考音频 + 最多 1500 个生成 token), 决定需要容纳多少个编译结果
+MAX_KV_LEN = 4096
+
+
+def bucket_size(n: int, buckets: Sequence[int]) -> int:
+    for bucket in buckets:
+        if n <= bucket:
+            return bucket
+    return n
+
+
+class T2SCompiledDecoder:
+    def __init__(
+        self,
+        transformer,
+        num_heads: int,
+        batch_buckets=BATCH_BUCKETS,
+        kv_bucket=KV_BUCKET,
+        mode=None,
+        max_kv_len=MAX_KV_LEN,
+    ):
+        """transformer: T2STransformer, 直接引用其中的参数, 模型之后 .to()/.half() 仍然有效"""
+        self.num_heads = num_heads
+        self.hidden_dim = transformer.blocks[0].hidden_dim
+        self.layers = [
+            (
+                block.qkv_w,
+                block.qkv_b,
+                block.out_w,
+                block.out_b,
+                block.norm_w1,
+                block.norm_b1,
+                float(block.norm_eps1),
+                block.mlp.w1,
+                block.mlp.b1,
+                block.mlp.w2,
+                block.mlp.b2,
+                block.norm_w2,
+                block.norm_b2,
+                float(block.norm_eps2),
+            )
+            for block in transformer.blocks
+        ]
+        self.batch_buckets = tuple(sorted(batch_buckets))
+        self.kv_bucket = kv_bucket
+        self.compiled = None
+        if hasattr(torch, "compile"):
+            try:
+                self.raise_cache_limit(len(self.batch_buckets) * math.ceil(max_kv_len / kv_bucket))
+                self.compiled = torch.compile(self.step, mode=mode, dynamic=False)
+            except Exception:
+                traceback.print_exc()
+        if self.compiled is None:
+            print("torch.compile 不可用, T2S 编译模式退回普通执行")
+
+    @staticmethod
+    def raise_cache_limit(num_shapes: int):
+        """保证 dynamo 能为每个桶保留一份编译结果 (新版本中该选项改名为 recompile_limit)"""
+        import torch._dynamo
+
+        config = torch._dynamo.config
+        for name in ("cache_size_limit", "recompile_limit", "accumulated_cache_size_limit"):
+            if hasattr(config, name) and getattr(config, name) < num_shapes:
+                setattr(config, name, num_shapes)
+
+    def step(self, x: torch.Tensor, k_caches: List[torch.Tensor], v_caches: List[torch.Tensor], pos, pad_mask):
+        """
+        所有层的一步解码. x: [B, 1, hidden]; pos: [1] 新 token 的位置;
+        k_caches/v_caches: 每层 [B, L, hidden], 新的 k/v 原地写入 pos; pad_mask: [B, L], True 为 padding
+        """
+        batch_size, kv_len = pad_mask.shape
+        positions = torch.arange(kv_len, device=x.device)
+        attn_mask = (positions <= pos).logical_and(~pad_mask).view(batch_size, 1, 1, kv_len)
+        for i, layer in enumerate(self.layers):
+            qkv_w, qkv_b, out_w, out_b, norm_w1, norm_b1, eps1, w1, b1, w2, b2, norm_w2, norm_b2, eps2 = layer
+            q, k, v = F.linear(x, qkv_w, qkv_b).chunk(3, dim=-1)
+            k_caches[i].index_copy_(1, pos, k)
+            v_caches[i].index_copy_(1, pos, v)
+            q = q.view(batch_size, 1, self.num_heads, -1).transpose(1, 2)
+            k = k_caches[i].view(batch_size, kv_len, self.num_heads, -1).transpose(1, 2)
+            v = v_caches[i].view(batch_size, kv_len, self.num_heads, -1).transpose(1, 2)
+            attn = F.scaled_dot_product_attention(q, k, v, attn_mask)
+            attn = F.linear(attn.transpose(1, 2).reshape(batch_size, 1, -1), out_w, out_b)
+            x = F.layer_norm(x + attn, [self.hidden_dim], norm_w1, norm_b1, eps1)
+            x = x + F.linear(F.relu(F.linear(x, w1, b1)), w2, b2)
+            x = F.layer_norm(x, [self.hidden_dim], norm_w2, norm_b2, eps2)
+        return x
+
+    def run(self, x, k_caches, v_caches, pos, pad_mask):
+        if self.compiled is not None:
+            try:
+                return self.compiled(x, k_caches, v_caches, pos, pad_mask)
+            except Exception:
+                traceback.print_exc()
+                print("T2S 编译失败, 退回普通执行")
+                self.compiled = None
+        return self.step(x, k_caches, v_caches, pos, pad_mask)
+
+    def session(self, k_cache: List[torch.Tensor], v_cache: List[torch.Tensor], padding_mask: torch.Tensor):
+        """用 process_prompt 的输出 ([B, src_len, hidden] 列表) 和 [B, src_len] 的 padding 掩码开始一次解码"""
+        return T2SDecodeSession(self, k_cache, v_cache, padding_mask)
+
+    def warmup(self, batch_sizes=(1,), kv_lens=(512, 1024), device="cpu", dtype=torch.float32):
+        """预先编译 batch_sizes x kv_lens 对应的桶"""
+        t0 = time.perf_counter()
+        with torch.no_grad():
+            for batch_size in batch_sizes:
+                batch = bucket_size(batch_size, self.batch_buckets)
+                for kv_len in kv_lens:
+                    kv_len = math.ceil(kv_len / self.kv_bucket) * self.kv_bucket
+                    shape = (batch, kv_len, self.hidden_dim)
+                    k_caches = [torch.zeros(shape, device=device, dtype=dtype) for _ in self.layers]
+                    v_caches = [torch.zeros(shape, device=device, dtype=dtype) for _ in self.layers]
+                    pad_mask = torch.zeros(batch, kv_len, dtype=torch.bool, device=device)
+                    x = torch.zeros(batch, 1, self.hidden_dim, device=device, dtype=dtype)
+                    pos = torch.tensor([0], device=device)
+                    self.run(x, k_caches, v_caches, pos, pad_mask)
+        elapsed = time.perf_counter() - t0
+        print("T2S 编译模式预热完成: batch %s, kv %s, %.1fs" % (list(batch_sizes), list(kv_lens), elapsed))
+
+
+class T2SDecodeSession:
+    """一次批量解码的静态 KV cache 状态, 对应 T2STransformer.decode_next_token 的用法"""
+
+    def __init__(self, decoder: T2SCompiledDecoder, k_cache, v_cache, padding_mask):
+        self.decoder = decoder
+        self.batch_size = padding_mask.shape[0]
+        self.pos = padding_mask.shape[1]
+        self.k_caches = k_cache
+        self.v_caches = v_cache
+        self.pad_mask = padding_mask
+        self.resize(torch.arange(self.batch_size, device=padding_mask.device))
+
+    def resize(self, keep: torch.Tensor):
+        """只保留 keep 中的行, 并把 batch/KV 长度补到桶大小"""
+        batch_size = keep.shape[0]
+        batch = bucket_size(batch_size, self.decoder.batch_buckets)
+        kv_len = math.ceil((self.pos + 1) / self.decoder.kv_bucket) * self.decoder.kv_bucket
+        rows = torch.cat([keep, keep[:1].expand(batch - batch_size)])
+
+        def fit(cache):
+            out = cache.new_zeros((batch, kv_len) + tuple(cache.shape[2:]))
+            out[:, : self.pos] = cache[:, : self.pos].index_select(0, rows)
+            return out
+
+        self.k_caches = [fit(cache) for cache in self.k_caches]
+        self.v_caches = [fit(cache) for cache in self.v_caches]
+        self.pad_mask = fit(self.pad_mask)
+        self.batch_size = batch_size
+
+    def index_select(self, keep: torch.Tensor):
+        self.resize(keep)
+
+    def mask(self, row: int, start: int, end: int):
+        """屏蔽 row 行 [start, end) 位置的 KV, 用于失控检测回退"""
+        self.pad_mask[row, start:end] = True
+
+    def decode(self, x: torch.Tensor) -> torch.Tensor:
+        """x: [batch_size, 1, hidden], 返回最后一层的输出 [batch_size, 1, hidden]"""
+        if self.pos >= self.pad_mask.shape[1]:
+            self.resize(torch.arange(self.batch_size, device=x.device))
+        batch = self.pad_mask.shape[0]
+        if batch > self.batch_size:
+            x = torch.cat([x, x[:1].expand(batch - self.batch_size, -1, -1)], dim=0)
+        pos = torch.tensor([self.pos], device=x.device)
+        out = self.decoder.run(x, self.k_caches, self.v_caches, pos, self.pad_mask)
+        self.pos += 1
+        return out[: self.batch_size]
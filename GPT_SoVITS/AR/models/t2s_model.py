@@ -1,6 +1,8 @@
 # modified from https://github.com/yangdongchao/SoundStorm/blob/master/soundstorm/s1/AR/models/t2s_model.py
 # reference: https://github.com/lifeiteng/vall-e
 import math
+import os
+import threading
 from typing import List, Optional
 
 import torch
@@ -10,6 +12,7 @@ from torchmetrics.classification import MulticlassAccuracy
 from tqdm import tqdm
 
 from AR.models.utils import (
+    SamplerState,
     dpo_loss,
     get_batch_logps,
     make_pad_mask,
@@ -18,6 +21,7 @@ from AR.models.utils import (
     sample,
     topk_sampling,
 )
+from AR.models.runaway import REPEAT, RUNAWAY_ENABLED, RUNAWAY_NGRAM, RunawayDetector
 from AR.modules.embedding import SinePositionalEmbedding, TokenEmbedding
 from AR.modules.transformer import LayerNorm, TransformerEncoder, TransformerEncoderLayer
 
@@ -33,6 +37,14 @@ default_config = {
     "EOS": 1024,
 }
 
+# 并行推理时每隔多少步同步一次、移除已生成完毕的序列
+T2S_SYNC_INTERVAL = int(os.environ.get("t2s_sync_interval", 4))
+# 传入 cancel_token 时每隔多少步检查一次请求是否已取消
+T2S_CANCEL_INTERVAL = int(os.environ.get("t2s_cancel_interval", 10))
+# 并行推理使用融合采样 (SamplerState + logits_to_probs_fused); 输出与逐步采样一致, 但只在长历史、大 batch 时可能更快,
+# 默认关闭, 先用 t2s_benchmark.py --sampler_only 在目标设备上确认有收益再开启
+T2S_FUSED_SAMPLER = os.environ.get("t2s_fused_sampler", "0") == "1"
+
 
 # @torch.jit.script ## 使用的话首次推理会非常慢，而且推理速度不稳定
 # Efficient implementation equivalent to the following:
@@ -351,6 +363,28 @@ class Text2SemanticDecoder(nn.Module):
             blocks.append(block)
 
         self.t2s_transformer = T2STransformer(self.num_layers, blocks)
+        # 可选的编译解码模式, 见 enable_compiled_decode
+        self.compiled_decoder = None
+        # 失控检测记录按线程保存, 并发推理的请求互不覆盖
+        self._runaway_events = {}
+
+    @property
+    def runaway_events(self) -> list:
+        """当前线程最近一次推理的失控检测记录"""
+        return self._runaway_events.get(threading.get_ident(), [])
+
+    @runaway_events.setter
+    def runaway_events(self, events: list):
+        self._runaway_events[threading.get_ident()] = events
+
+    def enable_compiled_decode(self, mode=None, warmup_batch_sizes=(1, 2, 4, 8), warmup_kv_lens=(512, 1024)):
+        """并行推理的逐 token 解码改用 torch.compile 编译的静态形状解码步 (见 AR/models/t2s_compiled.py) 并预热"""
+        from AR.models.t2s_compiled import T2SCompiledDecoder
+
+        self.compiled_decoder = T2SCompiledDecoder(self.t2s_transformer, self.num_head, mode=mode)
+        param = self.ar_predict_layer.weight
+        self.compiled_decoder.warmup(warmup_batch_sizes, warmup_kv_lens, param.device, param.dtype)
+        return self.compiled_decoder
 
     def make_input_data(self, x, x_lens, y, y_lens, bert_feature):
         x = self.ar_text_embedding(x)
@@ -625,7 +659,6 @@ class Text2SemanticDecoder(nn.Module):
         y = prompts
 
         x_len = x.shape[1]
-        stop = False
 
         k_cache = None
         v_cache = None
@@ -661,7 +694,7 @@ class Text2SemanticDecoder(nn.Module):
             value=False,
         )
 
-        causal_mask = torch.concat([x_mask, y_mask], dim=0).view(1, src_len, src_len).repeat(bsz, 1, 1).to(x.device)
+        causal_mask = torch.concat([x_mask, y_mask], dim=0).view(1, 1, src_len, src_len)
         # padding_mask = padding_mask.unsqueeze(1) * padding_mask.unsqueeze(2) ### [b, x+y, x+y]
         ### 上面是错误的，会导致padding的token被"看见"
 
@@ -677,10 +710,8 @@ class Text2SemanticDecoder(nn.Module):
         # [PAD, PAD, PAD, 1, 2, 3, 4, 5, 6],
         # [PAD, PAD, PAD, 1, 2, 3, 4, 5, 6]]
 
-        padding_mask = padding_mask.view(bsz, 1, src_len).repeat(1, src_len, 1)
-
-        attn_mask: torch.Tensor = causal_mask.logical_or(padding_mask)
-        attn_mask = attn_mask.unsqueeze(1).expand(-1, self.num_head, -1, -1).bool()
+        # 掩码只按长度构造, 各 head 之间靠广播共享, 不再按 batch/head 复制: [B, 1, src_len, src_len]
+        attn_mask: torch.Tensor = causal_mask.logical_or(padding_mask.view(bsz, 1, 1, src_len))
 
         # 正确的attn_mask应该是这样的：
         # |   pad_len   |  x_len  |  y_len  |
@@ -694,84 +725,147 @@ class Text2SemanticDecoder(nn.Module):
         # [PAD, PAD, PAD, 1, 2, 3,   4,   5, EOS],
         # [PAD, PAD, PAD, 1, 2, 3,   4,   5,   6]]
 
+        # 解码阶段每步只有一个 query, 可见范围就是除左侧 padding 外的全部位置.
+        # 预先构造 [B, 1, 1, src_len + max_steps] 的掩码, 每步取前 kv_len 列的视图, 不再逐步 F.pad
+        max_steps = 1500
+        decode_mask = F.pad(padding_mask, (0, max_steps), value=False).view(bsz, 1, 1, -1)
+
         ###### decode #####
-        y_list = [None] * y.shape[0]
-        batch_idx_map = list(range(y.shape[0]))
-        idx_list = [None] * y.shape[0]
-        for idx in tqdm(range(1500)):
+        # 生成的 token 直接写进预分配的 [B, prefix_len + max_steps] 缓冲区, 每条序列是否结束、结束位置都留在设备上,
+        # 每 sync_interval 步才同步一次, 把已结束的序列一次性移出 batch.
+        # sync_interval 为 1 时与逐步移除的结果 (含随机数消耗) 完全一致; 更大时已结束的序列会多跑几步,
+        # 同一 seed 下多条并行时采样结果会与 1 不同
+        sync_interval = max(1, int(kwargs.get("sync_interval", T2S_SYNC_INTERVAL)))
+        tokens = torch.zeros((bsz, prefix_len + max_steps), dtype=y.dtype, device=y.device)
+        tokens[:, :prefix_len] = y
+        finished = torch.zeros(bsz, dtype=torch.bool, device=y.device)
+        end_idx = torch.full((bsz,), max_steps - 1, dtype=torch.long, device=y.device)
+        batch_index = torch.arange(bsz, device=y.device)
+        # 融合采样时重复惩罚用增量更新的 token 出现表, 不再每步 gather/scatter 整个历史
+        sampler = SamplerState(y, self.vocab_size) if T2S_FUSED_SAMPLER else None
+        y_list = [None] * bsz
+        idx_list = [None] * bsz
+        pbar = tqdm(total=max_steps)
+        session = None
+        cancel_token = kwargs.get("cancel_token")
+        # 失控生成检测, 回退重新采样时把丢弃的列在 decode_mask 里掩掉, 输出时按掩码剔除
+        detector = None
+        rolled_back = False
+        if kwargs.get("runaway", RUNAWAY_ENABLED):
+            detector = RunawayDetector(
+                x_lens,
+                prefix_len,
+                self.vocab_size,
+                self.EOS,
+                prompt_phone_len=kwargs.get("prompt_phone_len"),
+                action=kwargs.get("runaway_action"),
+            )
+        self.runaway_events = detector.events if detector is not None else []
+        for idx in range(max_steps):
+            if cancel_token is not None and idx % T2S_CANCEL_INTERVAL == 0:
+                cancel_token.raise_if_cancelled("t2s", t2s_steps=max_steps - idx)
             if idx == 0:
                 xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt(xy_pos, attn_mask, None)
+                if self.compiled_decoder is not None and kwargs.get("compiled", True):
+                    session = self.compiled_decoder.session(k_cache, v_cache, padding_mask)
+                    k_cache, v_cache = [], []
+            elif session is not None:
+                xy_dec = session.decode(xy_pos)
             else:
-                xy_dec, k_cache, v_cache = self.t2s_transformer.decode_next_token(xy_pos, k_cache, v_cache, attn_mask)
+                xy_dec, k_cache, v_cache = self.t2s_transformer.decode_next_token(
+                    xy_pos, k_cache, v_cache, decode_mask[..., : src_len + idx]
+                )
             logits = self.ar_predict_layer(xy_dec[:, -1])
 
             if idx == 0:
-                attn_mask = F.pad(attn_mask[:, :, -1].unsqueeze(-2), (0, 1), value=False)
+                attn_mask = None
                 logits = logits[:, :-1]
-            else:
-                attn_mask = F.pad(attn_mask, (0, 1), value=False)
+            if detector is not None:
+                detector.observe(logits)
 
+            cur_len = prefix_len + idx
             samples = sample(
-                logits, y, top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty, temperature=temperature
+                logits,
+                tokens[:, :cur_len],
+                state=sampler,
+                top_k=top_k,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty,
+                temperature=temperature,
             )[0]
+            tokens[:, cur_len] = samples[:, 0]
 
-            y = torch.concat([y, samples], dim=1)
-
-            ####### 移除batch中已经生成完毕的序列,进一步优化计算量
-            tokens = torch.argmax(logits, dim=-1)
-            reserved_idx_of_batch_for_y = None
-            if (self.EOS in samples[:, 0]) or (self.EOS in tokens):  ###如果生成到EOS，则停止
-                l1 = samples[:, 0] == self.EOS
-                l2 = tokens == self.EOS
-                l = l1.logical_or(l2)
-                removed_idx_of_batch_for_y = torch.where(l == True)[0].tolist()
-                reserved_idx_of_batch_for_y = torch.where(l == False)[0]
-                # batch_indexs = torch.tensor(batch_idx_map, device=y.device)[removed_idx_of_batch_for_y]
-                for i in removed_idx_of_batch_for_y:
-                    batch_index = batch_idx_map[i]
-                    idx_list[batch_index] = idx
-                    y_list[batch_index] = y[i, :-1]
-
-                batch_idx_map = [batch_idx_map[i] for i in reserved_idx_of_batch_for_y.tolist()]
-
-            # 只保留batch中未生成完毕的序列
-            if reserved_idx_of_batch_for_y is not None:
-                # index = torch.LongTensor(batch_idx_map).to(y.device)
-                y = torch.index_select(y, dim=0, index=reserved_idx_of_batch_for_y)
-                attn_mask = torch.index_select(attn_mask, dim=0, index=reserved_idx_of_batch_for_y)
-                if k_cache is not None:
-                    for i in range(len(k_cache)):
-                        k_cache[i] = torch.index_select(k_cache[i], dim=0, index=reserved_idx_of_batch_for_y)
-                        v_cache[i] = torch.index_select(v_cache[i], dim=0, index=reserved_idx_of_batch_for_y)
+            ####### 记录生成到EOS的序列
+            stop_now = (samples[:, 0] == self.EOS).logical_or(torch.argmax(logits, dim=-1) == self.EOS)
+            end_idx = end_idx.masked_fill(stop_now.logical_and(~finished), idx)
+            finished = finished.logical_or(stop_now)
 
-            if (early_stop_num != -1 and (y.shape[1] - prefix_len) > early_stop_num) or idx == 1499:
+            last_step = idx == max_steps - 1 or (early_stop_num != -1 and idx + 1 > early_stop_num)
+            if last_step:
                 print("use early stop num:", early_stop_num)
-                stop = True
-                for i, batch_index in enumerate(batch_idx_map):
-                    batch_index = batch_idx_map[i]
-                    idx_list[batch_index] = idx
-                    y_list[batch_index] = y[i, :-1]
-
-            if None not in idx_list:
-                stop = True
+                end_idx = end_idx.masked_fill(~finished, idx)
+                finished.fill_(True)
 
-            if stop:
-                if y.shape[1] == 0:
-                    y = torch.concat([y, torch.zeros_like(samples)], dim=1)
-                    print("bad zero prediction")
-                print(f"T2S Decoding EOS [{prefix_len} -> {y.shape[1]}]")
-                break
+            ####### 移除batch中已经生成完毕的序列,进一步优化计算量
+            if last_step or (idx + 1) % sync_interval == 0:
+                pbar.update(idx + 1 - pbar.n)
+                if detector is not None and not last_step:
+                    for row, reason, first in detector.check(tokens, cur_len, ~finished):
+                        action = detector.decide(row, batch_index[row].item(), reason, first, idx)
+                        if action == "stop":
+                            # end_idx 为生成段内的列偏移, 重复时保留到片段第一次出现为止
+                            end_idx[row] = first + RUNAWAY_NGRAM - prefix_len if reason == REPEAT else idx
+                            finished[row] = True
+                        elif action == "resample":
+                            # 掩掉 first - 1 .. cur_len - 1 列的 KV, 当前列换成 first - 1 列的 token 重新输入,
+                            # 下一步即从片段开始前重新采样 (随机数已不同)
+                            decode_mask[row, :, :, x_len + first - 1 : x_len + cur_len] = True
+                            if session is not None:
+                                session.mask(row, x_len + first - 1, x_len + cur_len)
+                            tokens[row, cur_len] = tokens[row, first - 1]
+                            detector.rollback(row, first - prefix_len, cur_len)
+                            rolled_back = True
+                done = finished.nonzero(as_tuple=True)[0]
+                if done.numel() > 0:
+                    for row, batch_idx, end in zip(done.tolist(), batch_index[done].tolist(), end_idx[done].tolist()):
+                        y_list[batch_idx] = tokens[row, : prefix_len + end]
+                        idx_list[batch_idx] = end
+                        if rolled_back:
+                            # 剔除回退时丢弃的列
+                            valid = ~decode_mask[row, 0, 0, x_len : x_len + prefix_len + end]
+                            y_list[batch_idx] = y_list[batch_idx][valid]
+                            idx_list[batch_idx] = y_list[batch_idx].shape[0] - prefix_len
+                    if done.numel() == finished.shape[0]:
+                        print(f"T2S Decoding EOS [{prefix_len} -> {cur_len + 1}]")
+                        break
+                    # 只保留batch中未生成完毕的序列
+                    keep = (~finished).nonzero(as_tuple=True)[0]
+                    tokens = tokens.index_select(0, keep)
+                    decode_mask = decode_mask.index_select(0, keep)
+                    end_idx = end_idx.index_select(0, keep)
+                    batch_index = batch_index.index_select(0, keep)
+                    finished = finished.index_select(0, keep)
+                    if sampler is not None:
+                        sampler.index_select(keep)
+                    if detector is not None:
+                        detector.index_select(keep)
+                    if session is not None:
+                        session.index_select(keep)
+                    for i in range(len(k_cache)):
+                        k_cache[i] = k_cache[i].index_select(0, keep)
+                        v_cache[i] = v_cache[i].index_select(0, keep)
 
             ####################### update next step ###################################
-            y_emb = self.ar_audio_embedding(y[:, -1:])
-            xy_pos = y_emb * self.ar_audio_position.x_scale + self.ar_audio_position.alpha * self.ar_audio_position.pe[
-                :, y_len + idx
-            ].to(dtype=y_emb.dtype, device=y_emb.device)
-
-        if None in idx_list:
-            for i in range(x.shape[0]):
-                if idx_list[i] is None:
-                    idx_list[i] = 1500 - 1  ###如果没有生成到EOS，就用最大长度代替
+            y_emb = self.ar_audio_embedding(tokens[:, cur_len : cur_len + 1])
+            if detector is not None:
+                # 回退过的序列位置编码按有效长度计算, 其余序列与 y_len + idx 相同
+                pe = self.ar_audio_position.pe[0].index_select(0, y_len + detector.length - 1).unsqueeze(1)
+            else:
+                pe = self.ar_audio_position.pe[:, y_len + idx]
+            xy_pos = y_emb * self.ar_audio_position.x_scale + self.ar_audio_position.alpha * pe.to(
+                dtype=y_emb.dtype, device=y_emb.device
+            )
+        pbar.close()
 
         if ref_free:
             return y_list, [0] * x.shape[0]
@@ -793,7 +887,13 @@ class Text2SemanticDecoder(nn.Module):
     ):
         y_list = []
         idx_list = []
+        runaway_events = []
+        runaway_action = kwargs.pop("runaway_action", None)
         for i in range(len(x)):
+            if runaway_action is not None and not isinstance(runaway_action, str):
+                kwargs["runaway_action"] = runaway_action[i]
+            elif runaway_action is not None:
+                kwargs["runaway_action"] = runaway_action
             y, idx = self.infer_panel_naive(
                 x[i].unsqueeze(0),
                 x_lens[i],
@@ -808,6 +908,8 @@ class Text2SemanticDecoder(nn.Module):
             )
             y_list.append(y[0])
             idx_list.append(idx)
+            runaway_events.extend(dict(event, index=i) for event in self.runaway_events)
+        self.runaway_events = runaway_events
 
         return y_list, idx_list
 
@@ -875,7 +977,23 @@ class Text2SemanticDecoder(nn.Module):
             .to(device=x.device, dtype=torch.bool)
         )
 
+        cancel_token = kwargs.get("cancel_token")
+        # 失控生成检测, 这里逐条解码, 回退时直接截断 y 与 KV cache
+        detector = None
+        if kwargs.get("runaway", RUNAWAY_ENABLED):
+            detector = RunawayDetector(
+                x_lens,
+                prefix_len,
+                self.vocab_size,
+                self.EOS,
+                prompt_phone_len=kwargs.get("prompt_phone_len"),
+                action=kwargs.get("runaway_action"),
+            )
+        self.runaway_events = detector.events if detector is not None else []
+        sync_interval = max(1, int(kwargs.get("sync_interval", T2S_SYNC_INTERVAL)))
         for idx in tqdm(range(1500)):
+            if cancel_token is not None and idx % T2S_CANCEL_INTERVAL == 0:
+                cancel_token.raise_if_cancelled("t2s", t2s_steps=1500 - idx)
             if xy_attn_mask is not None:
                 xy_dec, k_cache, v_cache = self.t2s_transformer.process_prompt(xy_pos, xy_attn_mask, None)
             else:
@@ -887,6 +1005,8 @@ class Text2SemanticDecoder(nn.Module):
                 xy_attn_mask = None
             if idx < 11:  ###至少预测出10个token不然不给停止（0.4s）
                 logits = logits[:, :-1]
+            if detector is not None:
+                detector.observe(logits)
 
             samples = sample(
                 logits, y, top_k=top_k, top_p=top_p, repetition_penalty=repetition_penalty, temperature=temperature
@@ -900,6 +1020,22 @@ class Text2SemanticDecoder(nn.Module):
 
             if torch.argmax(logits, dim=-1)[0] == self.EOS or samples[0, 0] == self.EOS:
                 stop = True
+            if detector is not None and not stop and (idx + 1) % sync_interval == 0:
+                cur_len = y.shape[1] - 1
+                for row, reason, first in detector.check(y, cur_len, torch.ones_like(detector.flagged)):
+                    action = detector.decide(row, 0, reason, first, idx)
+                    if action == "stop":
+                        # 末尾的 token 会被当作 EOS 丢弃, 重复时保留到片段第一次出现为止
+                        if reason == REPEAT:
+                            y = y[:, : first + RUNAWAY_NGRAM + 1]
+                        stop = True
+                    elif action == "resample":
+                        # 截断到片段开始之前, 重新输入 first - 1 列的 token
+                        y = y[:, :first]
+                        for i in range(len(k_cache)):
+                            k_cache[i] = k_cache[i][:, : x_len + first - 1]
+                            v_cache[i] = v_cache[i][:, : x_len + first - 1]
+                        detector.rollback(row, first - prefix_len, first - 1)
             if stop:
                 if y.shape[1] == 0:
                     y = torch.concat([y, torch.zeros_like(samples)], dim=1)
@@ -908,14 +1044,15 @@ class Text2SemanticDecoder(nn.Module):
                 break
 
             ####################### update next step ###################################
+            # 位置按已生成的 token 数计算, 未回退时等于 y_len + idx
             y_emb = self.ar_audio_embedding(y[:, -1:])
             xy_pos = y_emb * self.ar_audio_position.x_scale + self.ar_audio_position.alpha * self.ar_audio_position.pe[
-                :, y_len + idx
+                :, y_len + y.shape[1] - prefix_len - 1
             ].to(dtype=y_emb.dtype, device=y_emb.device)
 
         if ref_free:
             return y[:, :-1], 0
-        return y[:, :-1], idx
+        return y[:, :-1], y.shape[1] - prefix_len - 1
 
     def infer_panel(
         self,
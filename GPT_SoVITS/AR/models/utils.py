@@ -189,13 +189,86 @@ def logits_to_probs(
     return probs
 
 
+class SamplerState:
+    """
+    Per-sequence sampling state for step-by-step decoding.
+    Tokens seen so far (prompt included) are kept in a [B, vocab] presence bitmap that is updated
+    with each sampled token, so the repetition penalty costs O(vocab) per step instead of a
+    gather/scatter over the whole, growing history.
+    """
+
+    def __init__(self, previous_tokens: torch.Tensor, vocab_size: int):
+        self.presence = torch.zeros(
+            (previous_tokens.shape[0], vocab_size), dtype=torch.bool, device=previous_tokens.device
+        )
+        self.presence.scatter_(1, previous_tokens.long(), True)
+
+    def update(self, tokens: torch.Tensor):
+        """tokens: [B, 1] sampled this step"""
+        self.presence.scatter_(1, tokens.long().view(-1, 1), True)
+
+    def index_select(self, index: torch.Tensor):
+        """keep only the given sequences (after finished ones are removed from the batch)"""
+        self.presence = self.presence.index_select(0, index)
+
+
+def logits_to_probs_fused(
+    logits,
+    state: SamplerState,
+    temperature: float = 1.0,
+    top_k: Optional[int] = None,
+    top_p: Optional[int] = None,
+    repetition_penalty: float = 1.0,
+):
+    """
+    Same filtering as logits_to_probs, but the penalty comes from the presence bitmap and top-p only
+    sorts the top-k candidates (their cumulative probabilities are taken against the full softmax,
+    so the kept set is unchanged). Returns the candidate probs [B, k] and their token ids.
+    Like logits_to_probs, the penalty is applied to logits in place.
+    """
+    vocab_size = logits.size(-1)
+    if repetition_penalty != 1.0:
+        presence = state.presence[:, :vocab_size]
+        penalized = torch.where(logits < 0, logits * repetition_penalty, logits / repetition_penalty)
+        logits.copy_(torch.where(presence, penalized, logits))
+
+    k = min(top_k, vocab_size) if top_k is not None and top_k > 0 else vocab_size
+    # sorted descending, so top-p is a prefix of the candidates
+    values, indices = torch.topk(logits, k)
+
+    if top_p is not None and top_p < 1.0:
+        cum_probs = torch.cumsum(torch.exp(values - torch.logsumexp(logits, dim=-1, keepdim=True)), dim=-1)
+        to_remove = cum_probs > top_p
+        to_remove[:, 0] = False  # keep at least one option
+        values = values.masked_fill(to_remove, -float("Inf"))
+
+    values = values / max(temperature, 1e-5)
+    return torch.nn.functional.softmax(values, dim=-1), indices
+
+
 def sample(
     logits,
     previous_tokens: Optional[torch.Tensor] = None,
+    state: Optional[SamplerState] = None,
     **sampling_kwargs,
 ) -> Tuple[torch.Tensor, torch.Tensor]:
-    probs = logits_to_probs(logits=logits, previous_tokens=previous_tokens, **sampling_kwargs)
-    idx_next = multinomial_sample_one_no_sync(probs)
+    """
+    With state (a SamplerState) the fused sampler is used, previous_tokens is then ignored and the
+    state is updated with the sampled tokens. Returns the same (idx_next, probs) either way.
+    """
+    if state is None:
+        probs = logits_to_probs(logits=logits, previous_tokens=previous_tokens, **sampling_kwargs)
+        idx_next = multinomial_sample_one_no_sync(probs)
+        return idx_next, probs
+
+    cand_probs, cand_indices = logits_to_probs_fused(logits, state, **sampling_kwargs)
+    # draw the exponential noise over the full vocabulary, as multinomial_sample_one_no_sync does,
+    # so a given seed picks the same token as the unfused path
+    q = torch.empty_like(logits).exponential_(1).gather(1, cand_indices)
+    choice = torch.argmax(cand_probs / q, dim=-1, keepdim=True)
+    idx_next = cand_indices.gather(1, choice).to(dtype=torch.int)
+    state.update(idx_next)
+    probs = torch.zeros_like(logits).scatter_(1, cand_indices, cand_probs.to(logits.dtype))
     return idx_next, probs
 
 
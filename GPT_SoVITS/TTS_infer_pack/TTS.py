@@ -3,8 +3,11 @@ import math
 import os
 import random
 import sys
+import threading
 import time
 import traceback
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import nullcontext
 from copy import deepcopy
 
 import torchaudio
@@ -24,14 +27,16 @@ import yaml
 from AR.models.t2s_lightning_module import Text2SemanticLightningModule
 from BigVGAN.bigvgan import BigVGAN
 from feature_extractor.cnhubert import CNHubert
+from module.cfm_batching import CFMBatcher
 from module.mel_processing import mel_spectrogram_torch, spectrogram_torch
 from module.models import SynthesizerTrn, SynthesizerTrnV3, Generator
 from peft import LoraConfig, get_peft_model
 from process_ckpt import get_sovits_version_from_path_fast, load_sovits_new
 from transformers import AutoModelForMaskedLM, AutoTokenizer
 
-from tools.audio_sr import AP_BWE
+from tools.audio_sr import AP_BWE, AP_BWEStream
 from tools.i18n.i18n import I18nAuto, scan_language_list
+from TTS_infer_pack.cancellation import CancellationToken, RequestCancelled, cancellation_metrics
 from TTS_infer_pack.text_segmentation_method import splits
 from TTS_infer_pack.TextPreprocessor import TextPreprocessor
 from sv import SV
@@ -48,6 +53,19 @@ def resample(audio_tensor, sr0, sr1, device):
 
 
 language = os.environ.get("language", "Auto")
+# SoVITS (v1/v2/v2Pro) 各句 padding 后整批解码, 设为 0 时退回拼接成一句 / 逐句解码
+vits_batched_decode = os.environ.get("vits_batched_decode", "1") != "0"
+# 流式模式下单句分块解码的块长、两侧上下文 (覆盖 flow 与 Generator 的感受野) 与交叉淡化重叠, 单位为隐变量帧
+vits_stream_chunk = int(os.environ.get("vits_stream_chunk", 40))
+vits_stream_padding = int(os.environ.get("vits_stream_padding", 32))
+vits_stream_overlap = int(os.environ.get("vits_stream_overlap", 4))
+# v3/v4 流式模式下声码器每块前面拼接的 mel 上下文帧数
+vocoder_stream_context = int(os.environ.get("vocoder_stream_context", 32))
+# v3/v4 并发请求的 CFM 块交给同一个工作线程一起迭代, 需要调用方并发执行 run (见 tts_api 的 tts_max_concurrency);
+# 只在 GPU 上、并发请求较多时有收益, CPU 上没有, 默认关闭
+cfm_batching = os.environ.get("cfm_batching", "0") == "1"
+cfm_batch_size = int(os.environ.get("cfm_batch_size", 16))
+cfm_batch_wait_ms = float(os.environ.get("cfm_batch_wait_ms", 2))
 language = sys.argv[-1] if sys.argv[-1] in scan_language_list() else language
 i18n = I18nAuto(language=language)
 
@@ -440,6 +458,10 @@ class TTS:
             self.bert_model, self.bert_tokenizer, self.configs.device
         )
 
+        # 每个线程各自的请求状态 (cancel_token 与参考音频快照), 多个线程可以同时执行 run
+        self._run_state = threading.local()
+        # 设置参考音频/参考文本时持有, 设置完成后 run 取一份快照, 之后只读快照
+        self.prompt_lock = threading.RLock()
         self.prompt_cache: dict = {
             "ref_audio_path": None,
             "prompt_semantic": None,
@@ -452,8 +474,19 @@ class TTS:
             "aux_ref_audio_paths": [],
         }
 
-        self.stop_flag: bool = False
+        self.active_tokens = set()
+        self.active_tokens_lock = threading.Lock()
+        self.cfm_batcher: CFMBatcher = None
+        self.cfm_batcher_lock = threading.Lock()
         self.precision: torch.dtype = torch.float16 if self.configs.is_half else torch.float32
+        # 可选的辅助模型使用声明, 形如 model_guard(name) -> ContextManager, 由模型生命周期管理器提供
+        self.model_guard = None
+        self.text_preprocessor.model_guard = self._use_model
+
+    def _use_model(self, name: str):
+        if self.model_guard is None:
+            return nullcontext()
+        return self.model_guard(name)
 
     def _init_models(
         self,
@@ -472,6 +505,11 @@ class TTS:
         if self.configs.is_half and str(self.configs.device) != "cpu":
             self.cnhuhbert_model = self.cnhuhbert_model.half()
 
+    def unload_cnhuhbert_weights(self):
+        if self.cnhuhbert_model is not None:
+            self.cnhuhbert_model.cpu()
+            self.cnhuhbert_model = None
+
     def init_bert_weights(self, base_path: str):
         print(f"Loading BERT weights from {base_path}")
         self.bert_tokenizer = AutoTokenizer.from_pretrained(base_path)
@@ -480,6 +518,15 @@ class TTS:
         self.bert_model = self.bert_model.to(self.configs.device)
         if self.configs.is_half and str(self.configs.device) != "cpu":
             self.bert_model = self.bert_model.half()
+        if getattr(self, "text_preprocessor", None) is not None:
+            self.text_preprocessor.bert_model = self.bert_model
+            self.text_preprocessor.tokenizer = self.bert_tokenizer
+
+    def unload_bert_weights(self):
+        if self.bert_model is not None:
+            self.bert_model.cpu()
+            self.bert_model = None
+            self.text_preprocessor.bert_model = None
 
     def init_vits_weights(self, weights_path: str):
         self.configs.vits_weights_path = weights_path
@@ -597,6 +644,12 @@ class TTS:
         self.t2s_model = t2s_model
         if self.configs.is_half and str(self.configs.device) != "cpu":
             self.t2s_model = self.t2s_model.half()
+        if os.environ.get("t2s_compile", "0") == "1":
+            # 并行推理的逐 token 解码改用编译模式, 预热的 batch 大小由 t2s_compile_batch_sizes 指定 (逗号分隔)
+            batch_sizes = [int(i) for i in os.environ.get("t2s_compile_batch_sizes", "1,2,4,8").split(",") if i.strip()]
+            self.t2s_model.model.enable_compiled_decode(
+                mode=os.environ.get("t2s_compile_mode") or None, warmup_batch_sizes=batch_sizes
+            )
 
     def init_vocoder(self, version: str):
         if version == "v3":
@@ -669,11 +722,27 @@ class TTS:
             print(i18n("你没有下载超分模型的参数，因此不进行超分。如想超分请先参照教程把文件下载好"))
             self.sr_model_not_exist = True
 
+    def create_sr_stream(self, sr: int):
+        """分段返回时逐段超采样用的 AP_BWEStream, 超采样模型不存在时返回 None"""
+        with self._use_model("sr"):
+            self.init_sr_model()
+            if self.sr_model_not_exist:
+                return None
+            return self.sr_model.stream(sr)
+
+    def unload_sr_model(self):
+        if self.sr_model is not None:
+            self.sr_model.to("cpu")
+            self.sr_model = None
+
     def init_sv_model(self):
         if self.sv_model is not None:
             return
         self.sv_model = SV(self.configs.device, self.configs.is_half)
 
+    def unload_sv_model(self):
+        self.sv_model = None
+
     def enable_half_precision(self, enable: bool = True, save: bool = True):
         """
         To enable half precision for the TTS model.
@@ -741,9 +810,10 @@ class TTS:
         Args:
             ref_audio_path: str, the path of the reference audio.
         """
-        self._set_prompt_semantic(ref_audio_path)
-        self._set_ref_spec(ref_audio_path)
-        self._set_ref_audio_path(ref_audio_path)
+        with self.prompt_lock:
+            self._set_prompt_semantic(ref_audio_path)
+            self._set_ref_spec(ref_audio_path)
+            self._set_ref_audio_path(ref_audio_path)
 
     def _set_ref_audio_path(self, ref_audio_path):
         self.prompt_cache["ref_audio_path"] = ref_audio_path
@@ -810,9 +880,10 @@ class TTS:
                 zero_wav_torch = zero_wav_torch.half()
 
             wav16k = torch.cat([wav16k, zero_wav_torch])
-            hubert_feature = self.cnhuhbert_model.model(wav16k.unsqueeze(0))["last_hidden_state"].transpose(
-                1, 2
-            )  # .float()
+            with self._use_model("cnhubert"):
+                hubert_feature = self.cnhuhbert_model.model(wav16k.unsqueeze(0))["last_hidden_state"].transpose(
+                    1, 2
+                )  # .float()
             codes = self.vits_model.extract_latent(hubert_feature)
 
             prompt_semantic = codes[0, 0].to(self.configs.device)
@@ -978,7 +1049,46 @@ class TTS:
         """
         Stop the inference process.
         """
-        self.stop_flag = True
+        with self.active_tokens_lock:
+            tokens = list(self.active_tokens)
+        for token in tokens:
+            token.cancel("stop")
+
+    @property
+    def stop_flag(self) -> bool:
+        """当前线程的请求是否已被 stop() 或其他方式取消"""
+        token = self.cancel_token
+        return token is not None and token.cancelled
+
+    @property
+    def prompt_cache(self) -> dict:
+        """run 执行期间为本请求的参考音频快照, 其余时候为共享的缓存"""
+        snapshot = getattr(self._run_state, "prompt_cache", None)
+        return self._prompt_cache if snapshot is None else snapshot
+
+    @prompt_cache.setter
+    def prompt_cache(self, value: dict):
+        self._prompt_cache = value
+
+    def snapshot_prompt(self) -> dict:
+        """复制共享缓存, 之后其他请求更换参考音频或辅助参考音频不会影响这份快照"""
+        snapshot = dict(self._prompt_cache)
+        snapshot["refer_spec"] = list(snapshot["refer_spec"])
+        snapshot["aux_ref_audio_paths"] = list(snapshot["aux_ref_audio_paths"])
+        return snapshot
+
+    @property
+    def cancel_token(self) -> CancellationToken:
+        """当前线程正在执行的请求的取消令牌"""
+        return getattr(self._run_state, "cancel_token", None)
+
+    @cancel_token.setter
+    def cancel_token(self, token: CancellationToken):
+        self._run_state.cancel_token = token
+
+    def check_cancelled(self, stage: str, **skipped):
+        if self.cancel_token is not None:
+            self.cancel_token.raise_if_cancelled(stage, **skipped)
 
     @torch.no_grad()
     def run(self, inputs: dict):
@@ -1009,12 +1119,16 @@ class TTS:
                     "repetition_penalty": 1.35    # float. repetition penalty for T2S model.
                     "sample_steps": 32,           # int. number of sampling steps for VITS model V3.
                     "super_sampling": False,       # bool. whether to use super-sampling for audio when using VITS model V3.
+                    "streaming_mode": False,      # bool. return audio chunk by chunk within each sentence.
+                    "cancel_token": None,         # CancellationToken.(optional) abort the request once cancelled.
                 }
         returns:
             Tuple[int, np.ndarray]: sampling rate and audio data.
         """
         ########## variables initialization ###########
-        self.stop_flag: bool = False
+        self._run_state.prompt_cache = None
+        self.cancel_token = inputs.get("cancel_token") or CancellationToken()
+        cancellation_metrics.record_request()
         text: str = inputs.get("text", "")
         text_lang: str = inputs.get("text_lang", "")
         ref_audio_path: str = inputs.get("ref_audio_path", "")
@@ -1038,13 +1152,19 @@ class TTS:
         repetition_penalty = inputs.get("repetition_penalty", 1.35)
         sample_steps = inputs.get("sample_steps", 32)
         super_sampling = inputs.get("super_sampling", False)
+        streaming_mode = inputs.get("streaming_mode", False)
 
+        # 不改写模型上的 infer_panel, 并发的请求可以各自选择
         if parallel_infer:
             print(i18n("并行推理模式已开启"))
-            self.t2s_model.model.infer_panel = self.t2s_model.model.infer_panel_batch_infer
+            infer_panel = self.t2s_model.model.infer_panel_batch_infer
         else:
             print(i18n("并行推理模式已关闭"))
-            self.t2s_model.model.infer_panel = self.t2s_model.model.infer_panel_naive_batched
+            infer_panel = self.t2s_model.model.infer_panel_naive_batched
+
+        if streaming_mode and not return_fragment:
+            print("句内流式解码需要分段返回, 已自动开启分段返回")
+            return_fragment = True
 
         if return_fragment:
             print(i18n("分段返回模式已开启"))
@@ -1052,7 +1172,13 @@ class TTS:
                 split_bucket = False
                 print(i18n("分段返回模式不支持分桶处理，已自动关闭分桶处理"))
 
-        if split_bucket and speed_factor == 1.0 and not (self.configs.use_vocoder and parallel_infer):
+        # 整批解码时每句单独调整语速, 语速不再影响分桶
+        batched_speed = vits_batched_decode and not self.configs.use_vocoder
+        if (
+            split_bucket
+            and (speed_factor == 1.0 or batched_speed)
+            and not (self.configs.use_vocoder and parallel_infer)
+        ):
             print(i18n("分桶处理模式已开启"))
         elif speed_factor != 1.0:
             print(i18n("语速调节不支持分桶处理，已自动关闭分桶处理"))
@@ -1078,50 +1204,53 @@ class TTS:
         if no_prompt_text and self.configs.use_vocoder:
             raise NO_PROMPT_ERROR("prompt_text cannot be empty when using SoVITS_V3")
 
-        if ref_audio_path in [None, ""] and (
-            (self.prompt_cache["prompt_semantic"] is None) or (self.prompt_cache["refer_spec"] in [None, []])
-        ):
-            raise ValueError(
-                "ref_audio_path cannot be empty, when the reference audio is not set using set_ref_audio()"
-            )
-
-        ###### setting reference audio and prompt text preprocessing ########
-        t0 = time.perf_counter()
-        if (ref_audio_path is not None) and (
-            ref_audio_path != self.prompt_cache["ref_audio_path"]
-            or (self.is_v2pro and self.prompt_cache["refer_spec"][0][1] is None)
-        ):
-            if not os.path.exists(ref_audio_path):
-                raise ValueError(f"{ref_audio_path} not exists")
-            self.set_ref_audio(ref_audio_path)
-
-        aux_ref_audio_paths = aux_ref_audio_paths if aux_ref_audio_paths is not None else []
-        paths = set(aux_ref_audio_paths) & set(self.prompt_cache["aux_ref_audio_paths"])
-        if not (len(list(paths)) == len(aux_ref_audio_paths) == len(self.prompt_cache["aux_ref_audio_paths"])):
-            self.prompt_cache["aux_ref_audio_paths"] = aux_ref_audio_paths
-            self.prompt_cache["refer_spec"] = [self.prompt_cache["refer_spec"][0]]
-            for path in aux_ref_audio_paths:
-                if path in [None, ""]:
-                    continue
-                if not os.path.exists(path):
-                    print(i18n("音频文件不存在，跳过："), path)
-                    continue
-                self.prompt_cache["refer_spec"].append(self._get_ref_spec(path))
-
-        if not no_prompt_text:
-            prompt_text = prompt_text.strip("\n")
-            if prompt_text[-1] not in splits:
-                prompt_text += "。" if prompt_lang != "en" else "."
-            print(i18n("实际输入的参考文本:"), prompt_text)
-            if self.prompt_cache["prompt_text"] != prompt_text:
-                phones, bert_features, norm_text = self.text_preprocessor.segment_and_extract_feature_for_text(
-                    prompt_text, prompt_lang, self.configs.version
+        # 参考音频与参考文本的设置在锁内完成, 然后取快照: 并发请求更换参考音频不会改变本请求合成中途的音色
+        with self.prompt_lock:
+            if ref_audio_path in [None, ""] and (
+                (self.prompt_cache["prompt_semantic"] is None) or (self.prompt_cache["refer_spec"] in [None, []])
+            ):
+                raise ValueError(
+                    "ref_audio_path cannot be empty, when the reference audio is not set using set_ref_audio()"
                 )
-                self.prompt_cache["prompt_text"] = prompt_text
-                self.prompt_cache["prompt_lang"] = prompt_lang
-                self.prompt_cache["phones"] = phones
-                self.prompt_cache["bert_features"] = bert_features
-                self.prompt_cache["norm_text"] = norm_text
+
+            ###### setting reference audio and prompt text preprocessing ########
+            t0 = time.perf_counter()
+            if (ref_audio_path is not None) and (
+                ref_audio_path != self.prompt_cache["ref_audio_path"]
+                or (self.is_v2pro and self.prompt_cache["refer_spec"][0][1] is None)
+            ):
+                if not os.path.exists(ref_audio_path):
+                    raise ValueError(f"{ref_audio_path} not exists")
+                self.set_ref_audio(ref_audio_path)
+
+            aux_ref_audio_paths = aux_ref_audio_paths if aux_ref_audio_paths is not None else []
+            paths = set(aux_ref_audio_paths) & set(self.prompt_cache["aux_ref_audio_paths"])
+            if not (len(list(paths)) == len(aux_ref_audio_paths) == len(self.prompt_cache["aux_ref_audio_paths"])):
+                self.prompt_cache["aux_ref_audio_paths"] = aux_ref_audio_paths
+                self.prompt_cache["refer_spec"] = [self.prompt_cache["refer_spec"][0]]
+                for path in aux_ref_audio_paths:
+                    if path in [None, ""]:
+                        continue
+                    if not os.path.exists(path):
+                        print(i18n("音频文件不存在，跳过："), path)
+                        continue
+                    self.prompt_cache["refer_spec"].append(self._get_ref_spec(path))
+
+            if not no_prompt_text:
+                prompt_text = prompt_text.strip("\n")
+                if prompt_text[-1] not in splits:
+                    prompt_text += "。" if prompt_lang != "en" else "."
+                print(i18n("实际输入的参考文本:"), prompt_text)
+                if self.prompt_cache["prompt_text"] != prompt_text:
+                    phones, bert_features, norm_text = self.text_preprocessor.segment_and_extract_feature_for_text(
+                        prompt_text, prompt_lang, self.configs.version
+                    )
+                    self.prompt_cache["prompt_text"] = prompt_text
+                    self.prompt_cache["prompt_lang"] = prompt_lang
+                    self.prompt_cache["phones"] = phones
+                    self.prompt_cache["bert_features"] = bert_features
+                    self.prompt_cache["norm_text"] = norm_text
+            self._run_state.prompt_cache = self.snapshot_prompt()
 
         ###### text preprocessing ########
         t1 = time.perf_counter()
@@ -1180,6 +1309,10 @@ class TTS:
                 return batch[0]
 
         t2 = time.perf_counter()
+        batches_left = len(data)
+        # 在 try 之前登记, 保证 finally 中移除; stop() 取消所有登记的请求
+        with self.active_tokens_lock:
+            self.active_tokens.add(self.cancel_token)
         try:
             print("############ 推理 ############")
             ###### inference ######
@@ -1187,7 +1320,12 @@ class TTS:
             t_45 = 0.0
             audio = []
             output_sr = self.configs.sampling_rate if not self.configs.use_vocoder else self.vocoder_configs["sr"]
+            sr_stream = None
+            if return_fragment and super_sampling and self.configs.use_vocoder and self.configs.version == "v3":
+                sr_stream = self.create_sr_stream(output_sr)
             for item in data:
+                self.check_cancelled("batch", batches=batches_left)
+                batches_left -= 1
                 t3 = time.perf_counter()
                 if return_fragment:
                     item = make_batch(item)
@@ -1212,18 +1350,20 @@ class TTS:
                     )
 
                 print(f"############ {i18n('预测语义Token')} ############")
-                pred_semantic_list, idx_list = self.t2s_model.model.infer_panel(
+                pred_semantic_list, idx_list = infer_panel(
                     all_phoneme_ids,
                     all_phoneme_lens,
                     prompt,
                     all_bert_features,
                     # prompt_phone_len=ph_offset,
+                    prompt_phone_len=len(self.prompt_cache["phones"]) if not no_prompt_text else None,
                     top_k=top_k,
                     top_p=top_p,
                     temperature=temperature,
                     early_stop_num=self.configs.hz * self.configs.max_sec,
                     max_len=max_len,
                     repetition_penalty=repetition_penalty,
+                    cancel_token=self.cancel_token,
                 )
                 t4 = time.perf_counter()
                 t_34 += t4 - t3
@@ -1231,29 +1371,60 @@ class TTS:
                 refer_audio_spec = []
                 if self.is_v2pro:
                     sv_emb = []
-                for spec, audio_tensor in self.prompt_cache["refer_spec"]:
-                    spec = spec.to(dtype=self.precision, device=self.configs.device)
-                    refer_audio_spec.append(spec)
+                with self._use_model("sv") if self.is_v2pro else nullcontext():
+                    for spec, audio_tensor in self.prompt_cache["refer_spec"]:
+                        spec = spec.to(dtype=self.precision, device=self.configs.device)
+                        refer_audio_spec.append(spec)
                     if self.is_v2pro:
-                        sv_emb.append(self.sv_model.compute_embedding3(audio_tensor))
+                        # 多条参考音频一次批量提取说话人向量
+                        sv_emb = self.sv_model.compute_embedding3_batch(
+                            [audio_tensor for _, audio_tensor in self.prompt_cache["refer_spec"]]
+                        )
 
                 batch_audio_fragment = []
 
-                # ## vits并行推理 method 1
-                # pred_semantic_list = [item[-idx:] for item, idx in zip(pred_semantic_list, idx_list)]
-                # pred_semantic_len = torch.LongTensor([item.shape[0] for item in pred_semantic_list]).to(self.configs.device)
-                # pred_semantic = self.batch_sequences(pred_semantic_list, axis=0, pad_value=0).unsqueeze(0)
-                # max_len = 0
-                # for i in range(0, len(batch_phones)):
-                #     max_len = max(max_len, batch_phones[i].shape[-1])
-                # batch_phones = self.batch_sequences(batch_phones, axis=0, pad_value=0, max_length=max_len)
-                # batch_phones = batch_phones.to(self.configs.device)
-                # batch_audio_fragment = (self.vits_model.batched_decode(
-                #         pred_semantic, pred_semantic_len, batch_phones, batch_phones_len,refer_audio_spec
-                #     ))
                 print(f"############ {i18n('合成音频')} ############")
-                if not self.configs.use_vocoder:
-                    if speed_factor == 1.0:
+                if streaming_mode:
+                    # 逐句分块合成, 每块算完立即返回, 不经过 audio_postprocess
+                    for i, idx in enumerate(idx_list):
+                        self.check_cancelled("vits", sentences=len(idx_list) - i)
+                        phones = batch_phones[i].unsqueeze(0).to(self.configs.device)
+                        _pred_semantic = pred_semantic_list[i][-idx:].unsqueeze(0).unsqueeze(0)
+                        if self.configs.use_vocoder:
+                            chunks = self.using_vocoder_synthesis_stream(
+                                _pred_semantic, phones, speed=speed_factor, sample_steps=sample_steps
+                            )
+                        else:
+                            chunks = self.vits_stream_decode(
+                                _pred_semantic,
+                                phones,
+                                refer_audio_spec,
+                                speed_factor,
+                                sv_emb if self.is_v2pro else None,
+                            )
+                        for chunk in chunks:
+                            sr, chunk = self.stream_postprocess(chunk, output_sr, sr_stream)
+                            if len(chunk) > 0:
+                                yield sr, chunk
+                        silence = torch.zeros(
+                            int(output_sr * fragment_interval), dtype=self.precision, device=self.configs.device
+                        )
+                        sr, chunk = self.stream_postprocess(silence, output_sr, sr_stream)
+                        if len(chunk) > 0:
+                            yield sr, chunk
+                elif not self.configs.use_vocoder:
+                    if vits_batched_decode:
+                        print(f"{i18n('并行合成中')}...")
+                        # ## vits并行推理 method 1: 各句 padding 后整批解码, 句间互不可见, ge 只算一次
+                        batch_audio_fragment = self.vits_batched_decode(
+                            pred_semantic_list,
+                            idx_list,
+                            batch_phones,
+                            refer_audio_spec,
+                            speed_factor,
+                            sv_emb if self.is_v2pro else None,
+                        )
+                    elif speed_factor == 1.0:
                         print(f"{i18n('并行合成中')}...")
                         # ## vits并行推理 method 2
                         pred_semantic_list = [item[-idx:] for item, idx in zip(pred_semantic_list, idx_list)]
@@ -1283,6 +1454,7 @@ class TTS:
                     else:
                         # ## vits串行推理
                         for i, idx in enumerate(tqdm(idx_list)):
+                            self.check_cancelled("vits", sentences=len(idx_list) - i)
                             phones = batch_phones[i].unsqueeze(0).to(self.configs.device)
                             _pred_semantic = (
                                 pred_semantic_list[i][-idx:].unsqueeze(0).unsqueeze(0)
@@ -1305,6 +1477,7 @@ class TTS:
                         batch_audio_fragment.extend(audio_fragments)
                     else:
                         for i, idx in enumerate(tqdm(idx_list)):
+                            self.check_cancelled("vits", sentences=len(idx_list) - i)
                             phones = batch_phones[i].unsqueeze(0).to(self.configs.device)
                             _pred_semantic = (
                                 pred_semantic_list[i][-idx:].unsqueeze(0).unsqueeze(0)
@@ -1316,9 +1489,11 @@ class TTS:
 
                 t5 = time.perf_counter()
                 t_45 += t5 - t4
-                if return_fragment:
+                if streaming_mode:
+                    print("%.3f\t%.3f\t%.3f\t%.3f" % (t1 - t0, t2 - t1, t4 - t3, t5 - t4))
+                elif return_fragment:
                     print("%.3f\t%.3f\t%.3f\t%.3f" % (t1 - t0, t2 - t1, t4 - t3, t5 - t4))
-                    yield self.audio_postprocess(
+                    sr, fragment = self.audio_postprocess(
                         [batch_audio_fragment],
                         output_sr,
                         None,
@@ -1326,7 +1501,11 @@ class TTS:
                         False,
                         fragment_interval,
                         super_sampling if self.configs.use_vocoder and self.configs.version == "v3" else False,
+                        sr_stream,
                     )
+                    # 流式超采样的预读窗口还没填满时 push 不返回音频, 不向客户端发送空片段
+                    if len(fragment) > 0:
+                        yield sr, fragment
                 else:
                     audio.append(batch_audio_fragment)
 
@@ -1334,6 +1513,16 @@ class TTS:
                     yield 16000, np.zeros(int(16000), dtype=np.int16)
                     return
 
+            if sr_stream is not None:
+                # 取出超采样预读窗口里剩下的音频
+                with self._use_model("sr"):
+                    audio_tail = sr_stream.flush()
+                if len(audio_tail) > 0:
+                    max_audio = np.abs(audio_tail).max()
+                    if max_audio > 1:
+                        audio_tail /= max_audio
+                    yield sr_stream.sr, (audio_tail * 32768).astype(np.int16)
+
             if not return_fragment:
                 print("%.3f\t%.3f\t%.3f\t%.3f" % (t1 - t0, t2 - t1, t_34, t_45))
                 if len(audio) == 0:
@@ -1349,21 +1538,100 @@ class TTS:
                     super_sampling if self.configs.use_vocoder and self.configs.version == "v3" else False,
                 )
 
+        except RequestCancelled as e:
+            e.skipped.setdefault("batches", batches_left)
+            cancellation_metrics.record_cancel(self.cancel_token, e)
+            print("请求已取消 (%s), 阶段: %s, 跳过: %s" % (e.reason, e.stage, e.skipped))
+            yield 16000, np.zeros(int(16000), dtype=np.int16)
         except Exception as e:
             traceback.print_exc()
             # 必须返回一个空音频, 否则会导致显存不释放。
             yield 16000, np.zeros(int(16000), dtype=np.int16)
-            # 重置模型, 否则会导致显存释放不完全。
-            del self.t2s_model
-            del self.vits_model
-            self.t2s_model = None
-            self.vits_model = None
-            self.init_t2s_weights(self.configs.t2s_weights_path)
-            self.init_vits_weights(self.configs.vits_weights_path)
+            # 重置模型, 否则会导致显存释放不完全。其他请求仍在使用模型时不重置, 以免中断它们
+            with self.active_tokens_lock:
+                others = len(self.active_tokens - {self.cancel_token})
+            if others == 0:
+                del self.t2s_model
+                del self.vits_model
+                self.t2s_model = None
+                self.vits_model = None
+                self.init_t2s_weights(self.configs.t2s_weights_path)
+                self.init_vits_weights(self.configs.vits_weights_path)
             raise e
         finally:
+            with self.active_tokens_lock:
+                self.active_tokens.discard(self.cancel_token)
+            self._run_state.prompt_cache = None
             self.empty_cache()
 
+    def stream_postprocess(
+        self, audio: torch.Tensor, sr: int, sr_stream: AP_BWEStream = None
+    ) -> Tuple[int, np.ndarray]:
+        """流式模式的单块后处理: 有超采样流时逐块超采样, 截断到 [-1, 1] 后转为 int16"""
+        if sr_stream is not None:
+            with self._use_model("sr"):
+                self.init_sr_model()
+                sr_stream.bwe = self.sr_model
+                audio, sr = sr_stream.push(audio), sr_stream.sr
+        else:
+            audio = audio.float().cpu().numpy()
+        return sr, (np.clip(audio, -1, 1) * 32767).astype(np.int16)
+
+    def vits_stream_decode(
+        self,
+        semantic_tokens: torch.Tensor,
+        phones: torch.Tensor,
+        refer_audio_spec: List[torch.Tensor],
+        speed: float = 1.0,
+        sv_emb: List[torch.Tensor] = None,
+    ):
+        """
+        单句分块解码, 每块算完立即产出, 首包延迟取决于块长而不是句长.
+        相邻两块重叠 vits_stream_overlap 帧, 用 sola_algorithm 交叉淡化; 每块末尾的重叠部分留到下一块处理.
+        """
+        overlap_len = vits_stream_overlap * math.prod(self.vits_model.upsample_rates)
+        tail = None
+        for fragment in self.vits_model.decode_streaming(
+            semantic_tokens,
+            phones,
+            refer_audio_spec,
+            speed=speed,
+            sv_emb=sv_emb,
+            chunk_size=vits_stream_chunk,
+            overlap=vits_stream_overlap,
+            padding=vits_stream_padding,
+        ):
+            if tail is not None:
+                fragments = [tail, fragment]
+                self.sola_algorithm(fragments, overlap_len)
+                yield fragments[0]
+                fragment = fragments[1]
+            tail = fragment[-overlap_len:]
+            yield fragment[:-overlap_len]
+            self.check_cancelled("vits")
+        if tail is not None:
+            yield tail
+
+    def vits_batched_decode(
+        self,
+        pred_semantic_list: List[torch.Tensor],
+        idx_list: List[int],
+        batch_phones: List[torch.Tensor],
+        refer_audio_spec: List[torch.Tensor],
+        speed: Union[float, List[float]] = 1.0,
+        sv_emb: List[torch.Tensor] = None,
+    ) -> List[torch.Tensor]:
+        """一个 batch 的各句 padding 后一次解码, 返回与输入同序的音频列表, 语速可每句不同"""
+        semantic = [item[-idx:] for item, idx in zip(pred_semantic_list, idx_list)]
+        codes_lengths = torch.LongTensor([item.shape[0] for item in semantic]).to(self.configs.device)
+        codes = self.batch_sequences(semantic, axis=0, pad_value=0).unsqueeze(0).to(self.configs.device)
+        text_lengths = torch.LongTensor([item.shape[-1] for item in batch_phones]).to(self.configs.device)
+        text = self.batch_sequences(batch_phones, axis=0, pad_value=0).to(self.configs.device)
+        audio_fragments = self.vits_model.batched_decode(
+            codes, codes_lengths, text, text_lengths, refer_audio_spec, speed=speed, sv_emb=sv_emb
+        )
+        return [audio_fragment.detach() for audio_fragment in audio_fragments]
+
     def empty_cache(self):
         try:
             gc.collect()  # 触发gc的垃圾回收。避免内存一直增长。
@@ -1383,6 +1651,7 @@ class TTS:
         split_bucket: bool = True,
         fragment_interval: float = 0.3,
         super_sampling: bool = False,
+        sr_stream: AP_BWEStream = None,
     ) -> Tuple[int, np.ndarray]:
         zero_wav = torch.zeros(
             int(self.configs.sampling_rate * fragment_interval), dtype=self.precision, device=self.configs.device
@@ -1407,12 +1676,18 @@ class TTS:
         if super_sampling:
             print(f"############ {i18n('音频超采样')} ############")
             t1 = time.perf_counter()
-            self.init_sr_model()
-            if not self.sr_model_not_exist:
-                audio, sr = self.sr_model(audio.unsqueeze(0), sr)
-                max_audio = np.abs(audio).max()
-                if max_audio > 1:
-                    audio /= max_audio
+            with self._use_model("sr"):
+                self.init_sr_model()
+                if not self.sr_model_not_exist and sr_stream is not None:
+                    # 逐段超采样, 只返回已确定的部分, 其余留到下一段或 flush
+                    sr_stream.bwe = self.sr_model
+                    audio, sr = sr_stream.push(audio), sr_stream.sr
+                elif not self.sr_model_not_exist:
+                    audio, sr = self.sr_model(audio.unsqueeze(0), sr)
+                if not self.sr_model_not_exist and len(audio) > 0:
+                    max_audio = np.abs(audio).max()
+                    if max_audio > 1:
+                        audio /= max_audio
             t2 = time.perf_counter()
             print(f"超采样用时：{t2 - t1:.3f}s")
         else:
@@ -1428,9 +1703,11 @@ class TTS:
 
         return sr, audio
 
-    def using_vocoder_synthesis(
-        self, semantic_tokens: torch.Tensor, phones: torch.Tensor, speed: float = 1.0, sample_steps: int = 32
-    ):
+    def vocoder_prompt(self):
+        """
+        v3/v4 合成用的参考部分, 返回 (fea_ref, ge, mel2, T_min, chunk_len, refer_audio_spec):
+        参考音频的特征与归一化 mel (截到 T_ref 帧), 以及每个 CFM 块可容纳的目标帧数
+        """
         prompt_semantic_tokens = self.prompt_cache["prompt_semantic"].unsqueeze(0).unsqueeze(0).to(self.configs.device)
         prompt_phones = torch.LongTensor(self.prompt_cache["phones"]).unsqueeze(0).to(self.configs.device)
         raw_entry = self.prompt_cache["refer_spec"][0]
@@ -1464,26 +1741,59 @@ class TTS:
         chunk_len = T_chunk - T_min
 
         mel2 = mel2.to(self.precision)
-        fea_todo, ge = self.vits_model.decode_encp(semantic_tokens, phones, refer_audio_spec, ge, speed)
-
-        cfm_resss = []
+        return fea_ref, ge, mel2, T_min, chunk_len, refer_audio_spec
+
+    def get_cfm_batcher(self) -> CFMBatcher:
+        """当前 CFM 对应的批处理服务, 重新加载 SoVITS 权重后换成新模型的"""
+        cfm = self.vits_model.cfm
+        with self.cfm_batcher_lock:
+            if self.cfm_batcher is None or self.cfm_batcher.cfm is not cfm:
+                if self.cfm_batcher is not None:
+                    self.cfm_batcher.close()
+                self.cfm_batcher = CFMBatcher(cfm, cfm_batch_size, cfm_batch_wait_ms)
+            return self.cfm_batcher
+
+    def cfm_inference(self, fea: torch.Tensor, mel2: torch.Tensor, sample_steps: int) -> torch.Tensor:
+        """CFM 推理; 开启 cfm_batching 时与其他请求的块一起迭代, 等待期间请求被取消则放弃这些块"""
+        if not cfm_batching:
+            return self.vits_model.cfm.inference(
+                fea, torch.LongTensor([fea.size(1)]).to(fea.device), mel2, sample_steps, inference_cfg_rate=0
+            )
+        future = self.get_cfm_batcher().submit(fea, mel2, sample_steps)
+        while True:
+            try:
+                return future.result(timeout=0.05)
+            except FutureTimeoutError:
+                if self.cancel_token is not None and self.cancel_token.cancelled:
+                    future.cancel()
+                    self.check_cancelled("cfm")
+
+    def cfm_chunks(self, fea_todo, fea_ref, mel2, T_min: int, chunk_len: int, sample_steps: int = 32):
+        """逐块 CFM 推理, 每块以上一块的末尾作为参考, 依次产出归一化的 mel [1, mel_dim, T]"""
         idx = 0
         while 1:
             fea_todo_chunk = fea_todo[:, :, idx : idx + chunk_len]
             if fea_todo_chunk.shape[-1] == 0:
                 break
+            self.check_cancelled("cfm", cfm_chunks=math.ceil((fea_todo.shape[-1] - idx) / chunk_len))
             idx += chunk_len
             fea = torch.cat([fea_ref, fea_todo_chunk], 2).transpose(2, 1)
 
-            cfm_res = self.vits_model.cfm.inference(
-                fea, torch.LongTensor([fea.size(1)]).to(fea.device), mel2, sample_steps, inference_cfg_rate=0
-            )
+            cfm_res = self.cfm_inference(fea, mel2, sample_steps)
             cfm_res = cfm_res[:, :, mel2.shape[2] :]
 
             mel2 = cfm_res[:, :, -T_min:]
             fea_ref = fea_todo_chunk[:, :, -T_min:]
 
-            cfm_resss.append(cfm_res)
+            yield cfm_res
+
+    def using_vocoder_synthesis(
+        self, semantic_tokens: torch.Tensor, phones: torch.Tensor, speed: float = 1.0, sample_steps: int = 32
+    ):
+        fea_ref, ge, mel2, T_min, chunk_len, refer_audio_spec = self.vocoder_prompt()
+        fea_todo, ge = self.vits_model.decode_encp(semantic_tokens, phones, refer_audio_spec, ge, speed)
+
+        cfm_resss = list(self.cfm_chunks(fea_todo, fea_ref, mel2, T_min, chunk_len, sample_steps))
         cfm_res = torch.cat(cfm_resss, 2)
         cfm_res = denorm_spec(cfm_res)
 
@@ -1493,6 +1803,41 @@ class TTS:
 
         return audio
 
+    def using_vocoder_synthesis_stream(
+        self, semantic_tokens: torch.Tensor, phones: torch.Tensor, speed: float = 1.0, sample_steps: int = 32
+    ):
+        """
+        流式版 using_vocoder_synthesis: 每个 CFM 块一算完就送进声码器, 不必等整句的 mel.
+        声码器输入前面拼上已有 mel 的末尾 vocoder_stream_context + overlapped_len 帧作为上下文, 上下文部分的音频丢弃;
+        每块末尾 overlapped_len 帧缺少右侧上下文, 先留着, 与下一块中同一段 (此时有了右侧上下文) 用 sola_algorithm 交叉淡化.
+        """
+        fea_ref, ge, mel2, T_min, chunk_len, refer_audio_spec = self.vocoder_prompt()
+        fea_todo, ge = self.vits_model.decode_encp(semantic_tokens, phones, refer_audio_spec, ge, speed)
+
+        upsample_rate = self.vocoder_configs["upsample_rate"]
+        overlap = self.vocoder_configs["overlapped_len"]
+        overlap_len = overlap * upsample_rate
+        history = None
+        tail = None
+        for cfm_res in self.cfm_chunks(fea_todo, fea_ref, mel2, T_min, chunk_len, sample_steps):
+            mel = denorm_spec(cfm_res)
+            if history is None:
+                window, skip = mel, 0
+            else:
+                window, skip = torch.cat([history, mel], 2), history.shape[2] - overlap
+            history = window[:, :, -(vocoder_stream_context + overlap) :]
+            with torch.inference_mode():
+                fragment = self.vocoder(window)[0][0][skip * upsample_rate :]
+            if tail is not None:
+                fragments = [tail, fragment]
+                self.sola_algorithm(fragments, overlap_len)
+                yield fragments[0]
+                fragment = fragments[1]
+            tail = fragment[-overlap_len:]
+            yield fragment[:-overlap_len]
+        if tail is not None:
+            yield tail
+
     def using_vocoder_synthesis_batched_infer(
         self,
         idx_list: List[int],
@@ -1501,39 +1846,7 @@ class TTS:
         speed: float = 1.0,
         sample_steps: int = 32,
     ) -> List[torch.Tensor]:
-        prompt_semantic_tokens = self.prompt_cache["prompt_semantic"].unsqueeze(0).unsqueeze(0).to(self.configs.device)
-        prompt_phones = torch.LongTensor(self.prompt_cache["phones"]).unsqueeze(0).to(self.configs.device)
-        raw_entry = self.prompt_cache["refer_spec"][0]
-        if isinstance(raw_entry, tuple):
-            raw_entry = raw_entry[0]
-        refer_audio_spec = raw_entry.to(dtype=self.precision, device=self.configs.device)
-
-        fea_ref, ge = self.vits_model.decode_encp(prompt_semantic_tokens, prompt_phones, refer_audio_spec)
-        ref_audio: torch.Tensor = self.prompt_cache["raw_audio"]
-        ref_sr = self.prompt_cache["raw_sr"]
-        ref_audio = ref_audio.to(self.configs.device).float()
-        if ref_audio.shape[0] == 2:
-            ref_audio = ref_audio.mean(0).unsqueeze(0)
-
-        # tgt_sr = self.vocoder_configs["sr"]
-        tgt_sr = 24000 if self.configs.version == "v3" else 32000
-        if ref_sr != tgt_sr:
-            ref_audio = resample(ref_audio, ref_sr, tgt_sr, self.configs.device)
-
-        mel2 = mel_fn(ref_audio) if self.configs.version == "v3" else mel_fn_v4(ref_audio)
-        mel2 = norm_spec(mel2)
-        T_min = min(mel2.shape[2], fea_ref.shape[2])
-        mel2 = mel2[:, :, :T_min]
-        fea_ref = fea_ref[:, :, :T_min]
-        T_ref = self.vocoder_configs["T_ref"]
-        T_chunk = self.vocoder_configs["T_chunk"]
-        if T_min > T_ref:
-            mel2 = mel2[:, :, -T_ref:]
-            fea_ref = fea_ref[:, :, -T_ref:]
-            T_min = T_ref
-        chunk_len = T_chunk - T_min
-
-        mel2 = mel2.to(self.precision)
+        fea_ref, ge, mel2, T_min, chunk_len, refer_audio_spec = self.vocoder_prompt()
 
         # #### batched inference
         overlapped_len = self.vocoder_configs["overlapped_len"]
@@ -1572,11 +1885,10 @@ class TTS:
 
         feat_chunks = torch.cat(feat_chunks, 0)
         bs = feat_chunks.shape[0]
+        self.check_cancelled("cfm", cfm_chunks=bs)
         fea_ref = fea_ref.repeat(bs, 1, 1)
         fea = torch.cat([fea_ref, feat_chunks], 2).transpose(2, 1)
-        pred_spec = self.vits_model.cfm.inference(
-            fea, torch.LongTensor([fea.size(1)]).to(fea.device), mel2, sample_steps, inference_cfg_rate=0
-        )
+        pred_spec = self.cfm_inference(fea, mel2, sample_steps)
         pred_spec = pred_spec[:, :, -chunk_len:]
         dd = pred_spec.shape[1]
         pred_spec = pred_spec.permute(1, 0, 2).contiguous().view(dd, -1).unsqueeze(0)
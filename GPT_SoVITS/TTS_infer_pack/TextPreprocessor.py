@@ -1,6 +1,7 @@
 import os
 import sys
 import threading
+from contextlib import nullcontext
 
 from tqdm import tqdm
 
@@ -55,6 +56,8 @@ class TextPreprocessor:
         self.tokenizer = tokenizer
         self.device = device
         self.bert_lock = threading.RLock()
+        # 可选的模型使用声明 model_guard(name) -> ContextManager, 未加载的BERT会在其中按需重新加载
+        self.model_guard = None
 
     def preprocess(self, text: str, lang: str, text_split_method: str, version: str = "v2") -> List[Dict]:
         print(f"############ {i18n('切分文本')} ############")
@@ -189,7 +192,8 @@ class TextPreprocessor:
             return phones, bert, norm_text
 
     def get_bert_feature(self, text: str, word2ph: list) -> torch.Tensor:
-        with torch.no_grad():
+        guard = self.model_guard("bert") if self.model_guard is not None else nullcontext()
+        with guard, torch.no_grad():
             inputs = self.tokenizer(text, return_tensors="pt")
             for i in inputs:
                 inputs[i] = inputs[i].to(self.device)
@@ -0,0 +1,129 @@
+"""
+请求级取消
+
+TTS.stop() 只设置 stop_flag, run 在 T2S 与 VITS 都跑完一个 batch 后才检查, 客户端重新生成或关掉页面时
+服务器仍要把整段回复合成完. 这里给每个请求一个 CancellationToken:
+- HTTP 处理函数在客户端断开、同一条消息重新生成或调用 /tts/cancel 时执行 token.cancel()
+- T2S 自回归解码每 t2s_cancel_interval 个 token、VITS 逐句解码与 CFM 分块之间、每个文本 batch 开始时
+  调用 token.raise_if_cancelled(), 已取消时抛出 RequestCancelled
+- TTS.run 捕获后记录到 cancellation_metrics: 取消的请求数、发生阶段、跳过的工作量、从取消到停止的延迟
+"""
+
+import threading
+import time
+from typing import Dict, Optional
+
+
+class RequestCancelled(Exception):
+    def __init__(self, reason: str, stage: str, skipped: Optional[dict] = None):
+        super().__init__("request cancelled (%s) during %s" % (reason, stage))
+        self.reason = reason
+        self.stage = stage
+        # 因取消而跳过的工作量, 如 {"t2s_steps": 800, "sentences": 3, "batches": 2}, t2s_steps 为上限估计
+        self.skipped = dict(skipped or {})
+
+
+class CancellationToken:
+    def __init__(self, request_id: Optional[str] = None):
+        self.request_id = request_id
+        self.reason: Optional[str] = None
+        self.created_at = time.perf_counter()
+        self.cancelled_at: Optional[float] = None
+        self._event = threading.Event()
+
+    def cancel(self, reason: str = "cancelled"):
+        if not self._event.is_set():
+            self.reason = reason
+            self.cancelled_at = time.perf_counter()
+            self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._event.wait(timeout)
+
+    def raise_if_cancelled(self, stage: str, **skipped):
+        if self._event.is_set():
+            raise RequestCancelled(self.reason, stage, skipped)
+
+
+class CancellationMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.cancelled = 0
+        self.by_stage: Dict[str, int] = {}
+        self.by_reason: Dict[str, int] = {}
+        self.skipped: Dict[str, int] = {}
+        self.compute_seconds_before_cancel = 0.0
+        self.cancel_latency_total = 0.0
+        self.cancel_latency_max = 0.0
+
+    def record_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def record_cancel(self, token: CancellationToken, error: RequestCancelled):
+        now = time.perf_counter()
+        latency = now - token.cancelled_at if token.cancelled_at is not None else 0.0
+        with self.lock:
+            self.cancelled += 1
+            self.by_stage[error.stage] = self.by_stage.get(error.stage, 0) + 1
+            self.by_reason[error.reason] = self.by_reason.get(error.reason, 0) + 1
+            for key, value in error.skipped.items():
+                self.skipped[key] = self.skipped.get(key, 0) + int(value)
+            self.compute_seconds_before_cancel += now - token.created_at
+            self.cancel_latency_total += latency
+            self.cancel_latency_max = max(self.cancel_latency_max, latency)
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "cancelled": self.cancelled,
+                "by_stage": dict(self.by_stage),
+                "by_reason": dict(self.by_reason),
+                "skipped": dict(self.skipped),
+                "compute_seconds_before_cancel": round(self.compute_seconds_before_cancel, 3),
+                "cancel_latency_avg": round(self.cancel_latency_total / self.cancelled, 3) if self.cancelled else 0.0,
+                "cancel_latency_max": round(self.cancel_latency_max, 3),
+            }
+
+
+class CancellationRegistry:
+    """按 key 登记进行中的请求, 同一 key 的新请求会取消旧请求 (如同一条消息重新生成)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens: Dict[str, CancellationToken] = {}
+
+    def start(self, key: str) -> CancellationToken:
+        token = CancellationToken(key)
+        with self.lock:
+            previous = self.tokens.get(key)
+            self.tokens[key] = token
+        if previous is not None:
+            previous.cancel("superseded")
+        return token
+
+    def finish(self, key: str, token: CancellationToken):
+        with self.lock:
+            if self.tokens.get(key) is token:
+                del self.tokens[key]
+
+    def cancel(self, key: Optional[str] = None, reason: str = "cancelled") -> int:
+        """取消 key 对应的请求, key 为 None 时取消全部, 返回取消的数量"""
+        with self.lock:
+            if key is None:
+                tokens = list(self.tokens.values())
+            else:
+                tokens = [self.tokens[key]] if key in self.tokens else []
+        for token in tokens:
+            token.cancel(reason)
+        return len(tokens)
+
+
+cancellation_metrics = CancellationMetrics()
+cancellation_registry = CancellationRegistry()
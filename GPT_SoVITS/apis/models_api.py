@@ -6,6 +6,7 @@
 import json
 from typing import List
 from fastapi import APIRouter, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 
 # Pydantic模型
@@ -14,8 +15,8 @@ class SoVITSModelInfo(BaseModel):
     path: str
     is_current: bool
 
-def create_models_router(app_state, SoVITS_names, name2sovits_path, tts_pipeline, get_sovits_version_from_path_fast, dict_language_v1, dict_language_v2):
-    """创建模型管理路由器"""
+def create_models_router(app_state, SoVITS_names, name2sovits_path, tts_pipeline, get_sovits_version_from_path_fast, dict_language_v1, dict_language_v2, tts_gate):
+    """创建模型管理路由器, tts_gate 与 TTS 路由共用 (见 tts_api.TTSGate)"""
     router = APIRouter(prefix="/models", tags=["models"])
     
     @router.get("/sovits", response_model=List[SoVITSModelInfo])
@@ -30,6 +31,31 @@ def create_models_router(app_state, SoVITS_names, name2sovits_path, tts_pipeline
             ))
         return models
 
+    def switch_sovits_model(model_name: str):
+        """在 tts_gate 内切换权重: 等进行中的推理结束, 切换期间新的推理排队"""
+        # 更新模型路径
+        sovits_path = model_name
+        if "！" in sovits_path or "!" in sovits_path:
+            sovits_path = name2sovits_path[sovits_path]
+
+        # 获取模型版本信息
+        version, model_version, if_lora_v3 = get_sovits_version_from_path_fast(sovits_path)
+
+        with tts_gate.exclusive():
+            # 更新语言字典
+            app_state.dict_language = dict_language_v1 if version == "v1" else dict_language_v2
+
+            # 加载模型
+            tts_pipeline.init_vits_weights(sovits_path)
+            app_state.current_sovits_model = model_name
+
+        # 保存到配置文件
+        with open("./weight.json", "r") as f:
+            data = json.loads(f.read())
+            data["SoVITS"][version] = sovits_path
+        with open("./weight.json", "w") as f:
+            f.write(json.dumps(data))
+
     @router.post("/sovits/set")
     async def set_sovits_model(model_name: str):
         """设置当前SoVITS模型"""
@@ -37,28 +63,8 @@ def create_models_router(app_state, SoVITS_names, name2sovits_path, tts_pipeline
             raise HTTPException(status_code=404, detail="Model not found")
         
         try:
-            # 更新模型路径
-            sovits_path = model_name
-            if "！" in sovits_path or "!" in sovits_path:
-                sovits_path = name2sovits_path[sovits_path]
-            
-            # 获取模型版本信息
-            version, model_version, if_lora_v3 = get_sovits_version_from_path_fast(sovits_path)
-            
-            # 更新语言字典
-            app_state.dict_language = dict_language_v1 if version == "v1" else dict_language_v2
-            
-            # 加载模型
-            tts_pipeline.init_vits_weights(sovits_path)
-            app_state.current_sovits_model = model_name
-            
-            # 保存到配置文件
-            with open("./weight.json", "r") as f:
-                data = json.loads(f.read())
-                data["SoVITS"][version] = sovits_path
-            with open("./weight.json", "w") as f:
-                f.write(json.dumps(data))
-            
+            # 加载权重较慢, 放到线程池中, 不阻塞事件循环
+            await run_in_threadpool(switch_sovits_model, model_name)
             return {"message": "Model set successfully", "model": model_name}
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to set model: {str(e)}")
@@ -5,7 +5,7 @@
 
 from fastapi import APIRouter
 
-def create_status_router(app_state, device, version, model_version, temp_dir):
+def create_status_router(app_state, device, version, model_version, temp_dir, model_lifecycle=None):
     """创建状态查询路由器"""
     router = APIRouter(prefix="/status", tags=["status"])
     
@@ -20,6 +20,7 @@ def create_status_router(app_state, device, version, model_version, temp_dir):
             "version": version,
             "model_version": model_version,
             "temp_dir": temp_dir,
+            "model_lifecycle": model_lifecycle.status() if model_lifecycle is not None else None,
         }
     
     return router 
\ No newline at end of file
@@ -6,27 +6,137 @@ TTS API
 import os
 import time
 import random
+import asyncio
 import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Optional
 import soundfile as sf
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import FileResponse
 from pydantic import BaseModel
+from TTS_infer_pack.cancellation import CancellationToken, cancellation_metrics, cancellation_registry
+
+# 同时执行推理的请求数; v3/v4 开启 cfm_batching 时调大, 并发请求的 CFM 块才能合并成一个 batch
+TTS_MAX_CONCURRENCY = max(1, int(os.environ.get("tts_max_concurrency", 1)))
 
 # Pydantic模型
 class TTSRequest(BaseModel):
     text: str
+    request_id: Optional[str] = None
 
 class ConversationTTSRequest(BaseModel):
     text: str
     conversation_id: str
     message_id: str
 
-def create_tts_router(app_state, tts_pipeline, cut_method, temp_dir):
+class CancelTTSRequest(BaseModel):
+    request_id: Optional[str] = None
+    conversation_id: Optional[str] = None
+    message_id: Optional[str] = None
+
+class TTSGate:
+    """推理与切换权重共用的闸门: 推理最多 n 个同时进行; 切换权重时占满全部名额, 等进行中的推理结束后再换"""
+
+    def __init__(self, n: int = TTS_MAX_CONCURRENCY):
+        self.n = n
+        self.semaphore = threading.Semaphore(n)
+        # 两个切换各占一部分名额会互相等待, 切换之间先串行
+        self.switch_lock = threading.Lock()
+
+    def acquire(self, timeout: float) -> bool:
+        if self.switch_lock.locked():
+            # 有切换在等名额时新的推理先让出, 否则请求不断时切换一直等不到
+            time.sleep(timeout)
+            return False
+        return self.semaphore.acquire(timeout=timeout)
+
+    def release(self):
+        self.semaphore.release()
+
+    @contextmanager
+    def exclusive(self):
+        with self.switch_lock:
+            acquired = 0
+            try:
+                for _ in range(self.n):
+                    self.semaphore.acquire()
+                    acquired += 1
+                yield
+            finally:
+                for _ in range(acquired):
+                    self.semaphore.release()
+
+async def watch_disconnect(http_request: Request, token: CancellationToken, interval: float = 0.5):
+    """客户端断开连接时取消推理"""
+    while not token.cancelled:
+        if await http_request.is_disconnected():
+            token.cancel("disconnected")
+            return
+        await asyncio.sleep(interval)
+
+def create_tts_router(app_state, tts_pipeline, cut_method, temp_dir, tts_gate: TTSGate):
     """创建TTS路由器"""
     router = APIRouter(prefix="/tts", tags=["tts"])
+    # 推理在线程池中执行, 不阻塞事件循环 (否则无法察觉客户端断开), 同一时间最多跑 TTS_MAX_CONCURRENCY 个请求;
+    # 切换权重 (models_api) 经过同一个 tts_gate, 不会换掉进行中推理的模型
+
+    def synthesize(inputs, token):
+        """排队或推理期间被取消时返回 None"""
+        while not tts_gate.acquire(timeout=0.2):
+            if token.cancelled:
+                return None
+        try:
+            if token.cancelled:
+                return None
+            result = None
+            for result in tts_pipeline.run(dict(inputs, cancel_token=token)):
+                # result 是 (sampling_rate, audio_data) 的元组
+                break  # 只取第一个结果
+            return None if token.cancelled else result
+        finally:
+            tts_gate.release()
+
+    async def run_cancellable(http_request, inputs, key=None):
+        """
+        执行推理并在客户端断开、同 key 的新请求到来或 /tts/cancel 时中止.
+        没有 key 的请求也用生成的 key 登记, 不带参数的 /tts/cancel 可以取消它们
+        """
+        key = key or f"anonymous:{uuid.uuid4().hex}"
+        token = cancellation_registry.start(key)
+        watcher = asyncio.create_task(watch_disconnect(http_request, token))
+        try:
+            result = await run_in_threadpool(synthesize, inputs, token)
+        finally:
+            watcher.cancel()
+            cancellation_registry.finish(key, token)
+        if result is None:
+            raise HTTPException(status_code=499, detail=f"TTS request cancelled: {token.reason}")
+        return result
+
+    @router.post("/cancel")
+    async def cancel_tts(request: CancelTTSRequest):
+        """取消进行中的推理, 不指定 request_id/对话消息时取消全部"""
+        if request.request_id:
+            key = f"request:{request.request_id}"
+        elif request.conversation_id and request.message_id:
+            key = f"conversation:{request.conversation_id}:{request.message_id}"
+        else:
+            key = None
+        return {"cancelled": cancellation_registry.cancel(key)}
+
+    @router.get("/metrics")
+    async def tts_metrics():
+        """请求取消统计, 开启 cfm_batching 后附带 CFM 批处理的统计"""
+        status = cancellation_metrics.status()
+        if tts_pipeline.cfm_batcher is not None:
+            status["cfm_batcher"] = tts_pipeline.cfm_batcher.status()
+        return status
     
     @router.post("")
-    async def text_to_speech(request: TTSRequest):
+    async def text_to_speech(request: TTSRequest, http_request: Request):
         """文本转语音"""
         if not app_state.current_character or not app_state.current_character_audio:
             raise HTTPException(status_code=400, detail="No character selected")
@@ -59,11 +169,9 @@ def create_tts_router(app_state, tts_pipeline, cut_method, temp_dir):
                 "super_sampling": app_state.inference_config["super_sampling"],
             }
             
-            # 执行推理，获取生成器结果
-            for result in tts_pipeline.run(inputs):
-                # result 是 (sampling_rate, audio_data) 的元组
-                sampling_rate, audio_data = result
-                break  # 只取第一个结果
+            # 执行推理，获取第一个结果
+            key = f"request:{request.request_id}" if request.request_id else None
+            sampling_rate, audio_data = await run_cancellable(http_request, inputs, key)
             
             # 生成临时文件名
             timestamp = int(time.time())
@@ -80,11 +188,13 @@ def create_tts_router(app_state, tts_pipeline, cut_method, temp_dir):
                 headers={"Content-Disposition": f"attachment; filename={temp_filename}"}
             )
             
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"TTS generation failed: {str(e)}")
     
     @router.post("/conversation")
-    async def text_to_speech_for_conversation(request: ConversationTTSRequest):
+    async def text_to_speech_for_conversation(request: ConversationTTSRequest, http_request: Request):
         """为对话消息生成语音并保存到对话系统"""
         if not app_state.current_character or not app_state.current_character_audio:
             raise HTTPException(status_code=400, detail="No character selected")
@@ -117,11 +227,9 @@ def create_tts_router(app_state, tts_pipeline, cut_method, temp_dir):
                 "super_sampling": app_state.inference_config["super_sampling"],
             }
             
-            # 执行推理，获取生成器结果
-            for result in tts_pipeline.run(inputs):
-                # result 是 (sampling_rate, audio_data) 的元组
-                sampling_rate, audio_data = result
-                break  # 只取第一个结果
+            # 执行推理，获取第一个结果; 同一条消息重新生成时取消之前未完成的请求
+            key = f"conversation:{request.conversation_id}:{request.message_id}"
+            sampling_rate, audio_data = await run_cancellable(http_request, inputs, key)
             
             # 生成音频文件名和版本ID
             timestamp = int(time.time())
@@ -196,6 +304,8 @@ def create_tts_router(app_state, tts_pipeline, cut_method, temp_dir):
                 "version_id": version_id
             }
             
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"TTS generation failed: {str(e)}")
     
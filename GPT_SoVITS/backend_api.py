@@ -59,11 +59,12 @@ from tools.i18n.i18n import I18nAuto, scan_language_list
 from apis.character_utils import load_character_data, get_default_happy_audio
 from apis.models_api import create_models_router
 from apis.characters_api import create_characters_router
-from apis.tts_api import create_tts_router
+from apis.tts_api import TTSGate, create_tts_router
 from apis.config_api import create_config_router, create_api_config_router
 from apis.status_api import create_status_router
 from apis.frontend_api import create_frontend_router
 from apis.conversations_api import create_conversations_router
+from tools.model_lifecycle import ModelLifecycleManager
 
 # 初始化i18n
 language = os.environ.get("language", "Auto")
@@ -149,6 +150,57 @@ if sovits_path:
 # 初始化TTS管道
 tts_pipeline = TTS(tts_config)
 
+# 辅助模型生命周期管理（MODEL_LIFECYCLE=true 时启用空闲/内存压力卸载，否则只统计使用情况）
+def _env_float(name, default):
+    value = os.environ.get(name, "")
+    if value.lower() in ("none", "off"):
+        return None
+    return float(value) if value else default
+
+model_lifecycle = ModelLifecycleManager(
+    check_interval=_env_float("MODEL_CHECK_INTERVAL", 30.0),
+    memory_limit_percent=_env_float("MODEL_MEMORY_LIMIT_PERCENT", 90.0),
+    gpu_memory_limit_percent=_env_float("MODEL_GPU_MEMORY_LIMIT_PERCENT", 90.0),
+    enabled=os.environ.get("MODEL_LIFECYCLE", "false").lower() == "true",
+)
+model_lifecycle.register(
+    "bert",
+    lambda: tts_pipeline.init_bert_weights(tts_pipeline.configs.bert_base_path),
+    tts_pipeline.unload_bert_weights,
+    lambda: tts_pipeline.bert_model is not None,
+    idle_ttl=_env_float("BERT_IDLE_TTL", 3600.0),
+    priority=2,
+    groups=["tts"],
+)
+model_lifecycle.register(
+    "cnhubert",
+    lambda: tts_pipeline.init_cnhuhbert_weights(tts_pipeline.configs.cnhuhbert_base_path),
+    tts_pipeline.unload_cnhuhbert_weights,
+    lambda: tts_pipeline.cnhuhbert_model is not None,
+    idle_ttl=_env_float("CNHUBERT_IDLE_TTL", 1800.0),
+    priority=1,
+    groups=["tts"],
+)
+model_lifecycle.register(
+    "sv",
+    lambda: tts_pipeline.init_sv_model() if tts_pipeline.is_v2pro else None,
+    tts_pipeline.unload_sv_model,
+    # 非 v2Pro 模型不需要 SV, 视为已加载, 不再为它反复提交预加载
+    lambda: tts_pipeline.sv_model is not None or not tts_pipeline.is_v2pro,
+    idle_ttl=_env_float("SV_IDLE_TTL", 1800.0),
+    priority=1,
+    groups=["tts"],
+)
+model_lifecycle.register(
+    "sr",
+    tts_pipeline.init_sr_model,
+    tts_pipeline.unload_sr_model,
+    lambda: tts_pipeline.sr_model is not None,
+    idle_ttl=_env_float("SR_IDLE_TTL", 600.0),
+    priority=0,
+)
+tts_pipeline.model_guard = model_lifecycle.use
+
 # 加载角色数据
 character_data = load_character_data()
 
@@ -221,6 +273,28 @@ try:
     
     app.include_router(asr_router)
     app.include_router(websocket_router)
+    
+    # ASR与VAD模型交给生命周期管理器，空闲时回收，请求到达时异步预加载
+    model_lifecycle.register(
+        "asr",
+        asr_engine.load_model,
+        asr_engine.unload_model,
+        lambda: asr_engine.is_loaded,
+        idle_ttl=_env_float("ASR_IDLE_TTL", 1800.0),
+        priority=0,
+        groups=["asr"],
+    )
+    if asr_engine.vad_engine is not None:
+        model_lifecycle.register(
+            "vad",
+            asr_engine.vad_engine.load_model,
+            asr_engine.vad_engine.unload_model,
+            lambda: asr_engine.vad_engine.is_loaded,
+            idle_ttl=_env_float("VAD_IDLE_TTL", 1800.0),
+            priority=1,
+            groups=["asr"],
+        )
+    asr_engine.model_guard = model_lifecycle.use
     print("✅ ASR语音识别模块已加载")
     print(f"   - ASR REST API路由已注册")
     print(f"   - ASR WebSocket路由已注册")
@@ -234,6 +308,17 @@ except Exception as e:
     import traceback
     traceback.print_exc()
 
+@app.middleware("http")
+async def notify_model_activity(request, call_next):
+    """请求到达时刷新对应模型组的使用时间，已回收的模型在后台提前加载（MODEL_LIFECYCLE 关闭时不做任何事）"""
+    if model_lifecycle.enabled:
+        path = request.url.path
+        if path.startswith("/asr"):
+            model_lifecycle.notify_activity("asr")
+        elif path.startswith("/tts"):
+            model_lifecycle.notify_activity("tts")
+    return await call_next(request)
+
 # 添加静态文件服务
 dist_path = os.path.join(now_dir, "ui", "dist")
 if os.path.exists(dist_path):
@@ -245,10 +330,13 @@ else:
     print("请先构建前端项目: cd ui && pnpm build")
 
 # 注册API路由
+# 推理与切换权重共用, 切换时等进行中的推理结束
+tts_gate = TTSGate()
+
 # 模型管理API
 models_router = create_models_router(
     app_state, SoVITS_names, name2sovits_path, tts_pipeline, 
-    get_sovits_version_from_path_fast, dict_language_v1, dict_language_v2
+    get_sovits_version_from_path_fast, dict_language_v1, dict_language_v2, tts_gate
 )
 app.include_router(models_router)
 
@@ -257,7 +345,7 @@ characters_router = create_characters_router(app_state, character_data, get_defa
 app.include_router(characters_router)
 
 # TTS API
-tts_router = create_tts_router(app_state, tts_pipeline, cut_method, temp_dir)
+tts_router = create_tts_router(app_state, tts_pipeline, cut_method, temp_dir, tts_gate)
 app.include_router(tts_router)
 
 # 配置管理API
@@ -269,7 +357,7 @@ api_config_router = create_api_config_router(dist_path)
 app.include_router(api_config_router)
 
 # 状态API
-status_router = create_status_router(app_state, device, version, model_version, temp_dir)
+status_router = create_status_router(app_state, device, version, model_version, temp_dir, model_lifecycle)
 app.include_router(status_router)
 
 # 对话管理API
@@ -291,6 +379,7 @@ def cleanup_temp_files():
         print(f"清理临时文件时出错: {e}")
 
 atexit.register(cleanup_temp_files)
+atexit.register(model_lifecycle.stop)
 
 if __name__ == "__main__":
     print("\n" + "="*60)
@@ -321,6 +410,10 @@ if __name__ == "__main__":
         print("⚠️ ASR预加载已禁用，首次识别时将加载模型")
         print("   提示：设置环境变量 ASR_PRELOAD=true 可启用预加载")
     
+    model_lifecycle.start()
+    if model_lifecycle.enabled:
+        print("♻️ 辅助模型空闲回收已启用")
+    
     print(f"📡 API服务地址: http://localhost:8000")
     print(f"📚 API文档地址: http://localhost:8000/docs")
     if os.path.exists(dist_path):
@@ -260,6 +260,52 @@ class ERes2NetV2(nn.Module):
         # else:
         #     return embed_a
 
+    def forward3_batch(self, x, lengths):
+        """
+        forward3 for a padded batch (B,T,F) with the valid frame count of each item.
+        The network is fully convolutional, so the inputs of every 3x3 conv are zeroed past each item's
+        length (what the conv's own zero padding sees on an unpadded input) and the final time mean only
+        covers valid frames. Valid outputs then match forward3 run item by item.
+        """
+        lengths = torch.as_tensor(lengths, dtype=torch.long, device=x.device)
+        # valid lengths at every time resolution: stride-2 convs (k=3,p=1 or k=1) map T -> ceil(T/2)
+        resolution_lengths = {}
+        size, lens = x.shape[1], lengths
+        while size not in resolution_lengths:
+            resolution_lengths[size] = lens
+            size, lens = (size + 1) // 2, (lens + 1) // 2
+
+        def mask_time(module, inputs):
+            feat = inputs[0]
+            lens = resolution_lengths[feat.shape[-1]]
+            mask = torch.arange(feat.shape[-1], device=feat.device).unsqueeze(0) < lens.unsqueeze(1)
+            return (feat * mask[:, None, None, :].to(feat.dtype),) + tuple(inputs[1:])
+
+        handles = [
+            module.register_forward_pre_hook(mask_time)
+            for module in self.modules()
+            if isinstance(module, nn.Conv2d) and module.kernel_size != (1, 1)
+        ]
+        try:
+            x = x.permute(0, 2, 1)  # (B,T,F) => (B,F,T)
+            x = x.unsqueeze(1)
+            out = F.relu(self.bn1(self.conv1(x)))
+            out1 = self.layer1(out)
+            out2 = self.layer2(out1)
+            out3 = self.layer3(out2)
+            out4 = self.layer4(out3)
+            out3_ds = self.layer3_ds(out3)
+            fuse_out34 = self.fuse34(out4, out3_ds)
+        finally:
+            for handle in handles:
+                handle.remove()
+        fuse_out34 = fuse_out34.flatten(start_dim=1, end_dim=2)
+        lens = resolution_lengths[fuse_out34.shape[-1]]
+        mask = torch.arange(fuse_out34.shape[-1], device=x.device).unsqueeze(0) < lens.unsqueeze(1)
+        # sum in fp32 so that long fp16 inputs cannot overflow
+        pooled = (fuse_out34.float() * mask.unsqueeze(1)).sum(-1) / lens.unsqueeze(1)
+        return pooled.to(fuse_out34.dtype)
+
 
 if __name__ == "__main__":
     x = torch.randn(1, 300, 80)
@@ -13,6 +13,7 @@ __all__ = [
     "mel_scale_scalar",
     "spectrogram",
     "fbank",
+    "fbank_batch",
     "mfcc",
     "vtln_warp_freq",
     "vtln_warp_mel_freq",
@@ -516,6 +517,46 @@ def get_mel_banks(
 cache = {}
 
 
+def _get_cached_mel_banks(
+    num_mel_bins: int,
+    padded_window_size: int,
+    sample_frequency: float,
+    low_freq: float,
+    high_freq: float,
+    vtln_low: float,
+    vtln_high: float,
+    vtln_warp: float,
+    device,
+    dtype,
+) -> Tensor:
+    cache_key = "%s-%s-%s-%s-%s-%s-%s-%s-%s-%s" % (
+        num_mel_bins,
+        padded_window_size,
+        sample_frequency,
+        low_freq,
+        high_freq,
+        vtln_low,
+        vtln_high,
+        vtln_warp,
+        device,
+        dtype,
+    )
+    if cache_key not in cache:
+        cache[cache_key] = get_mel_banks(
+            num_mel_bins,
+            padded_window_size,
+            sample_frequency,
+            low_freq,
+            high_freq,
+            vtln_low,
+            vtln_high,
+            vtln_warp,
+            device,
+            dtype,
+        )
+    return cache[cache_key]
+
+
 def fbank(
     waveform: Tensor,
     blackman_coeff: float = 0.42,
@@ -625,7 +666,7 @@ def fbank(
     # size (num_mel_bins, padded_window_size // 2)
     # print(num_mel_bins, padded_window_size, sample_frequency, low_freq, high_freq, vtln_low, vtln_high, vtln_warp)
 
-    cache_key = "%s-%s-%s-%s-%s-%s-%s-%s-%s-%s" % (
+    mel_energies = _get_cached_mel_banks(
         num_mel_bins,
         padded_window_size,
         sample_frequency,
@@ -637,22 +678,6 @@ def fbank(
         device,
         dtype,
     )
-    if cache_key not in cache:
-        mel_energies = get_mel_banks(
-            num_mel_bins,
-            padded_window_size,
-            sample_frequency,
-            low_freq,
-            high_freq,
-            vtln_low,
-            vtln_high,
-            vtln_warp,
-            device,
-            dtype,
-        )
-        cache[cache_key] = mel_energies
-    else:
-        mel_energies = cache[cache_key]
 
     # pad right column with zeros and add dimension, size (num_mel_bins, padded_window_size // 2 + 1)
     mel_energies = torch.nn.functional.pad(mel_energies, (0, 1), mode="constant", value=0)
@@ -676,6 +701,95 @@ def fbank(
     return mel_energies
 
 
+def fbank_batch(
+    waveforms: Tensor,
+    lengths: Tensor = None,
+    blackman_coeff: float = 0.42,
+    frame_length: float = 25.0,
+    frame_shift: float = 10.0,
+    high_freq: float = 0.0,
+    low_freq: float = 20.0,
+    num_mel_bins: int = 23,
+    preemphasis_coefficient: float = 0.97,
+    remove_dc_offset: bool = True,
+    round_to_power_of_two: bool = True,
+    sample_frequency: float = 16000.0,
+    use_log_fbank: bool = True,
+    use_power: bool = True,
+    window_type: str = POVEY,
+) -> Tuple[Tensor, Tensor]:
+    r"""Batched version of :func:`fbank` for a zero padded batch of mono waveforms. Framing, window,
+    FFT and mel projection run on the whole batch at once.
+
+    Only the options used by the speaker models are supported: ``snip_edges=True``, no dither,
+    no energy column, no VTLN warping and no mean subtraction. Every frame only depends on its own
+    samples, so the valid frames of each item equal ``fbank`` on the unpadded waveform.
+
+    Args:
+        waveforms (Tensor): Tensor of size (B, n), zero padded on the right
+        lengths (Tensor, optional): Valid number of samples of each item, size (B). (Default: all ``n``)
+        Other arguments are the same as :func:`fbank`.
+
+    Returns:
+        (Tensor, Tensor): fbank of size (B, m, ``num_mel_bins``) with frames past each item's length set
+        to zero, and the number of valid frames of each item, size (B)
+    """
+    device, dtype = waveforms.device, waveforms.dtype
+    assert waveforms.dim() == 2
+    waveforms = waveforms.contiguous()
+    batch_size, num_samples = waveforms.shape
+    window_shift = int(sample_frequency * frame_shift * MILLISECONDS_TO_SECONDS)
+    window_size = int(sample_frequency * frame_length * MILLISECONDS_TO_SECONDS)
+    padded_window_size = _next_power_of_2(window_size) if round_to_power_of_two else window_size
+    if lengths is None:
+        lengths = torch.full((batch_size,), num_samples, dtype=torch.long)
+    lengths = torch.as_tensor(lengths, dtype=torch.long, device=device)
+    assert 2 <= window_size <= int(lengths.min()), "choose a window size {} that is [2, {}]".format(
+        window_size, int(lengths.min())
+    )
+    epsilon = _get_epsilon(device, dtype)
+
+    # size (B, m, window_size)
+    m = 1 + (num_samples - window_size) // window_shift
+    strided_input = waveforms.as_strided(
+        (batch_size, m, window_size),
+        (waveforms.stride(0), window_shift * waveforms.stride(1), waveforms.stride(1)),
+    )
+    num_frames = 1 + (lengths - window_size) // window_shift
+
+    if remove_dc_offset:
+        strided_input = strided_input - torch.mean(strided_input, dim=-1, keepdim=True)
+
+    if preemphasis_coefficient != 0.0:
+        offset_strided_input = torch.nn.functional.pad(strided_input, (1, 0), mode="replicate")
+        strided_input = strided_input - preemphasis_coefficient * offset_strided_input[:, :, :-1]
+
+    window_function = _feature_window_function(window_type, window_size, blackman_coeff, device, dtype)
+    strided_input = strided_input * window_function
+
+    if padded_window_size != window_size:
+        strided_input = torch.nn.functional.pad(
+            strided_input, (0, padded_window_size - window_size), mode="constant", value=0
+        )
+
+    # size (B, m, padded_window_size // 2 + 1)
+    spectrum = torch.fft.rfft(strided_input).abs()
+    if use_power:
+        spectrum = spectrum.pow(2.0)
+
+    mel_energies = _get_cached_mel_banks(
+        num_mel_bins, padded_window_size, sample_frequency, low_freq, high_freq, 100.0, -500.0, 1.0, device, dtype
+    )
+    mel_energies = torch.nn.functional.pad(mel_energies, (0, 1), mode="constant", value=0)
+    mel_energies = torch.mm(spectrum.reshape(batch_size * m, -1), mel_energies.T).reshape(batch_size, m, -1)
+    if use_log_fbank:
+        mel_energies = torch.max(mel_energies, epsilon).log()
+
+    frame_mask = torch.arange(m, device=device).unsqueeze(0) < num_frames.unsqueeze(1)
+    mel_energies = mel_energies * frame_mask.unsqueeze(-1).to(dtype)
+    return mel_energies, num_frames
+
+
 def _get_dct_matrix(num_ceps: int, num_mel_bins: int) -> Tensor:
     # returns a dct matrix of size (num_mel_bins, num_ceps)
     # size (num_mel_bins, num_mel_bins)
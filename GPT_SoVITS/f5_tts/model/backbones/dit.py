@@ -73,12 +73,19 @@ class InputEmbedding(nn.Module):
         self.proj = nn.Linear(mel_dim * 2 + text_dim, out_dim)
         self.conv_pos_embed = ConvPositionEmbedding(dim=out_dim)
 
-    def forward(self, x: float["b n d"], cond: float["b n d"], text_embed: float["b n d"], drop_audio_cond=False):  # noqa: F722
+    def forward(
+        self,
+        x: float["b n d"],  # noqa: F722
+        cond: float["b n d"],  # noqa: F722
+        text_embed: float["b n d"],  # noqa: F722
+        drop_audio_cond=False,
+        mask: bool["b n"] | None = None,  # noqa: F722
+    ):
         if drop_audio_cond:  # cfg for cond audio
             cond = torch.zeros_like(cond)
 
         x = self.proj(torch.cat((x, cond, text_embed), dim=-1))
-        x = self.conv_pos_embed(x) + x
+        x = self.conv_pos_embed(x, mask) + x
         return x
 
 
@@ -169,7 +176,9 @@ class DiT(nn.Module):
         else:
             text_embed = self.text_embed(text, seq_len, drop_text=drop_text)  ###need to change
 
-        x = self.input_embed(x, cond, text_embed, drop_audio_cond=drop_audio_cond)
+        # at inference padded frames are kept out of the conv position embedding, so a row of a padded
+        # batch matches running it alone (training keeps the unmasked behaviour the weights were trained with)
+        x = self.input_embed(x, cond, text_embed, drop_audio_cond=drop_audio_cond, mask=mask if infer else None)
 
         rope = self.rotary_embed.forward_from_seq_len(seq_len)
 
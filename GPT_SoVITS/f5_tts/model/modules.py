@@ -181,7 +181,16 @@ class ConvPositionEmbedding(nn.Module):
             x = x.masked_fill(~mask, 0.0)
 
         x = x.permute(0, 2, 1)
-        x = self.conv1d(x)
+        if mask is None:
+            x = self.conv1d(x)
+        else:
+            # re-zero the padding after every layer, so padded rows see the same zero padding
+            # as an unpadded sequence of their own length
+            conv_mask = mask.permute(0, 2, 1)
+            for layer in self.conv1d:
+                x = layer(x)
+                if isinstance(layer, nn.Mish):
+                    x = x.masked_fill(~conv_mask, 0.0)
         out = x.permute(0, 2, 1)
 
         if mask is not None:
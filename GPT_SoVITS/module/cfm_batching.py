@@ -0,0 +1,202 @@
+"""
+跨请求的 CFM 批处理
+
+v3/v4 模型每个 CFM 块要在 DiT 上迭代 sample_steps 步, 单个请求的块只有 1 行 (流式、逐块推理) 或几行,
+多个请求同时合成时各自串行地跑小 batch, GPU 利用率很低. 这里用一个工作线程统一调度所有请求的块:
+- 请求线程调用 submit(mu, prompt, n_timesteps), 在本线程生成初始噪声后排队, 返回 Future
+- 工作线程每一步把所有进行中的块 (最多 max_batch 行) 按最长的块补齐, 一起过一次 DiT;
+  每行有自己的长度 (x_lens 掩码)、参考 mel 长度、当前时间步与步长, 不必同时开始, 也不必步数相同
+- 新到的块在下一步直接加入 (空闲时最多等 wait_ms 毫秒凑批), 跑完的块立即交回对应请求
+每行的 text/dt 条件在加入时单独计算并缓存, 与 CFM.inference 的 use_conditioner_cache 一致.
+补齐的位置在注意力中被掩码, 推理时 DiT 输入端的卷积位置编码也按 x_lens 把补齐的帧置零, 每行的结果与单独推理
+在浮点误差内一致 (见 cfm_benchmark.py 的 parity 检查). 不支持 inference_cfg_rate.
+收益来自把多个请求的小 batch 合成一次 DiT 前向: GPU 上单行远没有用满算力时吞吐随并发增加;
+CPU 上 DiT 前向本身已是计算瓶颈, 合批几乎没有收益 (还多了线程切换), 因此默认关闭 (见 TTS.py 的 cfm_batching).
+"""
+
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import Future
+from typing import List
+
+import torch
+from torch.nn import functional as F
+
+
+class CFMItem:
+    """一个块中的一行的迭代状态"""
+
+    def __init__(self, job, x, prompt_x, mu, prompt_len: int, n_timesteps: int):
+        self.job = job
+        self.x = x  # [C, T]
+        self.prompt_x = prompt_x  # [C, T]
+        self.mu = mu  # [C_mu, T]
+        self.length = x.shape[-1]
+        self.prompt_len = prompt_len
+        self.n_timesteps = n_timesteps
+        self.d = 1 / n_timesteps
+        self.t = 0
+        self.step = 0
+        self.text_emb = None  # [T, text_dim]
+        self.dt = None  # [dim]
+
+
+class CFMJob:
+    """一次 submit, 所有行都跑完后把 [B, C, T] 交给 future"""
+
+    def __init__(self):
+        self.future = Future()
+        self.items: List[CFMItem] = []
+        self.remaining = 0
+
+    def settle(self, result=None, error=None):
+        # 已取消或已失败的 job 不再设置结果; 先置为 RUNNING, 之后调用方的 cancel() 不再生效
+        if self.future.done() or not self.future.set_running_or_notify_cancel():
+            return
+        if error is not None:
+            self.future.set_exception(error)
+        else:
+            self.future.set_result(result)
+
+    def finish_item(self):
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.settle(torch.stack([item.x for item in self.items]))
+
+
+class CFMBatcher:
+    def __init__(self, cfm, max_batch: int = 16, wait_ms: float = 2):
+        """cfm: module.models.CFM; max_batch: 每步最多一起计算的行数"""
+        self.cfm = cfm
+        self.max_batch = max(1, max_batch)
+        self.wait = wait_ms / 1000
+        self.pending = deque()
+        self.active: List[CFMItem] = []
+        self.cond = threading.Condition()
+        self.closed = False
+        # 统计: 迭代步数与参与的总行数, 平均 batch = rows / steps
+        self.steps = 0
+        self.rows = 0
+        self.thread = threading.Thread(target=self.loop, name="cfm_batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, mu: torch.Tensor, prompt: torch.Tensor, n_timesteps: int, temperature: float = 1.0) -> Future:
+        """
+        参数与 CFM.inference 相同: mu [B, T, C_mu] (同一次提交的行等长), prompt [1 或 B, mel_dim, prompt_len].
+        返回的 Future 结果为 [B, mel_dim, T]; 在结果产出前调用 future.cancel() 会丢弃这些行
+        """
+        B, T = mu.size(0), mu.size(1)
+        x = torch.randn([B, self.cfm.in_channels, T], device=mu.device, dtype=mu.dtype) * temperature
+        prompt_len = prompt.size(-1)
+        prompt_x = torch.zeros_like(x, dtype=mu.dtype)
+        prompt_x[..., :prompt_len] = prompt[..., :prompt_len]
+        x[..., :prompt_len] = 0
+        mu = mu.transpose(2, 1)
+        job = CFMJob()
+        job.items = [CFMItem(job, x[i], prompt_x[i], mu[i], prompt_len, n_timesteps) for i in range(B)]
+        job.remaining = B
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("CFMBatcher is closed")
+            self.pending.extend(job.items)
+            self.cond.notify()
+        return job.future
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+        error = RuntimeError("CFMBatcher is closed")
+        for item in list(self.pending) + self.active:
+            item.job.settle(error=error)
+        self.pending.clear()
+        self.active = []
+
+    def status(self) -> dict:
+        with self.cond:
+            return {
+                "pending": len(self.pending),
+                "active": len(self.active),
+                "steps": self.steps,
+                "avg_batch": round(self.rows / self.steps, 2) if self.steps else 0.0,
+            }
+
+    def admit(self):
+        """把排队的行加入进行中的 batch, 已取消或已失败的丢弃; 返回是否还有要算的行"""
+        with self.cond:
+            while not self.pending and not self.active and not self.closed:
+                self.cond.wait()
+                if self.pending and self.wait > 0:
+                    # 空闲时稍等片刻, 让同时到达的请求从第一步起就在同一个 batch 里
+                    self.cond.wait(self.wait)
+            self.active = [item for item in self.active if not item.job.future.done()]
+            while self.pending and len(self.active) < self.max_batch:
+                item = self.pending.popleft()
+                if not item.job.future.done():
+                    self.active.append(item)
+            return bool(self.active) and not self.closed
+
+    def prepare(self, item: CFMItem):
+        """单独计算一行的 text/dt 条件, 与该行单独推理时相同"""
+        estimator = self.cfm.estimator
+        item.text_emb = estimator.text_embed(item.mu.transpose(0, 1).unsqueeze(0), item.length)[0]
+        d_tensor = torch.full((1,), item.d, device=item.x.device, dtype=item.mu.dtype)
+        item.dt = estimator.d_embed(d_tensor)[0]
+
+    def step(self, items: List[CFMItem]):
+        for item in items:
+            if item.text_emb is None:
+                self.prepare(item)
+        T = max(item.length for item in items)
+        device, dtype = items[0].x.device, items[0].mu.dtype
+        x = torch.stack([F.pad(item.x, (0, T - item.length)) for item in items])
+        prompt_x = torch.stack([F.pad(item.prompt_x, (0, T - item.length)) for item in items])
+        mu = torch.stack([F.pad(item.mu, (0, T - item.length)) for item in items])
+        text_cache = torch.stack([F.pad(item.text_emb, (0, 0, 0, T - item.length)) for item in items])
+        dt_cache = torch.stack([item.dt for item in items])
+        x_lens = torch.LongTensor([item.length for item in items]).to(device)
+        t_tensor = torch.tensor([item.t for item in items], device=device, dtype=dtype)
+        d_tensor = torch.tensor([item.d for item in items], device=device, dtype=dtype)
+        v_pred, _, _ = self.cfm.estimator(
+            x,
+            prompt_x,
+            x_lens,
+            t_tensor,
+            d_tensor,
+            mu,
+            use_grad_ckpt=False,
+            drop_audio_cond=False,
+            drop_text=False,
+            infer=True,
+            text_cache=text_cache,
+            dt_cache=dt_cache,
+        )
+        v_pred = v_pred.transpose(2, 1)
+        for i, item in enumerate(items):
+            item.x = item.x + item.d * v_pred[i, :, : item.length]
+            item.t = item.t + item.d
+            item.x[:, : item.prompt_len] = 0
+            item.step += 1
+        self.steps += 1
+        self.rows += len(items)
+
+    def loop(self):
+        with torch.inference_mode():
+            while self.admit():
+                items = self.active
+                try:
+                    self.step(items)
+                except Exception as e:
+                    traceback.print_exc()
+                    for item in items:
+                        item.job.settle(error=e)
+                    with self.cond:
+                        self.active = []
+                    continue
+                with self.cond:
+                    self.active = [item for item in items if item.step < item.n_timesteps]
+                for item in items:
+                    if item.step >= item.n_timesteps:
+                        item.job.finish_item()
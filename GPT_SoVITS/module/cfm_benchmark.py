@@ -0,0 +1,136 @@
+"""
+跨请求 CFM 批处理 (CFMBatcher) 的一致性检查与吞吐测试
+
+python GPT_SoVITS/module/cfm_benchmark.py [-s s2 v3/v4 权重.pth] [--device cuda] [--half] [-c 1,2,4,8]
+不给权重时用与 v3/v4 相同结构、随机初始化的 CFM.
+- parity: 同一 seed 下单独提交给 CFMBatcher 的块, 以及不同长度的块一起迭代 (短的补齐) 时, 与各自
+  CFM.inference 的结果之差不超过 --tol, 否则断言失败
+- throughput: c 个并发请求各自依次推理 chunks 个块 (下一块以上一块的末尾作为参考), 对比
+  串行 (所有请求共用一把锁, 与 tts_max_concurrency=1 相同) 与 CFMBatcher 的 chunks/sec 以及平均 batch.
+  合批的收益在 GPU 上; CPU 上 DiT 前向已是计算瓶颈, 加速比在 1 左右或略低于 1
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+import torch
+
+# to import modules from GPT_SoVITS (and GPT_SoVITS.f5_tts, which f5_tts imports) when run as a script
+now_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(now_dir)
+sys.path.append(os.path.dirname(now_dir))
+
+from f5_tts.model import DiT
+from module.cfm_batching import CFMBatcher
+from module.models import CFM
+
+
+def build_cfm(weights_path, device, half):
+    cfm = CFM(100, DiT(**dict(dim=1024, depth=22, heads=16, ff_mult=2, text_dim=512, conv_layers=4)))
+    if weights_path:
+        state = torch.load(weights_path, map_location="cpu", weights_only=False)["weight"]
+        state = {k[len("cfm.") :]: v for k, v in state.items() if k.startswith("cfm.")}
+        print(cfm.load_state_dict(state, strict=False))
+    cfm = cfm.eval().to(device)
+    return cfm.half() if half else cfm
+
+
+def make_chunk(prompt_len, chunk_len, device, dtype):
+    mu = torch.randn(1, prompt_len + chunk_len, 512, device=device, dtype=dtype)
+    prompt = torch.randn(1, 100, prompt_len, device=device, dtype=dtype)
+    return mu, prompt
+
+
+def synchronize(device):
+    if str(device).startswith("cuda"):
+        torch.cuda.synchronize()
+
+
+def parity(cfm, batcher, steps, device, dtype, tol):
+    mu, prompt = make_chunk(70, 300, device, dtype)
+    torch.manual_seed(0)
+    ref = cfm.inference(mu, torch.LongTensor([mu.size(1)]).to(device), prompt, steps)
+    torch.manual_seed(0)
+    out = batcher.submit(mu, prompt, steps).result()
+    diff = (out - ref).abs().max().item()
+    print("parity (single chunk): max diff %.2e" % diff)
+    assert diff <= tol, "single chunk differs from CFM.inference by %.2e (tol %.0e)" % (diff, tol)
+
+    chunks = [make_chunk(prompt_len, chunk_len, device, dtype) for prompt_len, chunk_len in ((70, 300), (100, 180))]
+    refs, futures = [], []
+    for i, (mu, prompt) in enumerate(chunks):
+        torch.manual_seed(i)
+        refs.append(cfm.inference(mu, torch.LongTensor([mu.size(1)]).to(device), prompt, steps))
+    with batcher.cond:
+        # 持有 (可重入的) 锁时提交, 保证两个块从第一步起就在同一个 batch 里
+        for i, (mu, prompt) in enumerate(chunks):
+            torch.manual_seed(i)
+            futures.append(batcher.submit(mu, prompt, steps))
+    for ref, future in zip(refs, futures):
+        diff = (future.result() - ref).abs().max().item()
+        print("parity (batched, length %s): max diff %.2e" % (ref.shape[-1], diff))
+        assert diff <= tol, "length %s row differs from CFM.inference by %.2e (tol %.0e)" % (ref.shape[-1], diff, tol)
+
+
+def throughput(cfm, batcher, concurrency, chunks, steps, device, dtype):
+    lock = threading.Lock()
+
+    def serial(mu, prompt):
+        with lock:
+            return cfm.inference(mu, torch.LongTensor([mu.size(1)]).to(device), prompt, steps)
+
+    def batched(mu, prompt):
+        return batcher.submit(mu, prompt, steps).result()
+
+    def request(infer, seed):
+        rng = random.Random(seed)
+        with torch.no_grad():
+            mu, prompt = make_chunk(rng.randint(60, 140), rng.randint(200, 340), device, dtype)
+            for _ in range(chunks):
+                out = infer(mu, prompt)
+                prompt = out[:, :, -prompt.shape[-1] :]
+            synchronize(device)
+
+    results = {}
+    for name, infer in (("serial", serial), ("batched", batched)):
+        steps_before, rows_before = batcher.steps, batcher.rows
+        threads = [threading.Thread(target=request, args=(infer, i)) for i in range(concurrency)]
+        t0 = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - t0
+        avg_batch = (batcher.rows - rows_before) / max(1, batcher.steps - steps_before)
+        results[name] = concurrency * chunks / elapsed
+        print(
+            "concurrency %2d %-8s %8.2f chunks/sec%s"
+            % (concurrency, name, results[name], " (avg batch %.2f)" % avg_batch if name == "batched" else "")
+        )
+    print("concurrency %2d speedup %.2fx" % (concurrency, results["batched"] / results["serial"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parity check and throughput benchmark for cross-request CFM batching")
+    parser.add_argument("-s", "--sovits", default=None, help="v3/v4 s2 weights, random weights when omitted")
+    parser.add_argument("-c", "--concurrency", default="1,2,4,8")
+    parser.add_argument("--chunks", type=int, default=4, help="chunks per request")
+    parser.add_argument("--steps", type=int, default=32, help="sample_steps")
+    parser.add_argument("--max_batch", type=int, default=16)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--half", action="store_true")
+    parser.add_argument("--tol", type=float, default=None, help="parity tolerance, default 1e-3 (fp32) / 5e-2 (fp16)")
+    args = parser.parse_args()
+
+    cfm = build_cfm(args.sovits, args.device, args.half)
+    dtype = next(cfm.parameters()).dtype
+    batcher = CFMBatcher(cfm, args.max_batch)
+    tol = args.tol if args.tol is not None else (5e-2 if args.half else 1e-3)
+    parity(cfm, batcher, args.steps, args.device, dtype, tol)
+    for concurrency in args.concurrency.split(","):
+        throughput(cfm, batcher, int(concurrency), args.chunks, args.steps, args.device, dtype)
+    batcher.close()
@@ -5,7 +5,10 @@ import torch
 import torch.utils.data
 from tqdm import tqdm
 
+from AR.data.bucket_sampler import DistributedTokenBatchSampler
+from module.dataset_index import load_or_build, parallel_map
 from module.mel_processing import spectrogram_torch, spec_to_mel_torch
+from module.packed_dataset import open_packed
 from text import cleaned_text_to_sequence
 import torch.nn.functional as F
 from tools.my_utils import load_audio
@@ -13,8 +16,157 @@ from tools.my_utils import load_audio
 version = os.environ.get("version", None)
 
 
+def _build_audio_index(loader, version, is_v2Pro):
+    names4 = set([name[:-3] for name in list(os.listdir(loader.path4))])  # 去除.pt后缀
+    names5 = set(os.listdir(loader.path5))
+    if is_v2Pro:
+        names6 = set([name[:-3] for name in list(os.listdir(loader.path7))])  # 去除.pt后缀
+    phoneme_data = {}
+    with open(loader.path2, "r", encoding="utf8") as f:
+        lines = f.read().strip("\n").split("\n")
+
+    for line in lines:
+        tmp = line.split("\t")
+        if len(tmp) != 4:
+            continue
+        phoneme_data[tmp[0]] = [tmp[1]]
+    if is_v2Pro:
+        audiopaths_sid_text = list(set(phoneme_data) & names4 & names5 & names6)
+    else:
+        audiopaths_sid_text = list(set(phoneme_data) & names4 & names5)
+    tmp = audiopaths_sid_text
+    leng = len(tmp)
+    min_num = 100
+    if leng < min_num:
+        audiopaths_sid_text = []
+        for _ in range(max(2, int(min_num / leng))):
+            audiopaths_sid_text += tmp
+
+    random.seed(1234)
+    random.shuffle(audiopaths_sid_text)
+
+    print("phoneme_data_len:", len(phoneme_data.keys()))
+    print("wav_data_len:", len(audiopaths_sid_text))
+
+    # 逐条 getsize 在大数据集/网络盘上很慢, 放到线程池里并行
+    sizes = dict(zip(tmp, parallel_map(lambda name: os.path.getsize("%s/%s" % (loader.path5, name)), tmp)))
+
+    audiopaths_sid_text_new = []
+    lengths = []
+    skipped_phone = 0
+    skipped_dur = 0
+    for audiopath in tqdm(audiopaths_sid_text):
+        try:
+            phoneme = phoneme_data[audiopath][0]
+            phoneme = phoneme.split(" ")
+            phoneme_ids = cleaned_text_to_sequence(phoneme, version)
+        except Exception:
+            print(f"{audiopath} not in self.phoneme_data !")
+            skipped_phone += 1
+            continue
+
+        size = sizes[audiopath]
+        duration = size / loader.sampling_rate / 2
+
+        if duration == 0:
+            print(f"Zero duration for {audiopath}, skipping...")
+            skipped_dur += 1
+            continue
+
+        if 54 > duration > 0.6 or loader.val:
+            audiopaths_sid_text_new.append([audiopath, phoneme_ids])
+            lengths.append(size // (2 * loader.hop_length))
+        else:
+            skipped_dur += 1
+            continue
+
+    print("skipped_phone: ", skipped_phone, ", skipped_dur: ", skipped_dur)
+    print("total left: ", len(audiopaths_sid_text_new))
+    assert len(audiopaths_sid_text_new) > 1  # 至少能凑够batch size，这里todo
+    # 一并返回 seed(1234) + shuffle 之后的全局随机数状态, 命中缓存时恢复, 后续的随机过程与不用缓存时一致
+    return audiopaths_sid_text_new, lengths, random.getstate()
+
+
+def load_audio_index(loader, exp_dir, version):
+    """
+    列目录、解析 2-name2text.txt 并按时长过滤, 返回 (audiopaths_sid_text, lengths).
+    结果缓存在 <exp_dir>/index 下, 源文件不变时直接复用 (见 module/dataset_index.py).
+    """
+    is_v2Pro = getattr(loader, "is_v2Pro", False)
+    params = {
+        "version": version,
+        "sampling_rate": loader.sampling_rate,
+        "hop_length": loader.hop_length,
+        "val": loader.val,
+        "is_v2Pro": is_v2Pro,
+    }
+    sources = [loader.path2, loader.path4, loader.path5] + ([loader.path7] if is_v2Pro else [])
+    audiopaths_sid_text, lengths, random_state = load_or_build(
+        exp_dir, "sovits", params, sources, lambda: _build_audio_index(loader, version, is_v2Pro)
+    )
+    random.setstate(random_state)
+    return audiopaths_sid_text, lengths
+
+
+class PackedFeatureMixin:
+    """
+    读取 module/packed_dataset.py 打包的 8-packed 分片, 没有打包或参数不一致时退回逐文件读取.
+    packed_audio_fields 与 get_audio 的返回值一一对应.
+    """
+
+    packed = None
+    packed_audio_fields = ("spec", "wav")
+
+    def packed_params(self):
+        params = {
+            "sampling_rate": self.sampling_rate,
+            "filter_length": self.filter_length,
+            "hop_length": self.hop_length,
+            "win_length": self.win_length,
+        }
+        if hasattr(self, "n_mel_channels"):
+            params.update(
+                {
+                    "filter_length_mel": self.filter_length_mel,
+                    "hop_length_mel": self.hop_length_mel,
+                    "n_mel_channels": self.n_mel_channels,
+                    "sampling_rate_mel": self.sampling_rate_mel,
+                    "mel_fmin": self.mel_fmin,
+                    "mel_fmax": self.mel_fmax,
+                }
+            )
+        return params
+
+    def init_packed(self, exp_dir):
+        self.packed = open_packed(exp_dir, type(self).__name__, self.packed_params())
+
+    def get_audio_features(self, audiopath):
+        packed = self.packed
+        if packed is not None:
+            if packed.has_all(self.packed_audio_fields, audiopath):
+                return tuple(packed.get(field, audiopath) for field in self.packed_audio_fields)
+            if self.packed_audio_fields == ("spec", "wav") and packed.has("wav", audiopath):
+                # 打包时没有存频谱 (--no_spec), 从打包的波形现算
+                wav = packed.get("wav", audiopath)
+                spec = spectrogram_torch(
+                    wav, self.filter_length, self.sampling_rate, self.hop_length, self.win_length, center=False
+                )
+                return torch.squeeze(spec, 0), wav
+        return self.get_audio("%s/%s" % (self.path5, audiopath))
+
+    def load_ssl(self, audiopath):
+        if self.packed is not None and self.packed.has("ssl", audiopath):
+            return self.packed.get("ssl", audiopath)
+        return torch.load("%s/%s.pt" % (self.path4, audiopath), map_location="cpu")
+
+    def load_sv(self, audiopath):
+        if self.packed is not None and self.packed.has("sv", audiopath):
+            return self.packed.get("sv", audiopath)
+        return torch.load("%s/%s.pt" % (self.path7, audiopath), map_location="cpu")
+
+
 # ZeroDivisionError fixed by Tybost (https://github.com/RVC-Boss/GPT-SoVITS/issues/79)
-class TextAudioSpeakerLoader(torch.utils.data.Dataset):
+class TextAudioSpeakerLoader(PackedFeatureMixin, torch.utils.data.Dataset):
     """
     1) loads audio, speaker_id, text pairs
     2) normalizes text and converts them to sequences of integers
@@ -33,92 +185,28 @@ class TextAudioSpeakerLoader(torch.utils.data.Dataset):
         if self.is_v2Pro:
             self.path7 = "%s/7-sv_cn" % exp_dir
             assert os.path.exists(self.path7)
-        names4 = set([name[:-3] for name in list(os.listdir(self.path4))])  # 去除.pt后缀
-        names5 = set(os.listdir(self.path5))
-        if self.is_v2Pro:
-            names6 = set([name[:-3] for name in list(os.listdir(self.path7))])  # 去除.pt后缀
-        self.phoneme_data = {}
-        with open(self.path2, "r", encoding="utf8") as f:
-            lines = f.read().strip("\n").split("\n")
-
-        for line in lines:
-            tmp = line.split("\t")
-            if len(tmp) != 4:
-                continue
-            self.phoneme_data[tmp[0]] = [tmp[1]]
-        if self.is_v2Pro:
-            self.audiopaths_sid_text = list(set(self.phoneme_data) & names4 & names5 & names6)
-        else:
-            self.audiopaths_sid_text = list(set(self.phoneme_data) & names4 & names5)
-        tmp = self.audiopaths_sid_text
-        leng = len(tmp)
-        min_num = 100
-        if leng < min_num:
-            self.audiopaths_sid_text = []
-            for _ in range(max(2, int(min_num / leng))):
-                self.audiopaths_sid_text += tmp
         self.max_wav_value = hparams.max_wav_value
         self.sampling_rate = hparams.sampling_rate
         self.filter_length = hparams.filter_length
         self.hop_length = hparams.hop_length
         self.win_length = hparams.win_length
-        self.sampling_rate = hparams.sampling_rate
         self.val = val
-
-        random.seed(1234)
-        random.shuffle(self.audiopaths_sid_text)
-
-        print("phoneme_data_len:", len(self.phoneme_data.keys()))
-        print("wav_data_len:", len(self.audiopaths_sid_text))
-
-        audiopaths_sid_text_new = []
-        lengths = []
-        skipped_phone = 0
-        skipped_dur = 0
-        for audiopath in tqdm(self.audiopaths_sid_text):
-            try:
-                phoneme = self.phoneme_data[audiopath][0]
-                phoneme = phoneme.split(" ")
-                phoneme_ids = cleaned_text_to_sequence(phoneme, version)
-            except Exception:
-                print(f"{audiopath} not in self.phoneme_data !")
-                skipped_phone += 1
-                continue
-
-            size = os.path.getsize("%s/%s" % (self.path5, audiopath))
-            duration = size / self.sampling_rate / 2
-
-            if duration == 0:
-                print(f"Zero duration for {audiopath}, skipping...")
-                skipped_dur += 1
-                continue
-
-            if 54 > duration > 0.6 or self.val:
-                audiopaths_sid_text_new.append([audiopath, phoneme_ids])
-                lengths.append(size // (2 * self.hop_length))
-            else:
-                skipped_dur += 1
-                continue
-
-        print("skipped_phone: ", skipped_phone, ", skipped_dur: ", skipped_dur)
-        print("total left: ", len(audiopaths_sid_text_new))
-        assert len(audiopaths_sid_text_new) > 1  # 至少能凑够batch size，这里todo
-        self.audiopaths_sid_text = audiopaths_sid_text_new
-        self.lengths = lengths
+        self.audiopaths_sid_text, self.lengths = load_audio_index(self, exp_dir, version)
+        self.init_packed(exp_dir)
 
     def get_audio_text_speaker_pair(self, audiopath_sid_text):
         audiopath, phoneme_ids = audiopath_sid_text
         text = torch.FloatTensor(phoneme_ids)
         try:
-            spec, wav = self.get_audio("%s/%s" % (self.path5, audiopath))
+            spec, wav = self.get_audio_features(audiopath)
             with torch.no_grad():
-                ssl = torch.load("%s/%s.pt" % (self.path4, audiopath), map_location="cpu")
+                ssl = self.load_ssl(audiopath)
                 if ssl.shape[-1] != spec.shape[-1]:
                     typee = ssl.dtype
                     ssl = F.pad(ssl.float(), (0, 1), mode="replicate").to(typee)
                 ssl.requires_grad = False
                 if self.is_v2Pro:
-                    sv_emb = torch.load("%s/%s.pt" % (self.path7, audiopath), map_location="cpu")
+                    sv_emb = self.load_sv(audiopath)
         except:
             traceback.print_exc()
             spec = torch.zeros(1025, 100)
@@ -276,13 +364,15 @@ class TextAudioSpeakerCollate:
             )
 
 
-class TextAudioSpeakerLoaderV3(torch.utils.data.Dataset):
+class TextAudioSpeakerLoaderV3(PackedFeatureMixin, torch.utils.data.Dataset):
     """
     1) loads audio, speaker_id, text pairs
     2) normalizes text and converts them to sequences of integers
     3) computes spectrograms from audio files.
     """
 
+    packed_audio_fields = ("spec", "mel")
+
     def __init__(self, hparams, val=False):
         exp_dir = hparams.exp_dir
         self.path2 = "%s/2-name2text.txt" % exp_dir
@@ -291,74 +381,13 @@ class TextAudioSpeakerLoaderV3(torch.utils.data.Dataset):
         assert os.path.exists(self.path2)
         assert os.path.exists(self.path4)
         assert os.path.exists(self.path5)
-        names4 = set([name[:-3] for name in list(os.listdir(self.path4))])  # 去除.pt后缀
-        names5 = set(os.listdir(self.path5))
-        self.phoneme_data = {}
-        with open(self.path2, "r", encoding="utf8") as f:
-            lines = f.read().strip("\n").split("\n")
-
-        for line in lines:
-            tmp = line.split("\t")
-            if len(tmp) != 4:
-                continue
-            self.phoneme_data[tmp[0]] = [tmp[1]]
-
-        self.audiopaths_sid_text = list(set(self.phoneme_data) & names4 & names5)
-        tmp = self.audiopaths_sid_text
-        leng = len(tmp)
-        min_num = 100
-        if leng < min_num:
-            self.audiopaths_sid_text = []
-            for _ in range(max(2, int(min_num / leng))):
-                self.audiopaths_sid_text += tmp
         self.max_wav_value = hparams.max_wav_value
         self.sampling_rate = hparams.sampling_rate
         self.filter_length = hparams.filter_length
         self.hop_length = hparams.hop_length
         self.win_length = hparams.win_length
-        self.sampling_rate = hparams.sampling_rate
         self.val = val
-
-        random.seed(1234)
-        random.shuffle(self.audiopaths_sid_text)
-
-        print("phoneme_data_len:", len(self.phoneme_data.keys()))
-        print("wav_data_len:", len(self.audiopaths_sid_text))
-
-        audiopaths_sid_text_new = []
-        lengths = []
-        skipped_phone = 0
-        skipped_dur = 0
-        for audiopath in tqdm(self.audiopaths_sid_text):
-            try:
-                phoneme = self.phoneme_data[audiopath][0]
-                phoneme = phoneme.split(" ")
-                phoneme_ids = cleaned_text_to_sequence(phoneme, version)
-            except Exception:
-                print(f"{audiopath} not in self.phoneme_data !")
-                skipped_phone += 1
-                continue
-
-            size = os.path.getsize("%s/%s" % (self.path5, audiopath))
-            duration = size / self.sampling_rate / 2
-
-            if duration == 0:
-                print(f"Zero duration for {audiopath}, skipping...")
-                skipped_dur += 1
-                continue
-
-            if 54 > duration > 0.6 or self.val:
-                audiopaths_sid_text_new.append([audiopath, phoneme_ids])
-                lengths.append(size // (2 * self.hop_length))
-            else:
-                skipped_dur += 1
-                continue
-
-        print("skipped_phone: ", skipped_phone, ", skipped_dur: ", skipped_dur)
-        print("total left: ", len(audiopaths_sid_text_new))
-        assert len(audiopaths_sid_text_new) > 1  # 至少能凑够batch size，这里todo
-        self.audiopaths_sid_text = audiopaths_sid_text_new
-        self.lengths = lengths
+        self.audiopaths_sid_text, self.lengths = load_audio_index(self, exp_dir, version)
         self.spec_min = -12
         self.spec_max = 2
 
@@ -368,6 +397,7 @@ class TextAudioSpeakerLoaderV3(torch.utils.data.Dataset):
         self.sampling_rate_mel = 24000
         self.mel_fmin = 0
         self.mel_fmax = None
+        self.init_packed(exp_dir)
 
     def norm_spec(self, x):
         return (x - self.spec_min) / (self.spec_max - self.spec_min) * 2 - 1
@@ -376,9 +406,9 @@ class TextAudioSpeakerLoaderV3(torch.utils.data.Dataset):
         audiopath, phoneme_ids = audiopath_sid_text
         text = torch.FloatTensor(phoneme_ids)
         try:
-            spec, mel = self.get_audio("%s/%s" % (self.path5, audiopath))
+            spec, mel = self.get_audio_features(audiopath)
             with torch.no_grad():
-                ssl = torch.load("%s/%s.pt" % (self.path4, audiopath), map_location="cpu")
+                ssl = self.load_ssl(audiopath)
                 if ssl.shape[-1] != spec.shape[-1]:
                     typee = ssl.dtype
                     ssl = F.pad(ssl.float(), (0, 1), mode="replicate").to(typee)
@@ -514,13 +544,15 @@ class TextAudioSpeakerCollateV3:
         return ssl_padded, spec_padded, mel_padded, ssl_lengths, spec_lengths, text_padded, text_lengths, mel_lengths
 
 
-class TextAudioSpeakerLoaderV4(torch.utils.data.Dataset):
+class TextAudioSpeakerLoaderV4(PackedFeatureMixin, torch.utils.data.Dataset):
     """
     1) loads audio, speaker_id, text pairs
     2) normalizes text and converts them to sequences of integers
     3) computes spectrograms from audio files.
     """
 
+    packed_audio_fields = ("spec", "mel")
+
     def __init__(self, hparams, val=False):
         exp_dir = hparams.exp_dir
         self.path2 = "%s/2-name2text.txt" % exp_dir
@@ -529,74 +561,13 @@ class TextAudioSpeakerLoaderV4(torch.utils.data.Dataset):
         assert os.path.exists(self.path2)
         assert os.path.exists(self.path4)
         assert os.path.exists(self.path5)
-        names4 = set([name[:-3] for name in list(os.listdir(self.path4))])  # 去除.pt后缀
-        names5 = set(os.listdir(self.path5))
-        self.phoneme_data = {}
-        with open(self.path2, "r", encoding="utf8") as f:
-            lines = f.read().strip("\n").split("\n")
-
-        for line in lines:
-            tmp = line.split("\t")
-            if len(tmp) != 4:
-                continue
-            self.phoneme_data[tmp[0]] = [tmp[1]]
-
-        self.audiopaths_sid_text = list(set(self.phoneme_data) & names4 & names5)
-        tmp = self.audiopaths_sid_text
-        leng = len(tmp)
-        min_num = 100
-        if leng < min_num:
-            self.audiopaths_sid_text = []
-            for _ in range(max(2, int(min_num / leng))):
-                self.audiopaths_sid_text += tmp
         self.max_wav_value = hparams.max_wav_value
         self.sampling_rate = hparams.sampling_rate
         self.filter_length = hparams.filter_length
         self.hop_length = hparams.hop_length
         self.win_length = hparams.win_length
-        self.sampling_rate = hparams.sampling_rate
         self.val = val
-
-        random.seed(1234)
-        random.shuffle(self.audiopaths_sid_text)
-
-        print("phoneme_data_len:", len(self.phoneme_data.keys()))
-        print("wav_data_len:", len(self.audiopaths_sid_text))
-
-        audiopaths_sid_text_new = []
-        lengths = []
-        skipped_phone = 0
-        skipped_dur = 0
-        for audiopath in tqdm(self.audiopaths_sid_text):
-            try:
-                phoneme = self.phoneme_data[audiopath][0]
-                phoneme = phoneme.split(" ")
-                phoneme_ids = cleaned_text_to_sequence(phoneme, version)
-            except Exception:
-                print(f"{audiopath} not in self.phoneme_data !")
-                skipped_phone += 1
-                continue
-
-            size = os.path.getsize("%s/%s" % (self.path5, audiopath))
-            duration = size / self.sampling_rate / 2
-
-            if duration == 0:
-                print(f"Zero duration for {audiopath}, skipping...")
-                skipped_dur += 1
-                continue
-
-            if 54 > duration > 0.6 or self.val:
-                audiopaths_sid_text_new.append([audiopath, phoneme_ids])
-                lengths.append(size // (2 * self.hop_length))
-            else:
-                skipped_dur += 1
-                continue
-
-        print("skipped_phone: ", skipped_phone, ", skipped_dur: ", skipped_dur)
-        print("total left: ", len(audiopaths_sid_text_new))
-        assert len(audiopaths_sid_text_new) > 1  # 至少能凑够batch size，这里todo
-        self.audiopaths_sid_text = audiopaths_sid_text_new
-        self.lengths = lengths
+        self.audiopaths_sid_text, self.lengths = load_audio_index(self, exp_dir, version)
         self.spec_min = -12
         self.spec_max = 2
 
@@ -606,6 +577,7 @@ class TextAudioSpeakerLoaderV4(torch.utils.data.Dataset):
         self.sampling_rate_mel = 32000
         self.mel_fmin = 0
         self.mel_fmax = None
+        self.init_packed(exp_dir)
 
     def norm_spec(self, x):
         return (x - self.spec_min) / (self.spec_max - self.spec_min) * 2 - 1
@@ -614,9 +586,9 @@ class TextAudioSpeakerLoaderV4(torch.utils.data.Dataset):
         audiopath, phoneme_ids = audiopath_sid_text
         text = torch.FloatTensor(phoneme_ids)
         try:
-            spec, mel = self.get_audio("%s/%s" % (self.path5, audiopath))
+            spec, mel = self.get_audio_features(audiopath)
             with torch.no_grad():
-                ssl = torch.load("%s/%s.pt" % (self.path4, audiopath), map_location="cpu")
+                ssl = self.load_ssl(audiopath)
                 if ssl.shape[-1] != spec.shape[-1]:
                     typee = ssl.dtype
                     ssl = F.pad(ssl.float(), (0, 1), mode="replicate").to(typee)
@@ -725,13 +697,15 @@ class TextAudioSpeakerCollateV4:
         return ssl_padded, spec_padded, mel_padded, ssl_lengths, spec_lengths, text_padded, text_lengths, mel_lengths
 
 
-class TextAudioSpeakerLoaderV3b(torch.utils.data.Dataset):
+class TextAudioSpeakerLoaderV3b(PackedFeatureMixin, torch.utils.data.Dataset):
     """
     1) loads audio, speaker_id, text pairs
     2) normalizes text and converts them to sequences of integers
     3) computes spectrograms from audio files.
     """
 
+    packed_audio_fields = ("spec", "mel", "wav")
+
     def __init__(self, hparams, val=False):
         exp_dir = hparams.exp_dir
         self.path2 = "%s/2-name2text.txt" % exp_dir
@@ -740,74 +714,13 @@ class TextAudioSpeakerLoaderV3b(torch.utils.data.Dataset):
         assert os.path.exists(self.path2)
         assert os.path.exists(self.path4)
         assert os.path.exists(self.path5)
-        names4 = set([name[:-3] for name in list(os.listdir(self.path4))])  # 去除.pt后缀
-        names5 = set(os.listdir(self.path5))
-        self.phoneme_data = {}
-        with open(self.path2, "r", encoding="utf8") as f:
-            lines = f.read().strip("\n").split("\n")
-
-        for line in lines:
-            tmp = line.split("\t")
-            if len(tmp) != 4:
-                continue
-            self.phoneme_data[tmp[0]] = [tmp[1]]
-
-        self.audiopaths_sid_text = list(set(self.phoneme_data) & names4 & names5)
-        tmp = self.audiopaths_sid_text
-        leng = len(tmp)
-        min_num = 100
-        if leng < min_num:
-            self.audiopaths_sid_text = []
-            for _ in range(max(2, int(min_num / leng))):
-                self.audiopaths_sid_text += tmp
         self.max_wav_value = hparams.max_wav_value
         self.sampling_rate = hparams.sampling_rate
         self.filter_length = hparams.filter_length
         self.hop_length = hparams.hop_length
         self.win_length = hparams.win_length
-        self.sampling_rate = hparams.sampling_rate
         self.val = val
-
-        random.seed(1234)
-        random.shuffle(self.audiopaths_sid_text)
-
-        print("phoneme_data_len:", len(self.phoneme_data.keys()))
-        print("wav_data_len:", len(self.audiopaths_sid_text))
-
-        audiopaths_sid_text_new = []
-        lengths = []
-        skipped_phone = 0
-        skipped_dur = 0
-        for audiopath in tqdm(self.audiopaths_sid_text):
-            try:
-                phoneme = self.phoneme_data[audiopath][0]
-                phoneme = phoneme.split(" ")
-                phoneme_ids = cleaned_text_to_sequence(phoneme, version)
-            except Exception:
-                print(f"{audiopath} not in self.phoneme_data !")
-                skipped_phone += 1
-                continue
-
-            size = os.path.getsize("%s/%s" % (self.path5, audiopath))
-            duration = size / self.sampling_rate / 2
-
-            if duration == 0:
-                print(f"Zero duration for {audiopath}, skipping...")
-                skipped_dur += 1
-                continue
-
-            if 54 > duration > 0.6 or self.val:
-                audiopaths_sid_text_new.append([audiopath, phoneme_ids])
-                lengths.append(size // (2 * self.hop_length))
-            else:
-                skipped_dur += 1
-                continue
-
-        print("skipped_phone: ", skipped_phone, ", skipped_dur: ", skipped_dur)
-        print("total left: ", len(audiopaths_sid_text_new))
-        assert len(audiopaths_sid_text_new) > 1  # 至少能凑够batch size，这里todo
-        self.audiopaths_sid_text = audiopaths_sid_text_new
-        self.lengths = lengths
+        self.audiopaths_sid_text, self.lengths = load_audio_index(self, exp_dir, version)
         self.spec_min = -12
         self.spec_max = 2
 
@@ -817,6 +730,7 @@ class TextAudioSpeakerLoaderV3b(torch.utils.data.Dataset):
         self.sampling_rate_mel = 24000
         self.mel_fmin = 0
         self.mel_fmax = None
+        self.init_packed(exp_dir)
 
     def norm_spec(self, x):
         return (x - self.spec_min) / (self.spec_max - self.spec_min) * 2 - 1
@@ -825,9 +739,9 @@ class TextAudioSpeakerLoaderV3b(torch.utils.data.Dataset):
         audiopath, phoneme_ids = audiopath_sid_text
         text = torch.FloatTensor(phoneme_ids)
         try:
-            spec, mel, wav = self.get_audio("%s/%s" % (self.path5, audiopath))
+            spec, mel, wav = self.get_audio_features(audiopath)
             with torch.no_grad():
-                ssl = torch.load("%s/%s.pt" % (self.path4, audiopath), map_location="cpu")
+                ssl = self.load_ssl(audiopath)
                 if ssl.shape[-1] != spec.shape[-1]:
                     typee = ssl.dtype
                     ssl = F.pad(ssl.float(), (0, 1), mode="replicate").to(typee)
@@ -1069,3 +983,26 @@ class DistributedBucketSampler(torch.utils.data.distributed.DistributedSampler):
 
     def __len__(self):
         return self.num_samples // self.batch_size
+
+
+class DistributedFrameBucketSampler(DistributedTokenBatchSampler):
+    """
+    DistributedBucketSampler 的按帧数组 batch 版本: 每个 batch 的 (最长 spec 帧数 × 条数) 不超过 max_frames,
+    短句自动多放几条, 长句少放, 显存占用由 max_frames 决定而不是最长的那个桶.
+    boundaries 只用来和 DistributedBucketSampler 一样丢弃过短/过长的样本.
+    作为 batch_sampler 传给 DataLoader, 每个 epoch 打印一次 padding 效率.
+    """
+
+    def __init__(
+        self, dataset, max_frames, boundaries=None, num_replicas=None, rank=None, shuffle=True, max_batch_size=None
+    ):
+        super().__init__(
+            dataset.lengths,
+            max_frames,
+            num_replicas=num_replicas,
+            rank=rank,
+            shuffle=shuffle,
+            max_batch_size=max_batch_size,
+            min_length=boundaries[0] if boundaries else None,
+            max_length=boundaries[-1] if boundaries else None,
+        )
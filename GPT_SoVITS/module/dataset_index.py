@@ -0,0 +1,88 @@
+"""
+数据集索引缓存
+
+TextAudioSpeakerLoader* 与 Text2SemanticDataset 构造时要列目录、解析 2-name2text.txt / 6-name2semantic.tsv、
+逐条 os.path.getsize 估算时长并过滤, 数据集大时开训前要等好几分钟, 每次重启、每个 rank 都要重来一遍.
+这里把构造结果 (名字、长度、音素 id、过滤结果) 缓存成 <exp_dir>/index/<kind>-<参数哈希>.pkl:
+- 参数 (版本、采样率、过滤阈值等) 不同时用不同的缓存文件, 互不覆盖
+- 记录源文件/目录的 mtime (文件还有大小), 任何一个变了就重建; 目录只看 mtime, 即增删文件才会触发,
+  原地覆盖 5-wav32k 里的音频不会, 不过重新预处理时 2-name2text.txt 总会重写, 仍能触发重建
+- 设置环境变量 dataset_index=0 可跳过缓存
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+INDEX_DIR = "index"
+INDEX_VERSION = 2
+INDEX_WORKERS = int(os.environ.get("dataset_index_workers", 16))
+
+
+def source_signature(paths):
+    signature = {}
+    for path in paths:
+        if not os.path.exists(path):
+            signature[path] = None
+        elif os.path.isdir(path):
+            signature[path] = [os.stat(path).st_mtime_ns]
+        else:
+            stat = os.stat(path)
+            signature[path] = [stat.st_mtime_ns, stat.st_size]
+    return signature
+
+
+def index_path(root, kind, params):
+    key = hashlib.md5(json.dumps(params, sort_keys=True).encode("utf8")).hexdigest()[:10]
+    return os.path.join(root, INDEX_DIR, "%s-%s.pkl" % (kind, key))
+
+
+def load_or_build(root, kind, params, sources, build):
+    """
+    缓存有效时直接返回缓存的数据, 否则调用 build() 重建并写入缓存.
+    params 需可 json 序列化; sources 为决定索引内容的源文件/目录.
+    """
+    path = index_path(root, kind, params)
+    # 先取签名再构建, 构建期间源文件有变化时下次会重建
+    signature = source_signature(sources)
+    use_cache = os.environ.get("dataset_index", "1") != "0"
+    if use_cache and os.path.exists(path):
+        try:
+            with open(path, "rb") as f:
+                index = pickle.load(f)
+            if index["version"] == INDEX_VERSION and index["params"] == params and index["sources"] == signature:
+                print("使用数据集索引缓存: %s" % path)
+                return index["data"]
+            print("数据集索引已过期, 重建: %s" % path)
+        except Exception:
+            traceback.print_exc()
+    data = build()
+    if use_cache:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 多个 rank 同时构建时各写各的临时文件, 最后原子替换
+            tmp_path = "%s.%s.tmp" % (path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                pickle.dump(
+                    {"version": INDEX_VERSION, "params": params, "sources": signature, "data": data},
+                    f,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+            os.replace(tmp_path, path)
+        except Exception:
+            traceback.print_exc()
+    return data
+
+
+def parallel_map(fn, items, num_workers=INDEX_WORKERS, chunk_size=1024):
+    """按块在线程池里执行 fn (适合 os.stat 这类 IO), 结果按输入顺序返回"""
+    items = list(items)
+    chunks = [items[i : i + chunk_size] for i in range(0, len(items), chunk_size)]
+    if len(chunks) <= 1 or num_workers <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        results = pool.map(lambda chunk: [fn(item) for item in chunk], chunks)
+        return [result for chunk in results for result in chunk]
@@ -223,13 +223,30 @@ class TextEncoder(nn.Module):
         text = self.encoder_text(text * text_mask, text_mask)
         y = self.mrte(y, y_mask, text, text_mask, ge)
         y = self.encoder2(y * y_mask, y_mask)
-        if speed != 1:
+        if isinstance(speed, (list, tuple)):
+            y, y_mask = self.interpolate_lengths(y, y_lengths, speed)
+        elif speed != 1:
             y = F.interpolate(y, size=int(y.shape[-1] / speed) + 1, mode="linear")
             y_mask = F.interpolate(y_mask, size=y.shape[-1], mode="nearest")
         stats = self.proj(y) * y_mask
         m, logs = torch.split(stats, self.out_channels, dim=1)
         return y, m, logs, y_mask
 
+    @staticmethod
+    def interpolate_lengths(y, y_lengths, speed):
+        """Stretch each padded item over its own length by its own speed, returns the re-padded batch and mask."""
+        items = []
+        for item, length, item_speed in zip(y, y_lengths.tolist(), speed):
+            item = item[:, :length].unsqueeze(0)
+            if item_speed != 1:
+                item = F.interpolate(item, size=int(length / item_speed) + 1, mode="linear")
+            items.append(item[0])
+        lengths = torch.LongTensor([item.shape[-1] for item in items]).to(y.device)
+        max_len = int(lengths.max())
+        y = torch.stack([F.pad(item, (0, max_len - item.shape[-1])) for item in items])
+        y_mask = torch.unsqueeze(commons.sequence_mask(lengths, max_len), 1).to(y.dtype)
+        return y * y_mask, y_mask
+
     def extract_latent(self, x):
         x = self.ssl_proj(x)
         quantized, codes, commit_loss, quantized_list = self.quantizer(x)
@@ -420,6 +437,7 @@ class Generator(torch.nn.Module):
         super(Generator, self).__init__()
         self.num_kernels = len(resblock_kernel_sizes)
         self.num_upsamples = len(upsample_rates)
+        self.upsample_rates = upsample_rates
         self.conv_pre = Conv1d(initial_channel, upsample_initial_channel, 7, 1, padding=3)
         resblock = modules.ResBlock1 if resblock == "1" else modules.ResBlock2
 
@@ -449,20 +467,26 @@ class Generator(torch.nn.Module):
         if gin_channels != 0:
             self.cond = nn.Conv1d(gin_channels, upsample_initial_channel, 1)
 
-    def forward(self, x, g=None):
+    def forward(self, x, g=None, x_mask=None):
+        # x_mask: [B, 1, T] for padded batches, keeps each item's tail identical to decoding it alone
         x = self.conv_pre(x)
         if g is not None:
             x = x + self.cond(g)
+        if x_mask is not None:
+            x = x * x_mask
 
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, modules.LRELU_SLOPE)
             x = self.ups[i](x)
+            if x_mask is not None:
+                x_mask = torch.repeat_interleave(x_mask, self.upsample_rates[i], dim=2)
+                x = x * x_mask
             xs = None
             for j in range(self.num_kernels):
                 if xs is None:
-                    xs = self.resblocks[i * self.num_kernels + j](x)
+                    xs = self.resblocks[i * self.num_kernels + j](x, x_mask)
                 else:
-                    xs += self.resblocks[i * self.num_kernels + j](x)
+                    xs += self.resblocks[i * self.num_kernels + j](x, x_mask)
             x = xs / self.num_kernels
         x = F.leaky_relu(x)
         x = self.conv_post(x)
@@ -957,8 +981,9 @@ class SynthesizerTrn(nn.Module):
         o = self.dec((z * y_mask)[:, :, :], g=ge)
         return o, y_mask, (z, z_p, m_p, logs_p)
 
-    @torch.no_grad()
-    def decode(self, codes, text, refer, noise_scale=0.5, speed=1, sv_emb=None):
+    def get_ge(self, refer, sv_emb=None):
+        """Speaker embedding of one reference spectrogram, or the mean over a list of them."""
+
         def get_ge(refer, sv_emb):
             ge = None
             if refer is not None:
@@ -979,9 +1004,12 @@ class SynthesizerTrn(nn.Module):
             for idx, _refer in enumerate(refer):
                 ge = get_ge(_refer, sv_emb[idx] if self.is_v2pro else None)
                 ges.append(ge)
-            ge = torch.stack(ges, 0).mean(0)
-        else:
-            ge = get_ge(refer, sv_emb)
+            return torch.stack(ges, 0).mean(0)
+        return get_ge(refer, sv_emb)
+
+    @torch.no_grad()
+    def decode(self, codes, text, refer, noise_scale=0.5, speed=1, sv_emb=None):
+        ge = self.get_ge(refer, sv_emb)
 
         y_lengths = torch.LongTensor([codes.size(2) * 2]).to(codes.device)
         text_lengths = torch.LongTensor([text.size(-1)]).to(text.device)
@@ -1004,6 +1032,84 @@ class SynthesizerTrn(nn.Module):
         o = self.dec((z * y_mask)[:, :, :], g=ge)
         return o
 
+    @torch.no_grad()
+    def decode_streaming(
+        self, codes, text, refer, noise_scale=0.5, speed=1, sv_emb=None, chunk_size=40, overlap=4, padding=32
+    ):
+        """
+        Decode one sentence window by window. enc_p runs once over the whole sentence; the flow and the Generator run
+        on windows of chunk_size latent frames, extended by `padding` frames of real context on both sides to cover
+        their receptive field and by `overlap` frames on the left for cross-fading.
+        Yields waveforms; every one after the first starts with overlap * prod(upsample_rates) samples that overlap
+        the end of the previous one.
+        """
+        ge = self.get_ge(refer, sv_emb)
+
+        y_lengths = torch.LongTensor([codes.size(2) * 2]).to(codes.device)
+        text_lengths = torch.LongTensor([text.size(-1)]).to(text.device)
+
+        quantized = self.quantizer.decode(codes)
+        if self.semantic_frame_rate == "25hz":
+            quantized = F.interpolate(quantized, size=int(quantized.shape[-1] * 2), mode="nearest")
+        x, m_p, logs_p, y_mask = self.enc_p(
+            quantized,
+            y_lengths,
+            text,
+            text_lengths,
+            self.ge_to512(ge.transpose(2, 1)).transpose(2, 1) if self.is_v2pro else ge,
+            speed,
+        )
+        z_p = m_p + torch.randn_like(m_p) * torch.exp(logs_p) * noise_scale
+
+        upsample = math.prod(self.upsample_rates)
+        total = z_p.shape[-1]
+        for start in range(0, total, chunk_size):
+            end = min(start + chunk_size, total)
+            out_start = max(0, start - overlap)
+            win_start = max(0, out_start - padding)
+            win_end = min(total, end + padding)
+            mask = y_mask[:, :, win_start:win_end]
+            z = self.flow(z_p[:, :, win_start:win_end], mask, g=ge, reverse=True)
+            o = self.dec(z * mask, g=ge)
+            yield o[0, 0, (out_start - win_start) * upsample : (end - win_start) * upsample]
+
+    @torch.no_grad()
+    def batched_decode(
+        self, codes, codes_lengths, text, text_lengths, refer, noise_scale=0.5, speed=1, sv_emb=None, ge=None
+    ):
+        """
+        Decode a padded batch in one pass, each item masked so it does not see its neighbours.
+        codes: [1, B, T] semantic tokens with lengths codes_lengths [B]; text: [B, L] with lengths text_lengths [B];
+        speed: one value for all items or one per item; ge is computed once from refer/sv_emb when not given.
+        Returns a list of B waveforms [T_i].
+        """
+        if ge is None:
+            ge = self.get_ge(refer, sv_emb)
+        bsz = codes.size(1)
+        if not isinstance(speed, (list, tuple)):
+            speed = [speed] * bsz
+        ge = ge.expand(bsz, -1, -1)
+
+        y_lengths = codes_lengths * 2
+        quantized = self.quantizer.decode(codes)
+        if self.semantic_frame_rate == "25hz":
+            quantized = F.interpolate(quantized, size=int(quantized.shape[-1] * 2), mode="nearest")
+        x, m_p, logs_p, y_mask = self.enc_p(
+            quantized,
+            y_lengths,
+            text,
+            text_lengths,
+            self.ge_to512(ge.transpose(2, 1)).transpose(2, 1) if self.is_v2pro else ge,
+            list(speed),
+        )
+        z_p = m_p + torch.randn_like(m_p) * torch.exp(logs_p) * noise_scale
+
+        z = self.flow(z_p, y_mask, g=ge, reverse=True)
+
+        o = self.dec(z * y_mask, g=ge, x_mask=y_mask)
+        audio_lengths = (y_mask.sum([1, 2]).long() * math.prod(self.upsample_rates)).tolist()
+        return [o[i, 0, :length] for i, length in enumerate(audio_lengths)]
+
     def extract_latent(self, x):
         ssl = self.ssl_proj(x)
         quantized, codes, commit_loss, quantized_list = self.quantizer(ssl)
@@ -0,0 +1,200 @@
+"""
+打包训练数据集
+
+训练时 TextAudioSpeakerLoader* 每个 epoch 都要逐条 torch.load 4-cnhubert 小文件、解码 5-wav32k、算 STFT,
+Text2SemanticDataset 逐条 torch.load 3-bert. 小文件多的文件系统上数据加载会拖慢训练.
+这里把这些特征预先算好, 按字段写进少量大分片 (格式见 AR/data/feature_shards.py):
+
+    <exp_dir>/8-packed/
+        meta.json           格式版本、loader 类型及频谱参数, 最后写入
+        ssl-0000.bin/.json  4-cnhubert 特征
+        spec-*, wav-*, mel-*  loader.get_audio 的输出 (按 loader 类型)
+        sv-*                7-sv_cn 说话人向量 (v2Pro)
+        bert-*              3-bert 特征
+
+loader 发现 8-packed 且参数一致时直接从 memmap 零拷贝读取, 否则照旧读原始文件.
+频谱由 loader 自己的 get_audio 计算后存盘, 与现算结果一致; 32k 波形无损时按 int16 存储.
+
+只打包训练中逐条读取的张量特征, 不是完整的数据集格式: 音素 id (2-name2text.txt) 与语义 id (6-name2semantic.tsv)
+不在分片中, 仍由 loader 在初始化时从原文件解析一次 (解析结果由 module/dataset_index.py 缓存), 这两个文件需要保留.
+
+python GPT_SoVITS/module/packed_dataset.py -e <exp_dir> -c <s2 config> -v <version> [--no_spec]
+"""
+
+import json
+import os
+import shutil
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
+
+import torch
+
+# to import modules from GPT_SoVITS when run as a script
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from AR.data.feature_shards import SHARD_BYTES, ShardReader, ShardWriter, has_shards
+
+PACKED_DIR = "8-packed"
+FORMAT_VERSION = 1
+
+
+class PackedDataset:
+    def __init__(self, root: str):
+        self.root = root
+        with open(os.path.join(root, "meta.json"), "r", encoding="utf8") as f:
+            self.meta = json.load(f)
+        self.readers: Dict[str, ShardReader] = {
+            field: ShardReader(root, prefix=field) for field in self.meta["fields"] if has_shards(root, prefix=field)
+        }
+
+    def has(self, field: str, name: str) -> bool:
+        reader = self.readers.get(field)
+        return reader is not None and name in reader
+
+    def has_all(self, fields: Iterable[str], name: str) -> bool:
+        return all(self.has(field, name) for field in fields)
+
+    def get(self, field: str, name: str) -> Optional[torch.Tensor]:
+        reader = self.readers.get(field)
+        if reader is None:
+            return None
+        tensor = reader.get(name, copy=False)
+        if tensor is not None and field == "wav" and tensor.dtype == torch.int16:
+            tensor = tensor.float() / 32768
+        return tensor
+
+
+def open_packed(exp_dir: str, loader: Optional[str] = None, params: Optional[dict] = None) -> Optional[PackedDataset]:
+    """
+    打包数据存在且与当前 loader 类型/频谱参数一致时返回 PackedDataset, 否则返回 None.
+    loader 为 None 时只检查格式版本 (如 GPT 训练只读其中的 bert/ssl, 与频谱参数无关).
+    """
+    root = os.path.join(exp_dir, PACKED_DIR)
+    if not os.path.exists(os.path.join(root, "meta.json")):
+        return None
+    try:
+        packed = PackedDataset(root)
+    except Exception:
+        traceback.print_exc()
+        return None
+    meta = packed.meta
+    if meta.get("format") != FORMAT_VERSION or (
+        loader is not None and (meta.get("loader") != loader or meta.get("params") != params)
+    ):
+        print("%s 与当前配置不一致, 忽略打包数据, 可重新运行 module/packed_dataset.py" % root)
+        return None
+    print("使用打包数据: %s" % root)
+    return packed
+
+
+def _lossless_int16(wav: torch.Tensor) -> Optional[torch.Tensor]:
+    scaled = wav * 32768
+    rounded = torch.round(scaled)
+    if torch.equal(scaled, rounded) and rounded.abs().max() <= 32767:
+        return rounded.to(torch.int16)
+    return None
+
+
+def pack_dataset(loader, exp_dir: str, with_spec: bool = True, num_workers: int = 4, max_bytes: int = SHARD_BYTES):
+    """
+    用 loader (TextAudioSpeakerLoader* 实例) 自己的 get_audio 计算音频特征并连同 ssl/sv/bert 一起打包.
+    已有的 8-packed 会被覆盖.
+    """
+    root = os.path.join(exp_dir, PACKED_DIR)
+    loader.packed = None
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    os.makedirs(root)
+
+    names = sorted(set(item[0] for item in loader.audiopaths_sid_text))
+    audio_fields = [field for field in loader.packed_audio_fields if with_spec or field != "spec"]
+    fields = ["ssl"] + audio_fields
+    if getattr(loader, "is_v2Pro", False):
+        fields.append("sv")
+    bert_dir = "%s/3-bert" % exp_dir
+    bert_shards = ShardReader(bert_dir) if has_shards(bert_dir) else None
+    fields.append("bert")
+    writers = {field: ShardWriter(root, field, max_bytes) for field in fields}
+
+    def compute(name):
+        out = {"ssl": torch.load("%s/%s.pt" % (loader.path4, name), map_location="cpu")}
+        features = loader.get_audio("%s/%s" % (loader.path5, name))
+        for field, value in zip(loader.packed_audio_fields, features):
+            if field in audio_fields:
+                out[field] = value
+        if "wav" in out:
+            wav16 = _lossless_int16(out["wav"])
+            if wav16 is not None:
+                out["wav"] = wav16
+        if "sv" in fields:
+            out["sv"] = torch.load("%s/%s.pt" % (loader.path7, name), map_location="cpu")
+        path_bert = "%s/%s.pt" % (bert_dir, name)
+        if os.path.exists(path_bert):
+            out["bert"] = torch.load(path_bert, map_location="cpu")
+        elif bert_shards is not None and name in bert_shards:
+            out["bert"] = bert_shards.get(name)
+        return name, out
+
+    def safe_compute(name):
+        try:
+            return compute(name)
+        except Exception:
+            print(name, traceback.format_exc())
+            return name, None
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+        for i, (name, out) in enumerate(pool.map(safe_compute, names)):
+            if out is None:
+                failed += 1
+                continue
+            for field, value in out.items():
+                writers[field].add(name, value)
+            if (i + 1) % 1000 == 0:
+                print("packed %s/%s" % (i + 1, len(names)))
+    for writer in writers.values():
+        writer.close()
+
+    meta = {
+        "format": FORMAT_VERSION,
+        "loader": type(loader).__name__,
+        "params": loader.packed_params(),
+        "fields": fields,
+        "num_items": len(names) - failed,
+    }
+    tmp_path = os.path.join(root, "meta.json.tmp")
+    with open(tmp_path, "w", encoding="utf8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, os.path.join(root, "meta.json"))
+    print("packed %s items into %s (%s failed)" % (meta["num_items"], root, failed))
+    return meta
+
+
+if __name__ == "__main__":
+    import argparse
+    from types import SimpleNamespace
+
+    parser = argparse.ArgumentParser(description="Pack SoVITS/GPT training features into memory-mapped shards")
+    parser.add_argument("-e", "--exp_dir", required=True, help="experiment dir (contains 2-name2text.txt)")
+    parser.add_argument("-c", "--config", default="GPT_SoVITS/configs/s2.json", help="s2 config json")
+    parser.add_argument("-v", "--version", default="v2", help="v1/v2/v2Pro/v2ProPlus/v3/v4")
+    parser.add_argument("-w", "--num_workers", type=int, default=4)
+    parser.add_argument("--no_spec", action="store_true", help="do not store spectrograms (much smaller)")
+    args = parser.parse_args()
+
+    os.environ["version"] = args.version
+    sys.path.append(os.getcwd())
+    from module import data_utils
+
+    with open(args.config, "r", encoding="utf8") as f:
+        data = json.load(f)["data"]
+    hparams = SimpleNamespace(exp_dir=args.exp_dir, **data)
+    if args.version == "v3":
+        loader = data_utils.TextAudioSpeakerLoaderV3(hparams, val=True)
+    elif args.version == "v4":
+        loader = data_utils.TextAudioSpeakerLoaderV4(hparams, val=True)
+    else:
+        loader = data_utils.TextAudioSpeakerLoader(hparams, version=args.version, val=True)
+    pack_dataset(loader, args.exp_dir, with_spec=not args.no_spec, num_workers=args.num_workers)
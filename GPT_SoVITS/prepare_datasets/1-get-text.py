@@ -33,6 +33,12 @@ from tools.my_utils import clean_path
 from time import time as ttime
 import shutil
 
+# 批量模式: g2p 分发到进程池, 中文 BERT 按长度分桶补齐后批量前向, 特征写进 3-bert 下的分片容器
+# 而不是每条一个 .pt (训练时 Text2SemanticDataset 两种都能读). 输出可用 AR/data/feature_shards.py 与逐条模式比对.
+batch_mode = eval(os.environ.get("text_batch_mode", "False"))
+g2p_workers = int(os.environ.get("g2p_workers", str(max(1, (os.cpu_count() or 2) // 2))))
+bert_batch_size = int(os.environ.get("bert_batch_size", "16"))
+
 
 def my_save(fea, path):  #####fix issue: torch.save doesn't support chinese path
     dir = os.path.dirname(path)
@@ -43,8 +49,18 @@ def my_save(fea, path):  #####fix issue: torch.save doesn't support chinese path
     shutil.move(tmp_path, "%s/%s" % (dir, name))
 
 
+def clean_text_worker(item):
+    """进程池中执行的 g2p, 返回 (结果, 错误信息)"""
+    name, text, lan = item
+    try:
+        return clean_text(text.replace("%", "-").replace("￥", ","), lan, version), None
+    except:
+        return None, traceback.format_exc()
+
+
 txt_path = "%s/2-name2text-%s.txt" % (opt_dir, i_part)
-if os.path.exists(txt_path) == False:
+# 进程池子进程 (spawn) 会重新导入本脚本, 只在主进程中执行
+if __name__ == "__main__" and os.path.exists(txt_path) == False:
     bert_dir = "%s/3-bert" % (opt_dir)
     os.makedirs(opt_dir, exist_ok=True)
     os.makedirs(bert_dir, exist_ok=True)
@@ -102,6 +118,78 @@ if os.path.exists(txt_path) == False:
             except:
                 print(name, text, traceback.format_exc())
 
+    def get_bert_features(texts, word2phs):
+        """补齐后批量前向, 每条有效 token 的结果与逐条 get_bert_feature 一致"""
+        with torch.no_grad():
+            inputs = tokenizer(texts, return_tensors="pt", padding=True)
+            lengths = inputs["attention_mask"].sum(-1).tolist()
+            for i in inputs:
+                inputs[i] = inputs[i].to(device)
+            res = bert_model(**inputs, output_hidden_states=True)
+            hidden = torch.cat(res["hidden_states"][-3:-2], -1).cpu()
+
+        features = []
+        for i, (text, word2ph) in enumerate(zip(texts, word2phs)):
+            assert len(word2ph) == len(text)
+            token_feature = hidden[i, 1 : lengths[i] - 1]
+            phone_level_feature = []
+            for j in range(len(word2ph)):
+                repeat_feature = token_feature[j].repeat(word2ph[j], 1)
+                phone_level_feature.append(repeat_feature)
+            features.append(torch.cat(phone_level_feature, dim=0).T)
+        return features
+
+    def process_batch(data, res):
+        from concurrent.futures import ProcessPoolExecutor
+
+        from AR.data.feature_shards import ShardReader, ShardWriter
+
+        names = [os.path.basename(clean_path(name)) for name, text, lan in data]
+        if g2p_workers > 1 and len(data) > 1:
+            with ProcessPoolExecutor(max_workers=g2p_workers) as pool:
+                cleaned = list(pool.map(clean_text_worker, data, chunksize=16))
+        else:
+            cleaned = [clean_text_worker(item) for item in data]
+
+        done = set(ShardReader(bert_dir).names())
+        bert_todo = []
+        for name, (_, text, lan), (result, error) in zip(names, data, cleaned):
+            print(name)
+            if error is not None:
+                print(name, text, error)
+                continue
+            phones, word2ph, norm_text = result
+            if lan == "zh" and name not in done and os.path.exists("%s/%s.pt" % (bert_dir, name)) == False:
+                bert_todo.append((name, phones, word2ph, norm_text))
+            res.append([name, " ".join(phones), word2ph, norm_text])
+
+        # 按 token 数排序分桶, 减少补齐
+        bert_todo.sort(key=lambda item: len(item[3]))
+        writer = ShardWriter(bert_dir, "bert-%s" % i_part)
+        failed = set()
+        for start in range(0, len(bert_todo), bert_batch_size):
+            batch = bert_todo[start : start + bert_batch_size]
+            try:
+                features = get_bert_features([item[3] for item in batch], [item[2] for item in batch])
+            except:
+                print(traceback.format_exc())
+                features = []
+                for item in batch:  # 整批失败时逐条重试
+                    try:
+                        features.append(get_bert_feature(item[3], item[2]))
+                    except:
+                        print(item[0], item[3], traceback.format_exc())
+                        features.append(None)
+            for (name, phones, word2ph, norm_text), bert_feature in zip(batch, features):
+                if bert_feature is None or bert_feature.shape[-1] != len(phones):
+                    print(name, norm_text, "bert feature length mismatch")
+                    failed.add(name)
+                    continue
+                writer.add(name, bert_feature)
+        writer.close()
+        # 与逐条模式一致: 提取失败的条目不写入 2-name2text
+        res[:] = [item for item in res if item[0] not in failed]
+
     todo = []
     res = []
     with open(inp_text, "r", encoding="utf8") as f:
@@ -135,7 +223,10 @@ if os.path.exists(txt_path) == False:
         except:
             print(line, traceback.format_exc())
 
-    process(todo, res)
+    if batch_mode:
+        process_batch(todo, res)
+    else:
+        process(todo, res)
     opt = []
     for name, phones, word2ph, norm_text in res:
         opt.append("%s\t%s\t%s\t%s" % (name, phones, word2ph, norm_text))
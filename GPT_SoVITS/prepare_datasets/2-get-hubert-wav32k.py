@@ -40,6 +40,7 @@ from tools.my_utils import load_audio, clean_path
 
 from time import time as ttime
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 
 def my_save(fea, path):  #####fix issue: torch.save doesn't support chinese path
@@ -72,42 +73,130 @@ if is_half == True:
 else:
     model = model.to(device)
 
+# 批量提取: 解码/重采样线程池 -> 按时长排序分桶补齐 -> CNHuBERT 批量前向 -> 后台线程写盘
+batch_size = int(os.environ.get("hubert_batch_size", "8"))
+num_workers = int(os.environ.get("hubert_num_workers", "4"))
+max_batch_seconds = float(os.environ.get("hubert_max_batch_seconds", "120"))  # 每批补齐后的总时长上限(16k)
+window_batches = 8  # 每次取多少批的音频一起排序分桶
+
 nan_fails = []
+save_futures = []  # (wav_name, 写盘的 future), 由 check_saves 取回结果
 
 
-def name2go(wav_name, wav_path):
+def prepare(wav_name, wav_path):
+    """解码+响度归一+重采样, 返回 (wav_name, tmp_audio32, tmp_audio16); 已提取或被过滤时返回 None"""
     hubert_path = "%s/%s.pt" % (hubert_dir, wav_name)
     if os.path.exists(hubert_path):
-        return
+        return None
     tmp_audio = load_audio(wav_path, 32000)
     tmp_max = np.abs(tmp_audio).max()
     if tmp_max > 2.2:
         print("%s-filtered,%s" % (wav_name, tmp_max))
-        return
+        return None
     tmp_audio32 = (tmp_audio / tmp_max * (maxx * alpha * 32768)) + ((1 - alpha) * 32768) * tmp_audio
     tmp_audio32b = (tmp_audio / tmp_max * (maxx * alpha * 1145.14)) + ((1 - alpha) * 1145.14) * tmp_audio
     tmp_audio = librosa.resample(tmp_audio32b, orig_sr=32000, target_sr=16000)  # 不是重采样问题
-    tensor_wav16 = torch.from_numpy(tmp_audio)
-    if is_half == True:
-        tensor_wav16 = tensor_wav16.half().to(device)
+    return wav_name, tmp_audio32, tmp_audio
+
+
+def hubert_forward(wavs16):
+    """
+    补齐后批量前向, 返回每条的 [768, T] 特征.
+    chinese-hubert-base 的卷积特征提取层用 GroupNorm (按整条音频统计), 补零会改变结果,
+    所以卷积部分逐条跑, 补齐与 attention mask 只用在之后逐帧的投影层和 Transformer 编码器上,
+    有效帧的结果与逐条提取一致 (编码器会把补齐帧置零, 与逐条时位置卷积的零填充相同).
+    """
+    hubert = model.model
+    dtype = next(hubert.parameters()).dtype
+    tensors = [torch.from_numpy(wav).to(device=device, dtype=dtype) for wav in wavs16]
+    if hubert.config.feat_extract_norm == "layer":
+        lengths = hubert._get_feat_extract_output_lengths(torch.LongTensor([len(wav) for wav in tensors])).tolist()
+        feats = hubert.feature_extractor(torch.nn.utils.rnn.pad_sequence(tensors, batch_first=True)).transpose(1, 2)
     else:
-        tensor_wav16 = tensor_wav16.to(device)
-    ssl = model.model(tensor_wav16.unsqueeze(0))["last_hidden_state"].transpose(1, 2).cpu()  # torch.Size([1, 768, 215])
-    if np.isnan(ssl.detach().numpy()).sum() != 0:
-        nan_fails.append((wav_name, wav_path))
-        print("nan filtered:%s" % wav_name)
-        return
+        feats = [hubert.feature_extractor(wav.unsqueeze(0))[0].transpose(0, 1) for wav in tensors]
+        lengths = [fea.shape[0] for fea in feats]
+        feats = torch.nn.utils.rnn.pad_sequence(feats, batch_first=True)
+    max_len = feats.shape[1]
+    attention_mask = torch.arange(max_len, device=device).unsqueeze(0) < torch.LongTensor(lengths).to(device).unsqueeze(1)
+    hidden_states = hubert.feature_projection(feats)
+    hidden_states = hubert.encoder(hidden_states, attention_mask=attention_mask)[0]
+    hidden_states = hidden_states.transpose(1, 2).cpu()  # torch.Size([B, 768, T])
+    return [hidden_states[i : i + 1, :, : lengths[i]].clone() for i in range(len(lengths))]
+
+
+def save_outputs(wav_name, tmp_audio32, ssl):
+    hubert_path = "%s/%s.pt" % (hubert_dir, wav_name)
     wavfile.write(
         "%s/%s" % (wav32dir, wav_name),
         32000,
         tmp_audio32.astype("int16"),
     )
-    my_save(ssl, hubert_path)
+    my_save(ssl, hubert_path)  # 最后写 .pt, 中断后据此续跑
+
+
+def run_batch(items, writer, keep_nan):
+    with torch.no_grad():
+        ssls = hubert_forward([item[2] for item in items])
+    for (wav_name, tmp_audio32, tmp_audio16), ssl in zip(items, ssls):
+        if torch.isnan(ssl).any():
+            if keep_nan:
+                nan_fails.append((wav_name, tmp_audio32, tmp_audio16))  # 音频留在内存里, fp32 重试时不必重新解码
+            print("nan filtered:%s" % wav_name)
+            continue
+        save_futures.append((wav_name, writer.submit(save_outputs, wav_name, tmp_audio32, ssl)))
+
+
+def check_saves(wait):
+    """取回写盘结果, 失败的条目与同步写盘时一样打印 traceback; wait=False 时只检查已完成的"""
+    pending = []
+    for wav_name, future in save_futures:
+        if not wait and not future.done():
+            pending.append((wav_name, future))
+            continue
+        try:
+            future.result()
+        except:
+            print(wav_name, traceback.format_exc())
+    save_futures[:] = pending
+
+
+def make_batches(items):
+    """按 16k 采样点数升序分桶, 每批至多 batch_size 条且补齐后的总时长不超过 max_batch_seconds"""
+    items = sorted(items, key=lambda item: len(item[2]))
+    batches = []
+    batch = []
+    for item in items:
+        if batch:
+            padded = len(item[2]) * (len(batch) + 1) / 16000
+            if len(batch) >= batch_size or padded > max_batch_seconds:
+                batches.append(batch)
+                batch = []
+        batch.append(item)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def process(items, writer, keep_nan):
+    for batch in make_batches(items):
+        try:
+            run_batch(batch, writer, keep_nan)
+        except:
+            print(traceback.format_exc())
+            if len(batch) == 1:
+                continue
+            # 整批失败 (如显存不足) 时逐条重试
+            for item in batch:
+                try:
+                    run_batch([item], writer, keep_nan)
+                except:
+                    print(item[0], traceback.format_exc())
 
 
 with open(inp_text, "r", encoding="utf8") as f:
     lines = f.read().strip("\n").split("\n")
 
+todo = []
 for line in lines[int(i_part) :: int(all_parts)]:
     try:
         # wav_name,text=line.split("\t")
@@ -120,15 +209,36 @@ for line in lines[int(i_part) :: int(all_parts)]:
         else:
             wav_path = wav_name
             wav_name = os.path.basename(wav_name)
-        name2go(wav_name, wav_path)
+        if os.path.exists("%s/%s.pt" % (hubert_dir, wav_name)):
+            continue
+        todo.append((wav_name, wav_path))
     except:
         print(line, traceback.format_exc())
 
-if len(nan_fails) > 0 and is_half == True:
-    is_half = False
-    model = model.float()
-    for wav in nan_fails:
-        try:
-            name2go(wav[0], wav[1])
-        except:
-            print(wav_name, traceback.format_exc())
+print("hubert: %s clips to extract, %s already done" % (len(todo), len(lines[int(i_part) :: int(all_parts)]) - len(todo)))
+
+
+def safe_prepare(args):
+    try:
+        return prepare(*args)
+    except:
+        print(args[1], traceback.format_exc())
+        return None
+
+
+window = max(1, batch_size) * window_batches
+with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool, ThreadPoolExecutor(max_workers=1) as writer:
+    # 预取下一窗口的解码, 使解码与前向重叠
+    futures = [pool.submit(safe_prepare, args) for args in todo[:window]]
+    for start in range(0, len(todo), window):
+        items = [future.result() for future in futures]
+        futures = [pool.submit(safe_prepare, args) for args in todo[start + window : start + 2 * window]]
+        process([item for item in items if item is not None], writer, keep_nan=is_half)
+        check_saves(wait=False)
+        print("hubert: %s/%s" % (min(start + window, len(todo)), len(todo)))
+
+    if len(nan_fails) > 0 and is_half == True:
+        is_half = False
+        model = model.float()
+        process(nan_fails, writer, keep_nan=False)
+    check_saves(wait=True)
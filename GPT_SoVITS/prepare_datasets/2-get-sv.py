@@ -26,6 +26,7 @@ sys.path.append(f"{now_dir}/GPT_SoVITS/eres2net")
 from tools.my_utils import clean_path
 from time import time as ttime
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from ERes2NetV2 import ERes2NetV2
 import kaldi as Kaldi
 
@@ -80,25 +81,88 @@ class SV:
             sv_emb = self.embedding_model.forward3(feat)
         return sv_emb
 
+    def compute_embedding3_batch(self, wavs):  # [(1,x)...]#-1~1, 32k
+        """补齐后批量重采样/fbank/ERes2NetV2, 有效部分与逐条 compute_embedding3 一致"""
+        with torch.no_grad():
+            lengths = torch.LongTensor([wav.shape[-1] for wav in wavs])
+            wav = torch.nn.utils.rnn.pad_sequence([wav.reshape(-1) for wav in wavs], batch_first=True)
+            wav = self.res(wav.to(device))
+            lengths = (lengths + 1) // 2  # Resample(32000, 16000) 输出 ceil(n/2) 个点
+            if self.is_half == True:
+                wav = wav.half()
+            feat, num_frames = Kaldi.fbank_batch(wav, lengths, num_mel_bins=80, sample_frequency=16000)
+            sv_emb = self.embedding_model.forward3_batch(feat, num_frames)
+        return sv_emb
+
 
 sv = SV(device, is_half)
+batch_size = int(os.environ.get("sv_batch_size", "16"))
+max_batch_seconds = float(os.environ.get("sv_max_batch_seconds", "240"))  # 每批补齐后的总时长上限(32k)
 
 
-def name2go(wav_name, wav_path):
-    sv_cn_path = "%s/%s.pt" % (sv_cn_dir, wav_name)
-    if os.path.exists(sv_cn_path):
-        return
-    wav_path = "%s/%s" % (wav32dir, wav_name)
-    wav32k, sr0 = torchaudio.load(wav_path)
+def load_wav32k(wav_name):
+    wav32k, sr0 = torchaudio.load("%s/%s" % (wav32dir, wav_name))
     assert sr0 == 32000
-    wav32k = wav32k.to(device)
-    emb = sv.compute_embedding3(wav32k).cpu()  # torch.Size([1, 20480])
-    my_save(emb, sv_cn_path)
+    return wav32k
+
+
+def make_batches(items):
+    """按采样点数升序分桶, 每批至多 batch_size 条且补齐后的总时长不超过 max_batch_seconds"""
+    items = sorted(items, key=lambda item: item[1].shape[-1])
+    batches = []
+    batch = []
+    for item in items:
+        if batch:
+            padded = item[1].shape[-1] * (len(batch) + 1) / 32000
+            if len(batch) >= batch_size or padded > max_batch_seconds:
+                batches.append(batch)
+                batch = []
+        batch.append(item)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def process(items, writer):
+    for batch in make_batches(items):
+        try:
+            embs = sv.compute_embedding3_batch([wav32k for _, wav32k in batch]).cpu()
+            embs = [embs[i : i + 1] for i in range(len(batch))]  # torch.Size([1, 20480])
+        except:
+            print(traceback.format_exc())
+            embs = []
+            for wav_name, wav32k in batch:  # 整批失败时逐条重试
+                try:
+                    embs.append(sv.compute_embedding3(wav32k.to(device)).cpu())
+                except:
+                    print(wav_name, traceback.format_exc())
+                    embs.append(None)
+        for (wav_name, _), emb in zip(batch, embs):
+            if emb is not None:
+                save_futures.append((wav_name, writer.submit(my_save, emb.clone(), "%s/%s.pt" % (sv_cn_dir, wav_name))))
+
+
+save_futures = []  # (wav_name, 写盘的 future), 由 check_saves 取回结果
+
+
+def check_saves(wait):
+    """取回写盘结果, 失败的条目与同步写盘时一样打印 traceback; wait=False 时只检查已完成的"""
+    pending = []
+    for wav_name, future in save_futures:
+        if not wait and not future.done():
+            pending.append((wav_name, future))
+            continue
+        try:
+            future.result()
+        except:
+            print(wav_name, traceback.format_exc())
+    save_futures[:] = pending
 
 
 with open(inp_text, "r", encoding="utf8") as f:
     lines = f.read().strip("\n").split("\n")
 
+todo = []
 for line in lines[int(i_part) :: int(all_parts)]:
     try:
         wav_name, spk_name, language, text = line.split("|")
@@ -110,6 +174,27 @@ for line in lines[int(i_part) :: int(all_parts)]:
         else:
             wav_path = wav_name
             wav_name = os.path.basename(wav_name)
-        name2go(wav_name, wav_path)
+        if os.path.exists("%s/%s.pt" % (sv_cn_dir, wav_name)):
+            continue
+        todo.append(wav_name)
     except:
         print(line, traceback.format_exc())
+
+
+def safe_load(wav_name):
+    try:
+        return wav_name, load_wav32k(wav_name)
+    except:
+        print(wav_name, traceback.format_exc())
+        return None
+
+
+window = max(1, batch_size) * 8  # 每次取多少条一起排序分桶
+with ThreadPoolExecutor(max_workers=4) as pool, ThreadPoolExecutor(max_workers=1) as writer:
+    futures = [pool.submit(safe_load, wav_name) for wav_name in todo[:window]]
+    for start in range(0, len(todo), window):
+        items = [future.result() for future in futures]
+        futures = [pool.submit(safe_load, wav_name) for wav_name in todo[start + window : start + 2 * window]]
+        process([item for item in items if item is not None], writer)
+        check_saves(wait=False)
+    check_saves(wait=True)
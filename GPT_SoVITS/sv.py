@@ -0,0 +1,106 @@
+import os
+import sys
+
+import torch
+
+sys.path.append(f"{os.getcwd()}/GPT_SoVITS/eres2net")
+sv_path = os.environ.get("sv_path", "GPT_SoVITS/pretrained_models/sv/pretrained_eres2netv2w24s4ep4.ckpt")
+from ERes2NetV2 import ERes2NetV2
+import kaldi as Kaldi
+
+
+def pad_waveforms(wavs):
+    """把若干条 (n,) 或 (1,n) 的波形右侧补零成 (B, n_max), 同时返回每条的有效长度"""
+    wavs = [wav.reshape(-1) for wav in wavs]
+    lengths = torch.LongTensor([wav.shape[0] for wav in wavs])
+    return torch.nn.utils.rnn.pad_sequence(wavs, batch_first=True), lengths
+
+
+class SV:
+    def __init__(self, device, is_half):
+        pretrained_state = torch.load(sv_path, map_location="cpu")
+        embedding_model = ERes2NetV2(baseWidth=24, scale=4, expansion=4)
+        embedding_model.load_state_dict(pretrained_state)
+        embedding_model.eval()
+        self.embedding_model = embedding_model
+        if is_half == False:
+            self.embedding_model = self.embedding_model.to(device)
+        else:
+            self.embedding_model = self.embedding_model.half().to(device)
+        self.is_half = is_half
+
+    def compute_embedding3(self, wav):  # (1,x)#-1~1, 16k
+        with torch.no_grad():
+            if self.is_half == True:
+                wav = wav.half()
+            feat = torch.stack(
+                [Kaldi.fbank(wav0.unsqueeze(0), num_mel_bins=80, sample_frequency=16000, dither=0) for wav0 in wav]
+            )
+            sv_emb = self.embedding_model.forward3(feat)
+        return sv_emb
+
+    def compute_embedding3_batch(self, wavs):
+        """
+        多条不等长 16k 波形一次提取: 补齐后批量算 fbank, 再带长度掩码批量过 ERes2NetV2.
+        返回与逐条 compute_embedding3 相同形状 (1, 20480) 的列表.
+        """
+        with torch.no_grad():
+            wav, lengths = pad_waveforms(wavs)
+            if self.is_half == True:
+                wav = wav.half()
+            feat, num_frames = Kaldi.fbank_batch(wav, lengths, num_mel_bins=80, sample_frequency=16000)
+            sv_emb = self.embedding_model.forward3_batch(feat, num_frames)
+        return [emb.unsqueeze(0) for emb in sv_emb]
+
+
+if __name__ == "__main__":
+    # python GPT_SoVITS/sv.py <音频目录或文件...> [batch_size]
+    # 对比逐条与批量提取的 clips/sec, 并给出两者结果的最大误差
+    import time
+
+    import torchaudio
+
+    device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    is_half = torch.cuda.is_available()
+    batch_size = int(sys.argv[-1]) if sys.argv[-1].isdigit() else 16
+    paths = []
+    for path in [arg for arg in sys.argv[1:] if not arg.isdigit()]:
+        if os.path.isdir(path):
+            paths.extend(os.path.join(path, name) for name in sorted(os.listdir(path)))
+        else:
+            paths.append(path)
+    wavs = []
+    for path in paths:
+        try:
+            wav, sr = torchaudio.load(path)
+        except Exception:
+            continue
+        wav = torchaudio.functional.resample(wav.mean(0, keepdim=True), sr, 16000)
+        wavs.append(wav.to(device))
+    if not wavs:
+        sys.exit("no audio loaded")
+    sv = SV(device, is_half)
+
+    def sync():
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    sv.compute_embedding3(wavs[0])  # warmup
+    sync()
+    t0 = time.perf_counter()
+    single = [sv.compute_embedding3(wav) for wav in wavs]
+    sync()
+    t1 = time.perf_counter()
+    order = sorted(range(len(wavs)), key=lambda i: wavs[i].shape[-1])
+    batched = [None] * len(wavs)
+    for start in range(0, len(order), batch_size):
+        idx = order[start : start + batch_size]
+        for i, emb in zip(idx, sv.compute_embedding3_batch([wavs[i] for i in idx])):
+            batched[i] = emb
+    sync()
+    t2 = time.perf_counter()
+    max_diff = max((a.float() - b.float()).abs().max().item() for a, b in zip(single, batched))
+    print("clips: %s, device: %s, half: %s" % (len(wavs), device, is_half))
+    print("per-clip:      %.1f clips/sec" % (len(wavs) / (t1 - t0)))
+    print("batch x%-5s  %.1f clips/sec" % (batch_size, len(wavs) / (t2 - t1)))
+    print("max abs diff: %.6f" % max_diff)
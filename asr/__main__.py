@@ -25,6 +25,16 @@ def main():
     config_parser.add_argument('--show', action='store_true', help='显示当前配置')
     config_parser.add_argument('--reset', action='store_true', help='重置为默认配置')
     
+    # 批量转写命令
+    batch_parser = subparsers.add_parser('batch', help='批量转写目录或清单，输出.list标注文件')
+    batch_parser.add_argument('source', help='音频目录或清单文件（每行一个路径，兼容.list）')
+    batch_parser.add_argument('-o', '--output_folder', default=None, help='输出目录，默认 output/asr_opt')
+    batch_parser.add_argument('-l', '--language', default='zh', help='写入.list的语种标记')
+    batch_parser.add_argument('-b', '--batch_size', type=int, default=16, help='每次generate的音频条数')
+    batch_parser.add_argument('-w', '--num_workers', type=int, default=4, help='解码线程数')
+    batch_parser.add_argument('--max_batch_seconds', type=float, default=None, help='每批补齐后的最大总时长（秒）')
+    batch_parser.add_argument('--no_resume', action='store_true', help='忽略已有.list，从头开始')
+    
     # 服务命令
     server_parser = subparsers.add_parser('server', help='启动独立ASR服务器')
     server_parser.add_argument('--host', default='0.0.0.0', help='服务器地址')
@@ -58,6 +68,36 @@ def main():
         else:
             print("请使用 --show 或 --reset 选项")
             
+    elif args.command == 'batch':
+        from tools.asr.batch_asr import collect_inputs, run_batch_asr
+        from .asr_engine import asr_engine
+        from .batch_jobs import default_output_path
+        
+        inputs = collect_inputs(args.source)
+        output_path = default_output_path(args.source, args.output_folder)
+        print(f"📂 共 {len(inputs)} 个音频文件 -> {output_path}")
+        
+        if not asr_engine.load_model():
+            print("❌ ASR模型加载失败")
+            sys.exit(1)
+        
+        def print_progress(done, total):
+            print(f"\r进度: {done}/{total}", end="", flush=True)
+        
+        stats = run_batch_asr(
+            inputs,
+            output_path,
+            asr_engine.recognize_batch,
+            speaker=Path(output_path).stem,
+            language=args.language,
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            max_batch_seconds=args.max_batch_seconds,
+            resume=not args.no_resume,
+            progress_fn=print_progress,
+        )
+        print(f"\n✅ 批量转写完成: 共 {stats['total']} 条, 续跑跳过 {stats['skipped']} 条, 失败 {stats['failed']} 条")
+        
     elif args.command == 'server':
         import uvicorn
         from fastapi import FastAPI
@@ -12,13 +12,21 @@ from pathlib import Path
 
 import soundfile as sf
 import numpy as np
-from fastapi import APIRouter, HTTPException, UploadFile, File, Form
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, HTTPException, UploadFile, File, Form, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 
 from .asr_engine import asr_engine
 from .model_manager import model_manager
 
+# 批量转写依赖 tools/asr 流水线（需在项目根目录运行）
+try:
+    from .batch_jobs import BatchJob, batch_job_manager, default_output_path
+    BATCH_AVAILABLE = True
+except ImportError as e:
+    BATCH_AVAILABLE = False
+    logging.warning(f"⚠️ 批量转写不可用: {e}")
+
 # 设置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -52,6 +60,18 @@ class VADResponse(BaseModel):
     error: Optional[str] = None
 
 
+class BatchJobRequest(BaseModel):
+    """批量转写任务请求模型"""
+    source: str  # 音频目录或清单文件（每行一个路径，兼容.list）
+    output_folder: Optional[str] = None
+    speaker: Optional[str] = None
+    language: str = "zh"
+    batch_size: int = 16
+    num_workers: int = 4
+    max_batch_seconds: Optional[float] = None
+    resume: bool = True
+
+
 class ModelInfo(BaseModel):
     """模型信息响应模型"""
     model_name: str
@@ -248,13 +268,22 @@ async def recognize_audio_file(
                 detail=f"不支持的音频格式: {file_extension}. 支持的格式: {', '.join(sorted(allowed_extensions))}"
             )
         
+        content = await audio_file.read()
+        
+        # wav/flac/ogg 等容器直接在内存中解码识别，无需落盘
+        if asr_engine.is_container_bytes(content):
+            def recognize_in_memory():
+                return asr_engine.recognize_audio_data(content)
+            
+            result = await asyncio.get_event_loop().run_in_executor(None, recognize_in_memory)
+            return ASRResponse(**result)
+        
         # 创建临时文件，使用映射后的扩展名
         temp_suffix = file_extension
         with tempfile.NamedTemporaryFile(suffix=temp_suffix, delete=False) as temp_file:
             temp_path = temp_file.name
             
             # 保存上传的文件
-            content = await audio_file.read()
             temp_file.write(content)
             
         logger.info(f"临时文件已创建: {temp_path}, 原始格式: {Path(audio_file.filename).suffix}, 处理格式: {file_extension}")
@@ -332,6 +361,36 @@ async def recognize_audio_url(
         raise HTTPException(status_code=500, detail=f"识别失败: {str(e)}")
 
 
+@router.post("/recognize/pcm", response_model=ASRResponse)
+async def recognize_audio_pcm(
+    request: Request,
+    sample_rate: int = 16000,
+    pcm_dtype: str = "int16"
+):
+    """
+    识别请求体中的原始音频字节
+    
+    请求体可以是无头PCM（由 sample_rate / pcm_dtype 描述），
+    也可以是wav/flac/ogg容器字节，全程在内存中处理
+    """
+    try:
+        body = await request.body()
+        if not body:
+            raise HTTPException(status_code=400, detail="缺少音频数据")
+        
+        def recognize_sync():
+            return asr_engine.recognize_audio_data(memoryview(body), sample_rate, pcm_dtype)
+        
+        result = await asyncio.get_event_loop().run_in_executor(None, recognize_sync)
+        return ASRResponse(**result)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"识别PCM音频失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"识别失败: {str(e)}")
+
+
 @router.get("/health")
 async def health_check():
     """健康检查"""
@@ -422,6 +481,117 @@ async def get_model_config():
         raise HTTPException(status_code=500, detail=f"获取模型配置失败: {str(e)}")
 
 
+# ======================
+# 批量转写接口
+# ======================
+
+def _get_batch_job(job_id: str):
+    if not BATCH_AVAILABLE:
+        raise HTTPException(status_code=503, detail="批量转写功能不可用")
+    job = batch_job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"任务不存在: {job_id}")
+    return job
+
+
+@router.post("/batch/jobs")
+async def create_batch_job(request: BatchJobRequest):
+    """
+    创建批量转写任务
+    
+    对目录或清单中的音频按时长分桶批量识别，结果以.list格式增量写出；
+    输出文件已存在且 resume=True 时跳过已完成的条目
+    """
+    if not BATCH_AVAILABLE:
+        raise HTTPException(status_code=503, detail="批量转写功能不可用")
+    
+    if not os.path.exists(request.source):
+        raise HTTPException(status_code=400, detail=f"输入路径不存在: {request.source}")
+    
+    try:
+        output_path = default_output_path(request.source, request.output_folder)
+        speaker = request.speaker or Path(output_path).stem
+        
+        for job in batch_job_manager.jobs.values():
+            if job.is_active and job.output_path == output_path:
+                raise HTTPException(status_code=409, detail=f"已有任务正在写入该输出: {job.job_id}")
+        
+        job = batch_job_manager.submit(BatchJob(
+            source=request.source,
+            output_path=output_path,
+            speaker=speaker,
+            language=request.language,
+            batch_size=max(1, request.batch_size),
+            num_workers=max(1, request.num_workers),
+            max_batch_seconds=request.max_batch_seconds,
+            resume=request.resume,
+        ))
+        return {"success": True, "job": job.to_dict()}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"创建批量转写任务失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"创建批量转写任务失败: {str(e)}")
+
+
+@router.get("/batch/jobs")
+async def list_batch_jobs():
+    """列出所有批量转写任务"""
+    if not BATCH_AVAILABLE:
+        raise HTTPException(status_code=503, detail="批量转写功能不可用")
+    return {"jobs": batch_job_manager.list_jobs()}
+
+
+@router.get("/batch/jobs/{job_id}")
+async def get_batch_job(job_id: str):
+    """获取批量转写任务状态"""
+    return _get_batch_job(job_id).to_dict()
+
+
+@router.post("/batch/jobs/{job_id}/cancel")
+async def cancel_batch_job(job_id: str):
+    """取消批量转写任务（在当前批次完成后停止，可通过resume续跑）"""
+    job = _get_batch_job(job_id)
+    job.cancel()
+    return {"success": True, "message": "已请求取消任务", "job": job.to_dict()}
+
+
+@router.get("/batch/jobs/{job_id}/results")
+async def stream_batch_results(job_id: str):
+    """以.list格式流式返回识别结果，任务运行期间持续输出新完成的行"""
+    job = _get_batch_job(job_id)
+    
+    async def tail_results():
+        position = 0
+        emitted = set()
+        while True:
+            active = job.is_active
+            if os.path.exists(job.output_path):
+                if active:
+                    # 运行期间文件只追加，从上次位置读取完整的新行
+                    with open(job.output_path, "rb") as f:
+                        f.seek(position)
+                        chunk = f.read()
+                    chunk = chunk[:chunk.rfind(b"\n") + 1]
+                    position += len(chunk)
+                    lines = chunk.decode("utf-8").splitlines()
+                else:
+                    # 结束后文件会按输入顺序重写，补发尚未输出的行
+                    with open(job.output_path, "r", encoding="utf-8") as f:
+                        lines = f.read().splitlines()
+                new_lines = [line for line in lines if "|" in line and line.split("|", 1)[0] not in emitted]
+                for line in new_lines:
+                    emitted.add(line.split("|", 1)[0])
+                if new_lines:
+                    yield "\n".join(new_lines) + "\n"
+            if not active:
+                break
+            await asyncio.sleep(1.0)
+    
+    return StreamingResponse(tail_results(), media_type="text/plain; charset=utf-8")
+
+
 # ======================
 # VAD 相关接口
 # ======================
@@ -3,9 +3,10 @@ FunASR语音识别引擎 (兼容版本)
 支持Silero VAD语音活动检测
 """
 
+import io
 import os
 import logging
-import tempfile
+from contextlib import nullcontext
 import numpy as np
 import soundfile as sf
 from typing import Optional, Union, Dict, Any, List
@@ -32,6 +33,12 @@ except ImportError:
     FUNASR_AVAILABLE = False
     logging.warning("⚠️ FunASR不可用，ASR功能将受限")
 
+# FunASR模型的输入采样率
+TARGET_SAMPLE_RATE = 16000
+
+# 可由soundfile在内存中直接解码的容器头
+_CONTAINER_MAGICS = (b"RIFF", b"RF64", b"fLaC", b"OggS", b"FORM")
+
 
 class ASREngine:
     """FunASR语音识别引擎，集成Silero VAD"""
@@ -51,6 +58,10 @@ class ASREngine:
         self.is_loaded = False
         self.logger = logging.getLogger(__name__)
         
+        # 可选的模型使用声明 model_guard(name) -> ContextManager（由模型生命周期管理器提供），
+        # 声明期间模型不会被空闲回收，已回收的模型会在其中重新加载
+        self.model_guard = None
+        
         # 配置管理
         self.config = config or ASRConfig()
         self.vad_config = self.config.get("vad", {})
@@ -205,6 +216,12 @@ class ASREngine:
             self.logger.error(f"加载ASR模型失败: {str(e)}")
             return False
     
+    def _use_model(self, name: str):
+        """声明正在使用某个模型（"asr" 或 "vad"）"""
+        if self.model_guard is None:
+            return nullcontext()
+        return self.model_guard(name)
+    
     def unload_model(self):
         """卸载模型释放内存"""
         if self.model is not None:
@@ -231,9 +248,6 @@ class ASREngine:
                     "error": "FunASR不可用，请安装FunASR"
                 }
             
-            if not self.is_loaded and not self.load_model():
-                raise RuntimeError("ASR模型未加载")
-            
             audio_path = str(audio_path)
             if not os.path.exists(audio_path):
                 raise FileNotFoundError(f"音频文件不存在: {audio_path}")
@@ -245,50 +259,13 @@ class ASREngine:
                 if vad_segments:
                     self.logger.info(f"VAD检测到 {len(vad_segments)} 个语音片段")
             
-            # 使用FunASR进行识别
-            result = self.model.generate(input=audio_path)
-            
-            if result and len(result) > 0:
-                # 提取识别结果
-                recognition_result = result[0]
-                
-                # 处理不同的结果格式
-                if isinstance(recognition_result, dict):
-                    text = recognition_result.get("text", "")
-                    confidence = recognition_result.get("confidence", 0.0)
-                    segments = recognition_result.get("segments", [])
-                    timestamp = recognition_result.get("timestamp", [])
-                elif isinstance(recognition_result, str):
-                    # 如果直接返回字符串
-                    text = recognition_result
-                    confidence = 1.0
-                    segments = []
-                    timestamp = []
-                else:
-                    # 其他格式，尝试转换为字符串
-                    text = str(recognition_result)
-                    confidence = 1.0
-                    segments = []
-                    timestamp = []
+            with self._use_model("asr"):
+                if not self.is_loaded and not self.load_model():
+                    raise RuntimeError("ASR模型未加载")
                 
-                # 格式化返回结果
-                formatted_result = {
-                    "success": True,
-                    "text": text,
-                    "confidence": confidence,
-                    "segments": segments,
-                    "speaker_info": None,  # 说话人信息可能不可用
-                    "timestamp": timestamp,
-                }
-                
-                self.logger.info(f"识别成功: {formatted_result['text']}")
-                return formatted_result
-            else:
-                return {
-                    "success": False,
-                    "text": "",
-                    "error": "未识别到语音内容"
-                }
+                # 使用FunASR进行识别
+                result = self.model.generate(input=audio_path)
+            return self._format_generate_result(result)
                 
         except Exception as e:
             self.logger.error(f"语音识别失败: {str(e)}")
@@ -298,13 +275,18 @@ class ASREngine:
                 "error": str(e)
             }
     
-    def recognize_audio_data(self, audio_data: np.ndarray, sample_rate: int = 16000) -> Dict[str, Any]:
+    def recognize_audio_data(self,
+                             audio_data: Union[np.ndarray, bytes, bytearray, memoryview],
+                             sample_rate: int = TARGET_SAMPLE_RATE,
+                             pcm_dtype: str = "int16") -> Dict[str, Any]:
         """
-        识别音频数据
+        识别内存中的音频数据，不经过临时文件
         
         Args:
-            audio_data: 音频数据数组
-            sample_rate: 采样率
+            audio_data: 音频数据数组，或WebSocket/REST层传入的原始字节
+                        (wav/flac/ogg容器字节，或无头PCM)
+            sample_rate: 采样率（无头PCM与数组输入时使用）
+            pcm_dtype: 无头PCM的采样格式，如 "int16"、"float32"
             
         Returns:
             Dict: 识别结果
@@ -317,23 +299,27 @@ class ASREngine:
                     "error": "FunASR不可用，请安装FunASR"
                 }
             
-            if not self.is_loaded and not self.load_model():
-                raise RuntimeError("ASR模型未加载")
+            waveform = self.prepare_waveform(audio_data, sample_rate, pcm_dtype)
+            if waveform.size == 0:
+                return {
+                    "success": False,
+                    "text": "",
+                    "error": "音频数据为空"
+                }
             
-            # 创建临时文件
-            with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_file:
-                temp_path = temp_file.name
-                
-                # 保存音频数据到临时文件
-                sf.write(temp_path, audio_data, sample_rate)
-                
-                # 识别音频文件
-                result = self.recognize_audio_file(temp_path)
-                
-                # 删除临时文件
-                os.unlink(temp_path)
+            # VAD预处理（如果启用）
+            if self.vad_enabled and self.vad_config.get("pre_process", False):
+                vad_segments = self._process_waveform_with_vad(waveform)
+                if vad_segments:
+                    self.logger.info(f"VAD检测到 {len(vad_segments)} 个语音片段")
+            
+            with self._use_model("asr"):
+                if not self.is_loaded and not self.load_model():
+                    raise RuntimeError("ASR模型未加载")
                 
-                return result
+                # 直接将16kHz波形送入FunASR，省去写盘与重复解码
+                result = self.model.generate(input=waveform, fs=TARGET_SAMPLE_RATE)
+            return self._format_generate_result(result)
                 
         except Exception as e:
             self.logger.error(f"识别音频数据失败: {str(e)}")
@@ -343,6 +329,159 @@ class ASREngine:
                 "error": str(e)
             }
     
+    def recognize_batch(self, waveforms: List[np.ndarray]) -> List[str]:
+        """
+        批量识别多段16kHz单声道波形，一次generate调用
+        
+        Args:
+            waveforms: 16kHz单声道float32波形列表
+            
+        Returns:
+            List[str]: 与输入顺序一致的识别文本
+        """
+        if not FUNASR_AVAILABLE:
+            raise RuntimeError("FunASR不可用，请安装FunASR")
+        
+        with self._use_model("asr"):
+            if not self.is_loaded and not self.load_model():
+                raise RuntimeError("ASR模型未加载")
+            
+            results = self.model.generate(input=list(waveforms), fs=TARGET_SAMPLE_RATE, batch_size=len(waveforms))
+        texts = []
+        for item in results:
+            texts.append(item.get("text", "") if isinstance(item, dict) else str(item))
+        return texts
+    
+    @staticmethod
+    def is_container_bytes(audio_bytes: Union[bytes, bytearray, memoryview]) -> bool:
+        """判断字节数据是否为soundfile可在内存中解码的容器格式"""
+        return bytes(audio_bytes[:4]) in _CONTAINER_MAGICS
+    
+    def prepare_waveform(self,
+                         audio_data: Union[np.ndarray, bytes, bytearray, memoryview],
+                         sample_rate: int = TARGET_SAMPLE_RATE,
+                         pcm_dtype: str = "int16") -> np.ndarray:
+        """
+        将数组或原始字节转换为16kHz单声道float32波形
+        
+        Args:
+            audio_data: 音频数据数组或字节
+            sample_rate: 输入采样率（容器字节以文件头为准）
+            pcm_dtype: 无头PCM的采样格式
+            
+        Returns:
+            np.ndarray: 16kHz单声道float32波形
+        """
+        if isinstance(audio_data, (bytes, bytearray, memoryview)):
+            if self.is_container_bytes(audio_data):
+                audio_data, sample_rate = sf.read(io.BytesIO(audio_data), dtype="float32")
+            else:
+                # 无头PCM：零拷贝视图，仅在类型转换时复制一次
+                dtype = np.dtype(pcm_dtype)
+                buffer = memoryview(audio_data).cast("B")
+                usable = len(buffer) - len(buffer) % dtype.itemsize
+                audio_data = np.frombuffer(buffer[:usable], dtype=dtype)
+        
+        waveform = np.asarray(audio_data)
+        
+        # 多声道转单声道
+        if waveform.ndim > 1:
+            waveform = waveform.mean(axis=1)
+        
+        # 整型PCM归一化到[-1, 1]
+        if np.issubdtype(waveform.dtype, np.integer):
+            waveform = waveform.astype(np.float32) / float(np.iinfo(waveform.dtype).max + 1)
+        else:
+            waveform = waveform.astype(np.float32, copy=False)
+        
+        # 重采样到16kHz（如果需要）
+        if sample_rate != TARGET_SAMPLE_RATE and waveform.size > 0:
+            import librosa
+            waveform = librosa.resample(waveform, orig_sr=sample_rate, target_sr=TARGET_SAMPLE_RATE)
+        
+        return np.ascontiguousarray(waveform, dtype=np.float32)
+    
+    def _format_generate_result(self, result: Any) -> Dict[str, Any]:
+        """
+        将FunASR generate的输出整理为统一的识别结果
+        
+        Args:
+            result: model.generate 的返回值
+            
+        Returns:
+            Dict: 识别结果
+        """
+        if result and len(result) > 0:
+            # 提取识别结果
+            recognition_result = result[0]
+            
+            # 处理不同的结果格式
+            if isinstance(recognition_result, dict):
+                text = recognition_result.get("text", "")
+                confidence = recognition_result.get("confidence", 0.0)
+                segments = recognition_result.get("segments", [])
+                timestamp = recognition_result.get("timestamp", [])
+            elif isinstance(recognition_result, str):
+                # 如果直接返回字符串
+                text = recognition_result
+                confidence = 1.0
+                segments = []
+                timestamp = []
+            else:
+                # 其他格式，尝试转换为字符串
+                text = str(recognition_result)
+                confidence = 1.0
+                segments = []
+                timestamp = []
+            
+            # 格式化返回结果
+            formatted_result = {
+                "success": True,
+                "text": text,
+                "confidence": confidence,
+                "segments": segments,
+                "speaker_info": None,  # 说话人信息可能不可用
+                "timestamp": timestamp,
+            }
+            
+            self.logger.info(f"识别成功: {formatted_result['text']}")
+            return formatted_result
+        else:
+            return {
+                "success": False,
+                "text": "",
+                "error": "未识别到语音内容"
+            }
+    
+    def _get_vad_params(self) -> Dict[str, Any]:
+        """从配置中读取VAD参数"""
+        return {
+            "threshold": self.vad_config.get("threshold", 0.5),
+            "min_speech_duration_ms": self.vad_config.get("min_speech_duration_ms", 250),
+            "max_speech_duration_s": self.vad_config.get("max_speech_duration_s", 30.0),
+            "min_silence_duration_ms": self.vad_config.get("min_silence_duration_ms", 100),
+            "speech_pad_ms": self.vad_config.get("speech_pad_ms", 30),
+        }
+    
+    def _process_waveform_with_vad(self, waveform: np.ndarray) -> Optional[List[Dict[str, Any]]]:
+        """
+        使用VAD处理16kHz波形
+        
+        Args:
+            waveform: 16kHz单声道波形
+            
+        Returns:
+            Optional[List[Dict]]: VAD检测的语音片段，如果失败返回None
+        """
+        try:
+            if not self.vad_enabled or not self.vad_engine:
+                return None
+            with self._use_model("vad"):
+                return self.vad_engine.detect_speech_chunks(waveform, **self._get_vad_params())
+        except Exception as e:
+            self.logger.error(f"VAD处理失败: {str(e)}")
+            return None
+    
     def _process_with_vad(self, audio_path: Union[str, Path]) -> Optional[List[Dict[str, Any]]]:
         """
         使用VAD处理音频文件
@@ -358,16 +497,11 @@ class ASREngine:
                 return None
             
             # 获取VAD参数
-            vad_params = {
-                "threshold": self.vad_config.get("threshold", 0.5),
-                "min_speech_duration_ms": self.vad_config.get("min_speech_duration_ms", 250),
-                "max_speech_duration_s": self.vad_config.get("max_speech_duration_s", 30.0),
-                "min_silence_duration_ms": self.vad_config.get("min_silence_duration_ms", 100),
-                "speech_pad_ms": self.vad_config.get("speech_pad_ms", 30),
-            }
+            vad_params = self._get_vad_params()
             
             # 使用VAD检测语音片段
-            segments = self.vad_engine.process_audio_file(audio_path, **vad_params)
+            with self._use_model("vad"):
+                segments = self.vad_engine.process_audio_file(audio_path, **vad_params)
             
             if segments:
                 self.logger.info(f"VAD检测完成，发现 {len(segments)} 个语音片段")
@@ -408,29 +542,18 @@ class ASREngine:
             detailed_results = []
             total_confidence = 0.0
             
+            # 只读取一次音频，各片段直接在内存中识别
+            audio_data, sr = sf.read(str(audio_path), dtype="float32")
+            
             for i, segment in enumerate(vad_segments):
                 try:
-                    # 创建临时音频片段文件
-                    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_file:
-                        temp_path = temp_file.name
-                    
                     # 提取音频片段
-                    audio_data, sr = sf.read(str(audio_path))
                     start_sample = int(segment['start'] * sr)
                     end_sample = int(segment['end'] * sr)
                     segment_audio = audio_data[start_sample:end_sample]
                     
-                    # 保存片段
-                    sf.write(temp_path, segment_audio, sr)
-                    
                     # 识别片段
-                    segment_result = self.recognize_audio_file(temp_path)
-                    
-                    # 清理临时文件
-                    try:
-                        os.unlink(temp_path)
-                    except:
-                        pass
+                    segment_result = self.recognize_audio_data(segment_audio, sr)
                     
                     if segment_result.get("success", False):
                         text = segment_result.get("text", "").strip()
@@ -492,13 +615,7 @@ class ASREngine:
                 return []
             
             # 获取VAD参数
-            vad_params = {
-                "threshold": self.vad_config.get("threshold", 0.5),
-                "min_speech_duration_ms": self.vad_config.get("min_speech_duration_ms", 250),
-                "max_speech_duration_s": self.vad_config.get("max_speech_duration_s", 30.0),
-                "min_silence_duration_ms": self.vad_config.get("min_silence_duration_ms", 100),
-                "speech_pad_ms": self.vad_config.get("speech_pad_ms", 30),
-            }
+            vad_params = self._get_vad_params()
             
             return self.vad_engine.split_audio_by_vad(audio_path, output_dir, **vad_params)
             
@@ -0,0 +1,152 @@
+"""
+批量转写任务管理
+在后台线程中对目录或清单执行批量识别，结果以.list格式增量写出，支持断点续跑
+"""
+
+import os
+import time
+import uuid
+import logging
+import threading
+from typing import Optional, Dict, Any, List
+
+from tools.asr.batch_asr import collect_inputs, run_batch_asr
+
+from .asr_engine import asr_engine
+
+
+class BatchJob:
+    """单个批量转写任务"""
+
+    def __init__(self,
+                 source: str,
+                 output_path: str,
+                 speaker: str,
+                 language: str = "zh",
+                 batch_size: int = 16,
+                 num_workers: int = 4,
+                 max_batch_seconds: Optional[float] = None,
+                 resume: bool = True):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.source = source
+        self.output_path = output_path
+        self.speaker = speaker
+        self.language = language
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.max_batch_seconds = max_batch_seconds
+        self.resume = resume
+
+        self.status = "pending"  # pending, running, completed, cancelled, failed
+        self.total = 0
+        self.done = 0
+        self.stats: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._cancel_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def cancel(self):
+        """请求在下一个批次边界停止"""
+        self._cancel_event.set()
+
+    @property
+    def is_active(self) -> bool:
+        return self.status in ("pending", "running")
+
+    def to_dict(self) -> Dict[str, Any]:
+        elapsed = None
+        if self.started_at:
+            elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "source": self.source,
+            "output_path": self.output_path,
+            "language": self.language,
+            "batch_size": self.batch_size,
+            "total": self.total,
+            "done": self.done,
+            "progress": self.done / self.total if self.total else 0.0,
+            "elapsed": elapsed,
+            "stats": self.stats,
+            "error": self.error,
+        }
+
+
+class BatchJobManager:
+    """批量转写任务管理器，任务串行占用ASR模型"""
+
+    def __init__(self):
+        self.jobs: Dict[str, BatchJob] = {}
+        self._model_lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+
+    def submit(self, job: BatchJob) -> BatchJob:
+        """提交任务并在后台线程中执行"""
+        self.jobs[job.job_id] = job
+        job._thread = threading.Thread(target=self._run, args=(job,), daemon=True)
+        job._thread.start()
+        return job
+
+    def get(self, job_id: str) -> Optional[BatchJob]:
+        return self.jobs.get(job_id)
+
+    def list_jobs(self) -> List[Dict[str, Any]]:
+        return [job.to_dict() for job in self.jobs.values()]
+
+    def _run(self, job: BatchJob):
+        try:
+            inputs = collect_inputs(job.source)
+            job.total = len(inputs)
+
+            with self._model_lock:
+                if job._cancel_event.is_set():
+                    job.status = "cancelled"
+                    return
+
+                job.status = "running"
+                job.started_at = time.time()
+                self.logger.info(f"批量转写任务 {job.job_id} 开始: {job.total} 个文件")
+
+                def update_progress(done, total):
+                    job.done = done
+
+                job.stats = run_batch_asr(
+                    inputs,
+                    job.output_path,
+                    asr_engine.recognize_batch,
+                    speaker=job.speaker,
+                    language=job.language,
+                    batch_size=job.batch_size,
+                    num_workers=job.num_workers,
+                    max_batch_seconds=job.max_batch_seconds,
+                    resume=job.resume,
+                    progress_fn=update_progress,
+                    should_stop=job._cancel_event.is_set,
+                )
+                job.done = job.stats["done"]
+                job.status = "cancelled" if job.stats["stopped"] else "completed"
+                self.logger.info(f"批量转写任务 {job.job_id} 结束: {job.status}, {job.stats}")
+
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            self.logger.error(f"批量转写任务 {job.job_id} 失败: {str(e)}")
+        finally:
+            job.finished_at = time.time()
+
+
+def default_output_path(source: str, output_folder: Optional[str] = None) -> str:
+    """与 tools/asr 一致：输出为 <output_folder>/<输入目录名>.list"""
+    name = os.path.basename(os.path.normpath(source))
+    if os.path.isfile(source):
+        name = os.path.splitext(name)[0]
+    output_folder = output_folder or "output/asr_opt"
+    return os.path.abspath(os.path.join(output_folder, f"{name}.list"))
+
+
+# 全局批量任务管理器
+batch_job_manager = BatchJobManager()
@@ -37,7 +37,10 @@ class ConnectionManager:
         await websocket.accept()
         self.active_connections[websocket] = {
             "session_id": len(self.active_connections),
-            "connected_at": asyncio.get_event_loop().time()
+            "connected_at": asyncio.get_event_loop().time(),
+            # 二进制帧（无头PCM）的音频参数，可通过config消息修改
+            "sample_rate": 16000,
+            "pcm_dtype": "int16"
         }
         logger.info(f"WebSocket连接建立，当前连接数: {len(self.active_connections)}")
     
@@ -82,14 +85,31 @@ async def websocket_asr_endpoint(websocket: WebSocket):
         "type": "config",
         "load_model": true
     }
+    
+    也可以直接发送二进制帧，内容为无头PCM（参数由config消息中的
+    sample_rate / pcm_dtype 指定）或wav/flac/ogg容器字节
     """
     await manager.connect(websocket)
     
     try:
         while True:
             # 接收消息
-            data = await websocket.receive_text()
-            message = json.loads(data)
+            frame = await websocket.receive()
+            if frame.get("type") == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            
+            if frame.get("bytes") is not None:
+                # 二进制帧直接在内存中识别
+                session = manager.active_connections.get(websocket, {})
+                await recognize_and_send(
+                    websocket,
+                    memoryview(frame["bytes"]),
+                    session.get("sample_rate", 16000),
+                    session.get("pcm_dtype", "int16")
+                )
+                continue
+            
+            message = json.loads(frame.get("text") or "{}")
             
             message_type = message.get("type")
             
@@ -144,6 +164,18 @@ async def handle_config_message(websocket: WebSocket, message: dict):
                 "message": "模型已卸载"
             })
         
+        elif "sample_rate" in message or "pcm_dtype" in message:
+            # 更新二进制帧的音频参数
+            session = manager.active_connections.get(websocket, {})
+            session["sample_rate"] = int(message.get("sample_rate", session.get("sample_rate", 16000)))
+            session["pcm_dtype"] = message.get("pcm_dtype", session.get("pcm_dtype", "int16"))
+            await manager.send_message(websocket, {
+                "type": "config_response",
+                "sample_rate": session["sample_rate"],
+                "pcm_dtype": session["pcm_dtype"],
+                "message": "音频参数已更新"
+            })
+        
         elif message.get("get_info"):
             # 获取模型信息
             info = asr_engine.get_model_info()
@@ -162,14 +194,6 @@ async def handle_config_message(websocket: WebSocket, message: dict):
 async def handle_audio_data(websocket: WebSocket, message: dict):
     """处理音频数据"""
     try:
-        # 检查模型是否加载
-        if not asr_engine.is_loaded:
-            await manager.send_message(websocket, {
-                "type": "error",
-                "message": "ASR模型未加载，请先加载模型"
-            })
-            return
-        
         # 解码音频数据
         audio_data_b64 = message.get("data")
         if not audio_data_b64:
@@ -186,7 +210,17 @@ async def handle_audio_data(websocket: WebSocket, message: dict):
         audio_format = message.get("format", "wav")
         sample_rate = message.get("sample_rate", 16000)
         
-        # 创建临时文件
+        # 无头PCM与wav/flac/ogg容器直接在内存中识别
+        if audio_format in ("pcm", "raw") or asr_engine.is_container_bytes(audio_bytes):
+            await recognize_and_send(
+                websocket,
+                memoryview(audio_bytes),
+                sample_rate,
+                message.get("pcm_dtype", "int16")
+            )
+            return
+        
+        # 其他格式（mp3/webm/m4a等）仍需交给FunASR按文件解码
         with tempfile.NamedTemporaryFile(suffix=f".{audio_format}", delete=False) as temp_file:
             temp_path = temp_file.name
             temp_file.write(audio_bytes)
@@ -194,7 +228,8 @@ async def handle_audio_data(websocket: WebSocket, message: dict):
         try:
             # 在线程池中执行识别
             def recognize_sync():
-                return asr_engine.recognize_audio_file(temp_path)
+                with asr_engine._use_model("asr"):
+                    return asr_engine.recognize_audio_file(temp_path)
             
             result = await asyncio.get_event_loop().run_in_executor(None, recognize_sync)
             
@@ -217,6 +252,29 @@ async def handle_audio_data(websocket: WebSocket, message: dict):
         })
 
 
+async def recognize_and_send(websocket: WebSocket, audio_bytes: memoryview, sample_rate: int, pcm_dtype: str):
+    """在内存中识别音频字节并发送结果"""
+    try:
+        # 模型被生命周期管理器回收后按需重新加载（WebSocket 连接不经过 HTTP 中间件的预加载）
+        def recognize_sync():
+            with asr_engine._use_model("asr"):
+                return asr_engine.recognize_audio_data(audio_bytes, sample_rate, pcm_dtype)
+        
+        result = await asyncio.get_event_loop().run_in_executor(None, recognize_sync)
+        
+        await manager.send_message(websocket, {
+            "type": "recognition_result",
+            **result
+        })
+        
+    except Exception as e:
+        logger.error(f"处理音频数据失败: {str(e)}")
+        await manager.send_message(websocket, {
+            "type": "error",
+            "message": f"音频识别失败: {str(e)}"
+        })
+
+
 # 为了向后兼容，也创建一个REST API路由
 websocket_router = APIRouter()
 websocket_router.include_router(ws_router)
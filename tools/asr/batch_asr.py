@@ -0,0 +1,246 @@
+# -*- coding:utf-8 -*-
+"""
+批量 ASR 标注流水线
+
+目录或清单输入 -> 线程池探测时长/解码 -> 按时长排序分桶 -> 批量识别 -> 增量写出 .list (可断点续跑)
+识别后端只需提供 transcribe_fn(waveforms) -> [text | (text, language)]
+"""
+
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import soundfile as sf
+
+SAMPLE_RATE = 16000
+AUDIO_EXTENSIONS = {".wav", ".flac", ".mp3", ".m4a", ".aac", ".ogg", ".opus", ".webm"}
+
+
+def collect_inputs(source, audio_only=True):
+    """
+    收集待识别的音频路径.
+    source 为目录时取目录下的文件 (按文件名排序), audio_only 时只取 AUDIO_EXTENSIONS 中的音频文件,
+    否则与原来的逐文件识别一样取目录下的所有条目;
+    为清单文件时每行一个路径, 也兼容 .list 格式 (取第一列), 相对路径相对于清单所在目录.
+    """
+    if os.path.isdir(source):
+        names = sorted(os.listdir(source))
+        if not audio_only:
+            return [os.path.join(source, name) for name in names]
+        return [
+            os.path.join(source, name)
+            for name in names
+            if os.path.splitext(name)[1].lower() in AUDIO_EXTENSIONS and os.path.isfile(os.path.join(source, name))
+        ]
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    paths = []
+    with open(source, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            path = line.split("|", 1)[0].strip()
+            if not os.path.isabs(path) and not os.path.exists(path):
+                path = os.path.join(base_dir, path)
+            paths.append(path)
+    return paths
+
+
+def read_finished(list_path):
+    """读取已有 .list 中已完成的音频路径, 用于断点续跑"""
+    finished = set()
+    if not os.path.exists(list_path):
+        return finished
+    with open(list_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if "|" in line:
+                finished.add(line.split("|", 1)[0])
+    return finished
+
+
+def probe_duration(path):
+    """只读文件头获取时长 (秒), 无法读取时按文件大小粗略估计"""
+    try:
+        info = sf.info(path)
+        return info.frames / float(info.samplerate)
+    except Exception:
+        return os.path.getsize(path) / (2.0 * SAMPLE_RATE)
+
+
+def decode_audio(path, sr=SAMPLE_RATE):
+    """解码为 sr 采样率的单声道 float32 波形; libsndfile 不支持的格式回退到 librosa"""
+    try:
+        audio, orig_sr = sf.read(path, dtype="float32", always_2d=False)
+        if audio.ndim > 1:
+            audio = audio.mean(axis=1)
+        if orig_sr != sr:
+            import librosa
+
+            audio = librosa.resample(audio, orig_sr=orig_sr, target_sr=sr)
+    except RuntimeError:
+        import librosa
+
+        audio, _ = librosa.load(path, sr=sr, mono=True)
+    return np.ascontiguousarray(audio, dtype=np.float32)
+
+
+def make_batches(paths, durations, batch_size, max_batch_seconds=None):
+    """
+    按时长升序分桶: 每批至多 batch_size 条, 且 (若指定) 按最长条目补齐后的总时长不超过 max_batch_seconds.
+    返回 [[index, ...], ...], 索引指向 paths.
+    """
+    order = sorted(range(len(paths)), key=lambda i: durations[i])
+    batches = []
+    batch = []
+    for idx in order:
+        if batch:
+            # 升序排列, 当前条目即为补齐长度
+            padded = durations[idx] * (len(batch) + 1)
+            if len(batch) >= batch_size or (max_batch_seconds and padded > max_batch_seconds):
+                batches.append(batch)
+                batch = []
+        batch.append(idx)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _split_result(item, language):
+    if isinstance(item, (tuple, list)):
+        return item[0], item[1]
+    return item, language
+
+
+def run_batch_asr(
+    inputs,
+    output_path,
+    transcribe_fn,
+    speaker,
+    language,
+    batch_size=16,
+    num_workers=4,
+    max_batch_seconds=None,
+    resume=True,
+    progress_fn=None,
+    should_stop=None,
+):
+    """
+    执行批量识别, 每完成一批即追加写入 output_path 并刷盘.
+
+    resume=True 时跳过 output_path 中已完成的条目; 全部完成后按输入顺序重写 .list,
+    与逐文件识别的输出顺序一致.
+    progress_fn(done, total) 在每批完成后调用; should_stop() 返回 True 时在批次边界停止.
+    返回统计信息字典.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    finished = read_finished(output_path) if resume else set()
+    if not resume and os.path.exists(output_path):
+        os.remove(output_path)
+
+    pending = [path for path in inputs if path not in finished]
+    total = len(inputs)
+    done = total - len(pending)
+    failed = 0
+    stopped = False
+
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+        durations = list(pool.map(probe_duration, pending))
+        batches = make_batches(pending, durations, max(1, batch_size), max_batch_seconds)
+
+        def submit(batch):
+            return [pool.submit(decode_audio, pending[i]) for i in batch]
+
+        # 预取下一批的解码, 使解码与识别重叠
+        next_futures = submit(batches[0]) if batches else None
+        with open(output_path, "a+", encoding="utf-8") as f:
+            _ensure_trailing_newline(f)
+            for batch_no, batch in enumerate(batches):
+                if should_stop is not None and should_stop():
+                    stopped = True
+                    break
+                futures = next_futures
+                next_futures = submit(batches[batch_no + 1]) if batch_no + 1 < len(batches) else None
+
+                paths, waveforms = [], []
+                for idx, future in zip(batch, futures):
+                    try:
+                        waveforms.append(future.result())
+                        paths.append(pending[idx])
+                    except Exception:
+                        failed += 1
+                        print(traceback.format_exc())
+
+                results = _transcribe_with_fallback(transcribe_fn, waveforms)
+                lines = []
+                for path, item in zip(paths, results):
+                    if item is None:
+                        failed += 1
+                        continue
+                    text, lang = _split_result(item, language)
+                    lines.append(f"{path}|{speaker}|{lang.upper()}|{text}\n")
+                f.writelines(lines)
+                f.flush()
+
+                done += len(batch)
+                if progress_fn is not None:
+                    progress_fn(done, total)
+
+        if next_futures:
+            for future in next_futures:
+                future.cancel()
+
+    if not stopped:
+        _reorder_list(output_path, inputs)
+
+    return {
+        "total": total,
+        "skipped": total - len(pending),
+        "done": done,
+        "failed": failed,
+        "stopped": stopped,
+        "output_path": os.path.abspath(output_path),
+    }
+
+
+def _ensure_trailing_newline(f):
+    """续跑时已完成的 .list 可能没有结尾换行, 追加前补上"""
+    if f.tell() == 0:
+        return
+    f.seek(0)
+    content = f.read()
+    if content and not content.endswith("\n"):
+        f.write("\n")
+
+
+def _transcribe_with_fallback(transcribe_fn, waveforms):
+    """整批识别失败时逐条重试, 只让出错的条目失败"""
+    if not waveforms:
+        return []
+    try:
+        return list(transcribe_fn(waveforms))
+    except Exception:
+        print(traceback.format_exc())
+    results = []
+    for waveform in waveforms:
+        try:
+            results.append(transcribe_fn([waveform])[0])
+        except Exception:
+            print(traceback.format_exc())
+            results.append(None)
+    return results
+
+
+def _reorder_list(output_path, inputs):
+    """按输入顺序重写 .list (原子替换)"""
+    if not os.path.exists(output_path):
+        return
+    rank = {path: i for i, path in enumerate(inputs)}
+    with open(output_path, "r", encoding="utf-8") as f:
+        lines = [line.rstrip("\n") for line in f if "|" in line]
+    lines.sort(key=lambda line: rank.get(line.split("|", 1)[0], len(rank)))
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+    os.replace(tmp_path, output_path)
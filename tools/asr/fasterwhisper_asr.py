@@ -9,6 +9,7 @@ from huggingface_hub import snapshot_download
 from huggingface_hub.errors import LocalEntryNotFoundError
 from tqdm import tqdm
 
+from tools.asr.batch_asr import collect_inputs, run_batch_asr
 from tools.asr.config import get_models
 from tools.asr.funasr_asr import only_asr
 from tools.my_utils import load_cudnn
@@ -81,50 +82,79 @@ def download_model(model_size: str):
     return model_path
 
 
-def execute_asr(input_folder, output_folder, model_path, language, precision):
+def transcribe_one(model, audio, language):
+    segments, info = model.transcribe(
+        audio=audio,
+        beam_size=5,
+        vad_filter=True,
+        vad_parameters=dict(min_silence_duration_ms=700),
+        language=language,
+    )
+    text = ""
+
+    if info.language == "zh":
+        print("检测为中文文本, 转 FunASR 处理")
+        text = only_asr(audio, language=info.language.lower())
+
+    if text == "":
+        for segment in segments:
+            text += segment.text
+    return text, info.language
+
+
+def execute_asr(input_folder, output_folder, model_path, language, precision, batch_size=1, num_workers=4, resume=True):
     if language == "auto":
         language = None  # 不设置语种由模型自动输出概率最高的语种
     print("loading faster whisper model:", model_path, model_path)
     device = "cuda" if torch.cuda.is_available() else "cpu"
     model = WhisperModel(model_path, device=device, compute_type=precision)
 
-    input_file_names = os.listdir(input_folder)
-    input_file_names.sort()
-
-    output = []
-    output_file_name = os.path.basename(input_folder)
-
-    for file_name in tqdm(input_file_names):
-        try:
-            file_path = os.path.join(input_folder, file_name)
-            segments, info = model.transcribe(
-                audio=file_path,
-                beam_size=5,
-                vad_filter=True,
-                vad_parameters=dict(min_silence_duration_ms=700),
-                language=language,
-            )
-            text = ""
-
-            if info.language == "zh":
-                print("检测为中文文本, 转 FunASR 处理")
-                text = only_asr(file_path, language=info.language.lower())
-
-            if text == "":
-                for segment in segments:
-                    text += segment.text
-            output.append(f"{file_path}|{output_file_name}|{info.language.upper()}|{text}")
-        except Exception as e:
-            print(e)
-            traceback.print_exc()
-
+    output_file_name = os.path.basename(os.path.normpath(input_folder))
+    if os.path.isfile(input_folder):
+        output_file_name = os.path.splitext(output_file_name)[0]
     output_folder = output_folder or "output/asr_opt"
-    os.makedirs(output_folder, exist_ok=True)
     output_file_path = os.path.abspath(f"{output_folder}/{output_file_name}.list")
 
-    with open(output_file_path, "w", encoding="utf-8") as f:
-        f.write("\n".join(output))
-        print(f"ASR 任务完成->标注文件路径: {output_file_path}\n")
+    # 逐文件识别与原来一样不按扩展名过滤目录中的文件
+    input_files = collect_inputs(input_folder, audio_only=batch_size > 1)
+
+    if batch_size <= 1:
+        # 逐文件识别, 保持原有行为
+        output = []
+        for file_path in tqdm(input_files):
+            try:
+                text, detected_language = transcribe_one(model, file_path, language)
+                output.append(f"{file_path}|{output_file_name}|{detected_language.upper()}|{text}")
+            except Exception as e:
+                print(e)
+                traceback.print_exc()
+
+        os.makedirs(output_folder, exist_ok=True)
+        with open(output_file_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(output))
+    else:
+        # Whisper 不支持跨文件批推理, 批模式下复用并行解码预取, 按时长排序, 增量写出与断点续跑
+        progress = tqdm(total=len(input_files))
+
+        def update_progress(done, total):
+            progress.n = done
+            progress.refresh()
+
+        stats = run_batch_asr(
+            input_files,
+            output_file_path,
+            lambda waveforms: [transcribe_one(model, waveform, language) for waveform in waveforms],
+            speaker=output_file_name,
+            language=language or "auto",
+            batch_size=batch_size,
+            num_workers=num_workers,
+            resume=resume,
+            progress_fn=update_progress,
+        )
+        progress.close()
+        print(f"批量识别: 共 {stats['total']} 条, 续跑跳过 {stats['skipped']} 条, 失败 {stats['failed']} 条")
+
+    print(f"ASR 任务完成->标注文件路径: {output_file_path}\n")
     return output_file_path
 
 
@@ -133,7 +163,11 @@ load_cudnn()
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "-i", "--input_folder", type=str, required=True, help="Path to the folder containing WAV files."
+        "-i",
+        "--input_folder",
+        type=str,
+        required=True,
+        help="Path to the folder containing WAV files, or a manifest with one path per line.",
     )
     parser.add_argument("-o", "--output_folder", type=str, required=True, help="Output folder to store transcriptions.")
     parser.add_argument(
@@ -155,6 +189,9 @@ if __name__ == "__main__":
         choices=["float16", "float32", "int8"],
         help="fp16, int8 or fp32",
     )
+    parser.add_argument("-b", "--batch_size", type=int, default=1, help="Clips decoded ahead per batch.")
+    parser.add_argument("-w", "--num_workers", type=int, default=4, help="Audio decoding threads.")
+    parser.add_argument("--no_resume", action="store_true", help="Ignore an existing .list and start over.")
 
     cmd = parser.parse_args()
     model_size = cmd.model_size
@@ -167,4 +204,7 @@ if __name__ == "__main__":
         model_path=model_path,
         language=cmd.language,
         precision=cmd.precision,
+        batch_size=cmd.batch_size,
+        num_workers=cmd.num_workers,
+        resume=not cmd.no_resume,
     )
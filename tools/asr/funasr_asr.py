@@ -2,6 +2,7 @@
 
 import argparse
 import os
+import time
 import traceback
 
 # from funasr.utils import version_checker
@@ -9,6 +10,8 @@ import traceback
 from funasr import AutoModel
 from tqdm import tqdm
 
+from tools.asr.batch_asr import collect_inputs, run_batch_asr
+
 funasr_models = {}  # 存储模型避免重复加载
 
 
@@ -22,7 +25,8 @@ def only_asr(input_file, language):
     return text
 
 
-def create_model(language="zh"):
+def model_paths(language="zh"):
+    """ASR/VAD/标点模型的路径与版本, 本地没有时用 modelscope 上的名称"""
     path_vad = "tools/asr/models/speech_fsmn_vad_zh-cn-16k-common-pytorch"
     path_punc = "tools/asr/models/punc_ct-transformer_zh-cn-common-vocab272727-pytorch"
     path_vad = path_vad if os.path.exists(path_vad) else "iic/speech_fsmn_vad_zh-cn-16k-common-pytorch"
@@ -51,55 +55,159 @@ def create_model(language="zh"):
     else:
         raise ValueError("FunASR 不支持该语言" + ": " + language)
 
+    return dict(
+        model=path_asr,
+        model_revision=model_revision,
+        vad_model=path_vad,
+        vad_model_revision=vad_model_revision,
+        punc_model=path_punc,
+        punc_model_revision=punc_model_revision,
+    )
+
+
+def create_model(language="zh"):
+    paths = model_paths(language)
+
     if language in funasr_models:
         return funasr_models[language]
     else:
-        model = AutoModel(
-            model=path_asr,
-            model_revision=model_revision,
-            vad_model=path_vad,
-            vad_model_revision=vad_model_revision,
-            punc_model=path_punc,
-            punc_model_revision=punc_model_revision,
-        )
+        model = AutoModel(**paths)
         print(f"FunASR 模型加载完成: {language.upper()}")
 
         funasr_models[language] = model
         return model
 
 
-def execute_asr(input_folder, output_folder, model_size, language):
-    input_file_names = os.listdir(input_folder)
-    input_file_names.sort()
+def create_batch_models(language="zh"):
+    """
+    批量识别用的三个独立模型: (vad, asr, punc), 粤语没有 vad/punc 时为 None.
+    ASR 模型不挂 VAD: 挂了 VAD 的 generate 会逐条输入处理, batch_size 只作用于 VAD 阶段
+    """
+    key = f"{language}:batch"
+    if key not in funasr_models:
+        paths = model_paths(language)
+        vad = (
+            AutoModel(model=paths["vad_model"], model_revision=paths["vad_model_revision"])
+            if paths["vad_model"]
+            else None
+        )
+        asr = AutoModel(model=paths["model"], model_revision=paths["model_revision"])
+        punc = (
+            AutoModel(model=paths["punc_model"], model_revision=paths["punc_model_revision"])
+            if paths["punc_model"]
+            else None
+        )
+        print(f"FunASR 批量识别模型加载完成: {language.upper()}")
+        funasr_models[key] = (vad, asr, punc)
+    return funasr_models[key]
+
+
+def split_by_vad(vad, waveform, sr=16000):
+    """按 VAD 切出语音段; 没有 VAD 时整条作为一段"""
+    if vad is None:
+        return [waveform]
+    segments = vad.generate(input=waveform, fs=sr)[0]["value"]
+    return [waveform[start * sr // 1000 : end * sr // 1000] for start, end in segments if end > start]
+
+
+def transcribe_batch(models, waveforms, language="zh"):
+    """
+    16k 单声道波形列表: 逐条过 VAD, 所有文件的语音段按长度排序后一次送入 ASR (真正按 batch 解码),
+    再按文件拼接并逐条加标点. 返回与输入等长的文本列表
+    """
+    vad, asr, punc = models
+    owners, segments = [], []
+    for i, waveform in enumerate(waveforms):
+        for segment in split_by_vad(vad, waveform):
+            owners.append(i)
+            segments.append(segment)
+
+    texts = [[] for _ in waveforms]
+    if segments:
+        # 长度相近的段相邻, 减少补齐; UniASR (粤语) 不支持 batch 解码, 逐段识别
+        order = sorted(range(len(segments)), key=lambda j: len(segments[j]))
+        if language == "yue":
+            results = [asr.generate(input=segments[j], fs=16000)[0] for j in order]
+        else:
+            results = asr.generate(input=[segments[j] for j in order], fs=16000, batch_size=len(order))
+        by_segment = [None] * len(segments)
+        for j, result in zip(order, results):
+            by_segment[j] = result["text"]
+        for owner, text in zip(owners, by_segment):
+            if text:
+                texts[owner].append(text)
 
     output = []
-    output_file_name = os.path.basename(input_folder)
-
-    model = create_model(language)
-
-    for file_name in tqdm(input_file_names):
-        try:
-            print("\n" + file_name)
-            file_path = os.path.join(input_folder, file_name)
-            text = model.generate(input=file_path)[0]["text"]
-            output.append(f"{file_path}|{output_file_name}|{language.upper()}|{text}")
-        except:
-            print(traceback.format_exc())
-
+    for parts in texts:
+        text = " ".join(parts)
+        if punc is not None and text:
+            text = punc.generate(input=text)[0]["text"]
+        output.append(text)
+    return output
+
+
+def execute_asr(input_folder, output_folder, model_size, language, batch_size=1, num_workers=4, resume=True):
+    output_file_name = os.path.basename(os.path.normpath(input_folder))
+    if os.path.isfile(input_folder):
+        output_file_name = os.path.splitext(output_file_name)[0]
     output_folder = output_folder or "output/asr_opt"
-    os.makedirs(output_folder, exist_ok=True)
     output_file_path = os.path.abspath(f"{output_folder}/{output_file_name}.list")
 
-    with open(output_file_path, "w", encoding="utf-8") as f:
-        f.write("\n".join(output))
-        print(f"ASR 任务完成->标注文件路径: {output_file_path}\n")
+    # 逐文件识别与原来一样不按扩展名过滤目录中的文件
+    input_files = collect_inputs(input_folder, audio_only=batch_size > 1)
+
+    if batch_size <= 1:
+        # 逐文件识别, 保持原有行为
+        model = create_model(language)
+        output = []
+        for file_path in tqdm(input_files):
+            try:
+                print("\n" + os.path.basename(file_path))
+                text = model.generate(input=file_path)[0]["text"]
+                output.append(f"{file_path}|{output_file_name}|{language.upper()}|{text}")
+            except:
+                print(traceback.format_exc())
+
+        os.makedirs(output_folder, exist_ok=True)
+        with open(output_file_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(output))
+    else:
+        models = create_batch_models(language)
+        progress = tqdm(total=len(input_files))
+        t0 = time.perf_counter()
+
+        def update_progress(done, total):
+            progress.n = done
+            progress.refresh()
+
+        stats = run_batch_asr(
+            input_files,
+            output_file_path,
+            lambda waveforms: transcribe_batch(models, waveforms, language),
+            speaker=output_file_name,
+            language=language,
+            batch_size=batch_size,
+            num_workers=num_workers,
+            resume=resume,
+            progress_fn=update_progress,
+        )
+        progress.close()
+        elapsed = time.perf_counter() - t0
+        print(f"批量识别: 共 {stats['total']} 条, 续跑跳过 {stats['skipped']} 条, 失败 {stats['failed']} 条")
+        print(f"批量识别吞吐: {(stats['total'] - stats['skipped']) / max(elapsed, 1e-6):.2f} 条/秒 (batch_size={batch_size})")
+
+    print(f"ASR 任务完成->标注文件路径: {output_file_path}\n")
     return output_file_path
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "-i", "--input_folder", type=str, required=True, help="Path to the folder containing WAV files."
+        "-i",
+        "--input_folder",
+        type=str,
+        required=True,
+        help="Path to the folder containing WAV files, or a manifest with one path per line.",
     )
     parser.add_argument("-o", "--output_folder", type=str, required=True, help="Output folder to store transcriptions.")
     parser.add_argument("-s", "--model_size", type=str, default="large", help="Model Size of FunASR is Large")
@@ -109,10 +217,16 @@ if __name__ == "__main__":
     parser.add_argument(
         "-p", "--precision", type=str, default="float16", choices=["float16", "float32"], help="fp16 or fp32"
     )  # 还没接入
+    parser.add_argument("-b", "--batch_size", type=int, default=1, help="Clips per batched generate call.")
+    parser.add_argument("-w", "--num_workers", type=int, default=4, help="Audio decoding threads.")
+    parser.add_argument("--no_resume", action="store_true", help="Ignore an existing .list and start over.")
     cmd = parser.parse_args()
     execute_asr(
         input_folder=cmd.input_folder,
         output_folder=cmd.output_folder,
         model_size=cmd.model_size,
         language=cmd.language,
+        batch_size=cmd.batch_size,
+        num_workers=cmd.num_workers,
+        resume=not cmd.no_resume,
     )
@@ -0,0 +1,186 @@
+"""
+进程内音频解码
+
+load_audio 原来每个文件都要启动一个 ffmpeg 子进程, 短音频时进程启动开销占了大头. 这里按格式分三条路径:
+- WAV/FLAC: soundfile (libsndfile) 直接解码, 重采样用缓存好滤波器系数的多相重采样 (scipy.signal.resample_poly)
+- 其他格式: PyAV 在进程内解码 (faster-whisper 已依赖 av), 没装 av 时回退到 ffmpeg 子进程
+- ffmpeg 子进程全部在一个常驻的有界线程池里执行, 批量解码时不会一次拉起过多进程
+输出与原 load_audio 一致: 单声道 float32, 取值 -1~1.
+
+python tools/audio_decoder.py <目录或文件...> --sr 32000  可对比 ffmpeg 子进程与本模块的 clips/sec.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from math import gcd
+
+import ffmpeg
+import numpy as np
+import soundfile as sf
+from scipy.signal import firwin, resample_poly
+
+try:
+    import av
+
+    AV_AVAILABLE = True
+except ImportError:
+    AV_AVAILABLE = False
+
+SOUNDFILE_EXTENSIONS = {".wav", ".flac"}
+FFMPEG_WORKERS = int(os.environ.get("ffmpeg_workers", min(8, os.cpu_count() or 1)))
+
+_resample_filters = {}
+_resample_lock = threading.Lock()
+_ffmpeg_pool = None
+_ffmpeg_pool_lock = threading.Lock()
+
+
+def _resample_filter(up, down):
+    """按 (up, down) 缓存 FIR 低通滤波器, 与 resample_poly 默认设计相同 (kaiser 窗, beta=5)"""
+    key = (up, down)
+    h = _resample_filters.get(key)
+    if h is None:
+        with _resample_lock:
+            h = _resample_filters.get(key)
+            if h is None:
+                max_rate = max(up, down)
+                h = firwin(2 * 10 * max_rate + 1, 1.0 / max_rate, window=("kaiser", 5.0)).astype(np.float32)
+                _resample_filters[key] = h
+    return h
+
+
+def resample(audio, orig_sr, target_sr):
+    """单声道波形重采样, 采样率相同时原样返回"""
+    if orig_sr == target_sr:
+        return audio
+    g = gcd(int(orig_sr), int(target_sr))
+    up, down = int(target_sr) // g, int(orig_sr) // g
+    # resample_poly 会修改传入的系数数组, 传副本
+    return resample_poly(audio, up, down, window=_resample_filter(up, down).copy()).astype(np.float32, copy=False)
+
+
+def _to_mono(audio):
+    # 与 ffmpeg -ac 1 的下混一致: 各声道取平均
+    if audio.ndim > 1:
+        audio = audio.mean(axis=1)
+    return audio
+
+
+def decode_soundfile(file, sr):
+    audio, orig_sr = sf.read(file, dtype="float32", always_2d=False)
+    return np.ascontiguousarray(resample(_to_mono(audio), orig_sr, sr), dtype=np.float32)
+
+
+def decode_av(file, sr):
+    with av.open(file) as container:
+        stream = container.streams.audio[0]
+        resampler = av.AudioResampler(format="flt", layout="mono", rate=sr)
+        parts = []
+        for frame in container.decode(stream):
+            frame.pts = None
+            for out in resampler.resample(frame):
+                parts.append(out.to_ndarray().reshape(-1))
+        for out in resampler.resample(None):
+            parts.append(out.to_ndarray().reshape(-1))
+    if not parts:
+        return np.zeros(0, dtype=np.float32)
+    return np.ascontiguousarray(np.concatenate(parts), dtype=np.float32)
+
+
+def decode_ffmpeg(file, sr):
+    out, _ = (
+        ffmpeg.input(file, threads=0)
+        .output("-", format="f32le", acodec="pcm_f32le", ac=1, ar=sr)
+        .run(cmd=["ffmpeg", "-nostdin"], capture_stdout=True, capture_stderr=True)
+    )
+    return np.frombuffer(out, np.float32).flatten()
+
+
+def _get_ffmpeg_pool():
+    global _ffmpeg_pool
+    if _ffmpeg_pool is None:
+        with _ffmpeg_pool_lock:
+            if _ffmpeg_pool is None:
+                _ffmpeg_pool = ThreadPoolExecutor(max_workers=max(1, FFMPEG_WORKERS), thread_name_prefix="ffmpeg_decode")
+    return _ffmpeg_pool
+
+
+def decode_audio(file, sr):
+    """解码为 sr 采样率的单声道 float32 波形, 快速路径失败时回退到 ffmpeg 子进程"""
+    ext = os.path.splitext(file)[1].lower()
+    try:
+        if ext in SOUNDFILE_EXTENSIONS:
+            return decode_soundfile(file, sr)
+        if AV_AVAILABLE:
+            return decode_av(file, sr)
+    except Exception:
+        pass
+    return _get_ffmpeg_pool().submit(decode_ffmpeg, file, sr).result()
+
+
+def decode_audio_batch(files, sr, num_workers=4, return_exceptions=False):
+    """
+    用线程池并行解码一组文件, 结果按输入顺序返回.
+    return_exceptions=True 时出错的文件在对应位置返回异常对象而不是抛出.
+    """
+
+    def run(file):
+        try:
+            return decode_audio(file, sr)
+        except Exception as e:
+            if return_exceptions:
+                return e
+            raise
+
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+        return list(pool.map(run, files))
+
+
+def main():
+    import time
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Compare ffmpeg subprocess decoding with in-process decoding (clips/sec)")
+    parser.add_argument("inputs", nargs="+", help="Audio files or folders")
+    parser.add_argument("--sr", type=int, default=32000)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--limit", type=int, default=200, help="Maximum number of clips")
+    args = parser.parse_args()
+
+    files = []
+    for path in args.inputs:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path)))
+        else:
+            files.append(path)
+    files = [file for file in files if os.path.isfile(file)][: args.limit]
+    if not files:
+        print("no input files")
+        return
+
+    def bench(name, fn):
+        t0 = time.perf_counter()
+        outputs = fn()
+        cost = time.perf_counter() - t0
+        print("%-28s %8.1f clips/sec  (%.2fs)" % (name, len(files) / cost, cost))
+        return outputs
+
+    reference = bench("ffmpeg subprocess", lambda: [decode_ffmpeg(file, args.sr) for file in files])
+    bench("in-process", lambda: [decode_audio(file, args.sr) for file in files])
+    batched = bench(
+        "in-process batch x%d" % args.num_workers, lambda: decode_audio_batch(files, args.sr, args.num_workers)
+    )
+
+    max_diff = 0.0
+    max_len_diff = 0
+    for ref, out in zip(reference, batched):
+        n = min(len(ref), len(out))
+        max_len_diff = max(max_len_diff, abs(len(ref) - len(out)))
+        if n:
+            max_diff = max(max_diff, float(np.abs(ref[:n] - out[:n]).max()))
+    print("max abs diff vs ffmpeg: %.6f, max length diff: %d samples" % (max_diff, max_len_diff))
+
+
+if __name__ == "__main__":
+    main()
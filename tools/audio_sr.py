@@ -5,6 +5,8 @@ import os
 AP_BWE_main_dir_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "AP_BWE_main")
 sys.path.append(AP_BWE_main_dir_path)
 import json
+import math
+import numpy as np
 import torch
 import torchaudio.functional as aF
 # from attrdict import AttrDict####will be bug in py3.10
@@ -32,19 +34,110 @@ class AP_BWE:
         self.device = device
         self.model = model
         self.h = h
+        # 超过该时长 (秒) 的整段输入改为分块处理, 0 表示总是整段处理
+        self.chunk_seconds = float(os.environ.get("ap_bwe_chunk_seconds", 30))
 
     def to(self, *arg, **kwargs):
         self.model.to(*arg, **kwargs)
         self.device = self.model.conv_pre_mag.weight.device
         return self
 
-    def __call__(self, audio, orig_sampling_rate):
+    def super_sample(self, audio, orig_sampling_rate):
+        """audio: (1, n) 原采样率, 返回 (1, m) hr_sampling_rate 的张量 (仍在模型设备上)"""
         with torch.no_grad():
-            # audio, orig_sampling_rate = torchaudio.load(inp_path)
-            # audio = audio.to(self.device)
             audio = aF.resample(audio, orig_freq=orig_sampling_rate, new_freq=self.h.hr_sampling_rate)
             amp_nb, pha_nb, com_nb = amp_pha_stft(audio, self.h.n_fft, self.h.hop_size, self.h.win_size)
             amp_wb_g, pha_wb_g, com_wb_g = self.model(amp_nb, pha_nb)
-            audio_hr_g = amp_pha_istft(amp_wb_g, pha_wb_g, self.h.n_fft, self.h.hop_size, self.h.win_size)
-            # sf.write(opt_path, audio_hr_g.squeeze().cpu().numpy(), self.h.hr_sampling_rate, 'PCM_16')
-            return audio_hr_g.squeeze().cpu().numpy(), self.h.hr_sampling_rate
+            return amp_pha_istft(amp_wb_g, pha_wb_g, self.h.n_fft, self.h.hop_size, self.h.win_size)
+
+    def stream(self, orig_sampling_rate):
+        return AP_BWEStream(self, orig_sampling_rate)
+
+    def __call__(self, audio, orig_sampling_rate):
+        # audio, orig_sampling_rate = torchaudio.load(inp_path)
+        # audio = audio.to(self.device)
+        chunk = int(self.chunk_seconds * orig_sampling_rate)
+        if chunk > 0 and audio.shape[-1] > chunk:
+            # 长音频分块重叠处理, 显存占用与时长无关
+            stream = self.stream(orig_sampling_rate)
+            audio = audio.reshape(-1)
+            outputs = [stream.push(audio[i : i + chunk]) for i in range(0, audio.shape[0], chunk)]
+            outputs.append(stream.flush())
+            return np.concatenate(outputs), self.h.hr_sampling_rate
+        audio_hr_g = self.super_sample(audio, orig_sampling_rate)
+        # sf.write(opt_path, audio_hr_g.squeeze().cpu().numpy(), self.h.hr_sampling_rate, 'PCM_16')
+        return audio_hr_g.squeeze().cpu().numpy(), self.h.hr_sampling_rate
+
+
+class AP_BWEStream:
+    """
+    分段超采样: 按原采样率逐段 push, 每次返回已经确定的高采样率输出, 结束时 flush 取出剩余部分.
+    AP_BWE 是局部的卷积网络, 每个窗口带上 context 长的左侧上下文和右侧预读一起推理, 只输出中间部分.
+    窗口起点都对齐到 STFT 帧 (hop) 上, 相邻窗口重叠处的帧位置相同、相位连续, 再用 overlap 长的升余弦窗交叉淡化拼接.
+    context / overlap / min_chunk 的单位为帧.
+    """
+
+    def __init__(self, bwe, orig_sampling_rate, context=64, overlap=4, min_chunk=32):
+        self.bwe = bwe
+        self.orig_sr = orig_sampling_rate
+        self.sr = bwe.h.hr_sampling_rate
+        hop = bwe.h.hop_size * orig_sampling_rate
+        # 原采样率下一帧对应的样本数, 及其在输出中的样本数 (hop 的整数倍)
+        self.step = hop // math.gcd(hop, self.sr)
+        self.out_step = self.step * self.sr // orig_sampling_rate
+        self.context = context * self.step
+        self.overlap = overlap * self.step
+        self.min_chunk = min_chunk * self.step
+        fade = torch.linspace(0, 1, overlap * self.out_step)
+        self.fade_in = 0.5 - 0.5 * torch.cos(math.pi * fade)
+        self.buffer = None  # 原采样率输入, buffer[0] 位于 self.start
+        self.start = 0
+        self.emitted = 0  # 已输出到的位置 (原采样率样本), 其后 overlap 长的输出暂存在 tail
+        self.tail = None
+        self.end = 0
+
+    def to_out(self, position):
+        return position // self.step * self.out_step
+
+    def push(self, audio):
+        audio = audio.reshape(-1).float().to(self.bwe.device)
+        if self.buffer is None:
+            self.buffer = audio
+        else:
+            self.buffer = torch.cat([self.buffer.to(self.bwe.device), audio])
+        self.end += audio.shape[0]
+        outputs = []
+        while True:
+            valid_end = (self.end - self.context) // self.step * self.step
+            if valid_end - self.emitted < self.min_chunk + self.overlap:
+                break
+            outputs.append(self.process(valid_end, False))
+        return np.concatenate(outputs) if outputs else np.zeros(0, dtype=np.float32)
+
+    def flush(self):
+        if self.buffer is None:
+            return np.zeros(0, dtype=np.float32)
+        output = self.process(self.end, True)
+        self.buffer = None
+        return output
+
+    def process(self, valid_end, final):
+        window = self.buffer if final else self.buffer[: valid_end + self.context - self.start]
+        audio = self.bwe.super_sample(window.unsqueeze(0), self.orig_sr)[0]
+        offset = self.to_out(self.emitted - self.start)
+        stop = audio.shape[0] if final else self.to_out(valid_end - self.start)
+        segment = audio[offset:stop].clone()
+        if self.tail is not None:
+            n = min(self.tail.shape[0], segment.shape[0])
+            fade_in = self.fade_in[:n].to(segment.device)
+            segment[:n] = self.tail[:n].to(segment.device) * (1 - fade_in) + segment[:n] * fade_in
+        if final:
+            self.tail = None
+        else:
+            n = self.to_out(self.overlap)
+            segment, self.tail = segment[:-n], segment[-n:]
+            self.emitted = valid_end - self.overlap
+            start = max(0, self.emitted - self.context)
+            self.buffer = self.buffer[start - self.start :]
+            self.start = start
+        return segment.cpu().numpy()
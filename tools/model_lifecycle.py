@@ -0,0 +1,298 @@
+"""
+辅助模型生命周期管理
+
+按模型设置空闲超时 (idle TTL), 超时或内存紧张时自动卸载空闲模型, 使用时按需重新加载,
+请求流量恢复时可在后台线程中提前预加载. 模型只需提供 load / unload / is_loaded 三个回调,
+使用方通过 manager.use(name) 上下文声明正在使用, 使用中的模型不会被卸载.
+"""
+
+import gc
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional
+
+import psutil
+
+
+class ManagedModel:
+    def __init__(
+        self,
+        name: str,
+        load_fn: Callable[[], object],
+        unload_fn: Callable[[], None],
+        is_loaded_fn: Callable[[], bool],
+        idle_ttl: Optional[float] = None,
+        priority: int = 0,
+        groups: Iterable[str] = (),
+    ):
+        self.name = name
+        self.load_fn = load_fn
+        self.unload_fn = unload_fn
+        self.is_loaded_fn = is_loaded_fn
+        self.idle_ttl = idle_ttl  # None 表示不因空闲而卸载
+        self.priority = priority  # 内存紧张时数值小的先卸载
+        self.groups = set(groups)
+        self.lock = threading.RLock()
+        self.refcount = 0
+        self.last_used = time.time()
+        self.loading = False
+        self.load_count = 0
+        self.unload_count = 0
+        self.last_load_seconds: Optional[float] = None
+        self.last_unload_reason: Optional[str] = None
+        self.last_error: Optional[str] = None
+
+    @property
+    def is_loaded(self) -> bool:
+        try:
+            return bool(self.is_loaded_fn())
+        except Exception:
+            return False
+
+    def idle_seconds(self) -> float:
+        return time.time() - self.last_used
+
+    def load(self):
+        with self.lock:
+            if self.is_loaded:
+                return
+            self.loading = True
+            t0 = time.perf_counter()
+            try:
+                self.load_fn()
+                self.load_count += 1
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                raise
+            finally:
+                self.loading = False
+                self.last_load_seconds = time.perf_counter() - t0
+                self.last_used = time.time()
+
+    def unload(self, reason: str) -> bool:
+        """仅在模型已加载且无人使用时卸载, 返回是否卸载"""
+        if not self.lock.acquire(blocking=False):
+            return False
+        try:
+            if self.refcount > 0 or not self.is_loaded:
+                return False
+            self.unload_fn()
+            self.unload_count += 1
+            self.last_unload_reason = reason
+            return True
+        except Exception as e:
+            self.last_error = str(e)
+            traceback.print_exc()
+            return False
+        finally:
+            self.lock.release()
+
+    def to_dict(self) -> dict:
+        return {
+            "loaded": self.is_loaded,
+            "loading": self.loading,
+            "in_use": self.refcount,
+            "idle_seconds": round(self.idle_seconds(), 1),
+            "idle_ttl": self.idle_ttl,
+            "load_count": self.load_count,
+            "unload_count": self.unload_count,
+            "last_load_seconds": self.last_load_seconds,
+            "last_unload_reason": self.last_unload_reason,
+            "last_error": self.last_error,
+        }
+
+
+class ModelLifecycleManager:
+    def __init__(
+        self,
+        check_interval: float = 30.0,
+        memory_limit_percent: Optional[float] = 90.0,
+        gpu_memory_limit_percent: Optional[float] = 90.0,
+        enabled: bool = True,
+    ):
+        """
+        Args:
+            check_interval: 后台检查间隔 (秒).
+            memory_limit_percent: 系统内存占用超过该百分比时卸载空闲模型, None 表示不检查.
+            gpu_memory_limit_percent: 显存占用超过该百分比时卸载空闲模型, None 表示不检查.
+            enabled: 为 False 时只记录使用情况并上报状态, 不做任何自动卸载.
+        """
+        self.models: Dict[str, ManagedModel] = {}
+        self.check_interval = check_interval
+        self.memory_limit_percent = memory_limit_percent
+        self.gpu_memory_limit_percent = gpu_memory_limit_percent
+        self.enabled = enabled
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model_preload")
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def register(
+        self,
+        name: str,
+        load_fn: Callable[[], object],
+        unload_fn: Callable[[], None],
+        is_loaded_fn: Callable[[], bool],
+        idle_ttl: Optional[float] = None,
+        priority: int = 0,
+        groups: Iterable[str] = (),
+    ) -> ManagedModel:
+        model = ManagedModel(name, load_fn, unload_fn, is_loaded_fn, idle_ttl, priority, groups)
+        self.models[name] = model
+        return model
+
+    @contextmanager
+    def use(self, name: str):
+        """声明正在使用模型: 未加载时同步加载, 退出前不会被卸载"""
+        model = self.models.get(name)
+        if model is None:
+            yield
+            return
+        with model.lock:
+            model.refcount += 1
+        try:
+            model.load()
+            yield
+        finally:
+            with model.lock:
+                model.refcount -= 1
+                model.last_used = time.time()
+
+    def touch(self, name: str):
+        model = self.models.get(name)
+        if model is not None:
+            model.last_used = time.time()
+
+    def preload_async(self, names: Iterable[str]) -> List[str]:
+        """在后台线程中加载尚未加载的模型, 返回已提交加载的模型名"""
+        submitted = []
+        for name in names:
+            model = self.models.get(name)
+            if model is None or model.is_loaded or model.loading:
+                continue
+            model.last_used = time.time()
+            self._executor.submit(self._safe_load, model)
+            submitted.append(name)
+        return submitted
+
+    def notify_activity(self, group: str) -> List[str]:
+        """某类请求到达: 刷新该组模型的使用时间, 并异步预加载已被卸载的模型"""
+        names = [name for name, model in self.models.items() if group in model.groups]
+        for name in names:
+            self.touch(name)
+        return self.preload_async(names)
+
+    def _safe_load(self, model: ManagedModel):
+        try:
+            model.load()
+            print(f"[model_lifecycle] 预加载完成: {model.name} ({model.last_load_seconds:.2f}s)")
+        except Exception:
+            traceback.print_exc()
+
+    def unload(self, name: str, reason: str = "manual") -> bool:
+        model = self.models.get(name)
+        if model is None:
+            return False
+        unloaded = model.unload(reason)
+        if unloaded:
+            self._release_memory()
+            print(f"[model_lifecycle] 已卸载 {name} ({reason})")
+        return unloaded
+
+    def start(self):
+        if self._thread is not None or not self.enabled:
+            return
+        self._thread = threading.Thread(target=self._monitor, name="model_lifecycle", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._executor.shutdown(wait=False)
+
+    def _monitor(self):
+        while not self._stop_event.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception:
+                traceback.print_exc()
+
+    def check(self) -> List[str]:
+        """卸载超过空闲时限的模型; 内存紧张时再按优先级和空闲时长卸载空闲模型"""
+        unloaded = []
+        for name, model in list(self.models.items()):
+            if model.idle_ttl is not None and model.idle_seconds() > model.idle_ttl:
+                if model.unload("idle"):
+                    unloaded.append(name)
+
+        pressure = self.memory_pressure()
+        if pressure is not None:
+            candidates = sorted(
+                # 刚用过的模型不参与, 避免在内存边界上反复加载/卸载
+                (
+                    model
+                    for model in self.models.values()
+                    if model.is_loaded and model.refcount == 0 and model.idle_seconds() > self.check_interval
+                ),
+                key=lambda model: (model.priority, -model.idle_seconds()),
+            )
+            for model in candidates:
+                if model.unload(pressure):
+                    unloaded.append(model.name)
+                    self._release_memory()
+                    if self.memory_pressure() is None:
+                        break
+
+        if unloaded:
+            self._release_memory()
+            print(f"[model_lifecycle] 已卸载: {', '.join(unloaded)}")
+        return unloaded
+
+    def memory_pressure(self) -> Optional[str]:
+        """返回内存紧张的原因, 不紧张时返回 None"""
+        if self.memory_limit_percent is not None:
+            if psutil.virtual_memory().percent > self.memory_limit_percent:
+                return "memory_pressure"
+        if self.gpu_memory_limit_percent is not None:
+            usage = self._gpu_memory_percent()
+            if usage is not None and usage > self.gpu_memory_limit_percent:
+                return "gpu_memory_pressure"
+        return None
+
+    @staticmethod
+    def _gpu_memory_percent() -> Optional[float]:
+        try:
+            import torch
+
+            if not torch.cuda.is_available():
+                return None
+            free, total = torch.cuda.mem_get_info()
+            return (total - free) / total * 100
+        except Exception:
+            return None
+
+    @staticmethod
+    def _release_memory():
+        gc.collect()
+        try:
+            import torch
+
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except Exception:
+            pass
+
+    def status(self) -> dict:
+        process = psutil.Process()
+        return {
+            "enabled": self.enabled,
+            "check_interval": self.check_interval,
+            "memory_limit_percent": self.memory_limit_percent,
+            "gpu_memory_limit_percent": self.gpu_memory_limit_percent,
+            "process_rss_mb": round(process.memory_info().rss / 1024 / 1024, 1),
+            "system_memory_percent": psutil.virtual_memory().percent,
+            "gpu_memory_percent": self._gpu_memory_percent(),
+            "models": {name: model.to_dict() for name, model in self.models.items()},
+        }
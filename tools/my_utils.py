@@ -8,6 +8,7 @@ import gradio as gr
 import numpy as np
 import pandas as pd
 
+from tools.audio_decoder import decode_audio, decode_audio_batch
 from tools.i18n.i18n import I18nAuto
 
 i18n = I18nAuto(language=os.environ.get("language", "Auto"))
@@ -15,17 +16,11 @@ i18n = I18nAuto(language=os.environ.get("language", "Auto"))
 
 def load_audio(file, sr):
     try:
-        # https://github.com/openai/whisper/blob/main/whisper/audio.py#L26
-        # This launches a subprocess to decode audio while down-mixing and resampling as necessary.
-        # Requires the ffmpeg CLI and `ffmpeg-python` package to be installed.
+        # WAV/FLAC 在进程内解码, 其他格式交给 PyAV, 都不行时才启动 ffmpeg 子进程 (见 tools/audio_decoder.py)
         file = clean_path(file)  # 防止小白拷路径头尾带了空格和"和回车
         if os.path.exists(file) is False:
             raise RuntimeError("You input a wrong audio path that does not exists, please fix it!")
-        out, _ = (
-            ffmpeg.input(file, threads=0)
-            .output("-", format="f32le", acodec="pcm_f32le", ac=1, ar=sr)
-            .run(cmd=["ffmpeg", "-nostdin"], capture_stdout=True, capture_stderr=True)
-        )
+        return decode_audio(file, sr)
     except Exception:
         out, _ = (
             ffmpeg.input(file, threads=0)
@@ -34,7 +29,39 @@ def load_audio(file, sr):
         )  # Expose the Error
         raise RuntimeError(i18n("音频加载失败"))
 
-    return np.frombuffer(out, np.float32).flatten()
+
+def load_audio_batch(files, sr, num_workers=4, return_exceptions=False):
+    """用线程池批量解码, 结果按输入顺序返回; return_exceptions=True 时失败的文件返回异常对象"""
+    return decode_audio_batch([clean_path(file) for file in files], sr, num_workers, return_exceptions)
+
+
+def load_audio_blocks(file, sr, block_size=32000 * 10):
+    """
+    load_audio 的流式版本: 逐块产出单声道 float32 波形 (每块 block_size 个采样点, 最后一块可能更短),
+    长音频不必整体解码进内存.
+    """
+    file = clean_path(file)  # 防止小白拷路径头尾带了空格和"和回车
+    if os.path.exists(file) is False:
+        raise RuntimeError("You input a wrong audio path that does not exists, please fix it!")
+    process = (
+        ffmpeg.input(file, threads=0)
+        .output("-", format="f32le", acodec="pcm_f32le", ac=1, ar=sr)
+        .run_async(cmd=["ffmpeg", "-nostdin", "-loglevel", "error"], pipe_stdout=True, pipe_stderr=True)
+    )
+    try:
+        while True:
+            data = process.stdout.read(block_size * 4)
+            if not data:
+                break
+            yield np.frombuffer(data, np.float32)
+        process.stdout.close()
+        if process.wait() != 0:
+            print(process.stderr.read().decode("utf-8", errors="ignore"))  # Expose the Error
+            raise RuntimeError(i18n("音频加载失败"))
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
 
 
 def clean_path(path_str: str):
@@ -6,7 +6,7 @@ from scipy.io import wavfile
 
 # parent_directory = os.path.dirname(os.path.abspath(__file__))
 # sys.path.append(parent_directory)
-from tools.my_utils import load_audio
+from tools.my_utils import load_audio_blocks
 from slicer2 import Slicer
 
 
@@ -32,9 +32,8 @@ def slice(inp, opt_root, threshold, min_length, min_interval, hop_size, max_sil_
         # print(inp_path)
         try:
             name = os.path.basename(inp_path)
-            audio = load_audio(inp_path, 32000)
-            # print(audio.shape)
-            for chunk, start, end in slicer.slice(audio):  # start和end是帧数
+            # 边解码边切分, 长音频不必整体读入内存, 切分结果与 slicer.slice 一致
+            for chunk, start, end in slicer.slice_stream(load_audio_blocks(inp_path, 32000)):  # start和end是帧数
                 tmp_max = np.abs(chunk).max()
                 if tmp_max > 1:
                     chunk /= tmp_max
@@ -10,7 +10,11 @@ def get_rms(
 ):
     padding = (int(frame_length // 2), int(frame_length // 2))
     y = np.pad(y, padding, mode=pad_mode)
+    return framed_rms(y, frame_length, hop_length)
 
+
+def framed_rms(y, frame_length=2048, hop_length=512):
+    """RMS of every full frame of an already padded signal (the framing part of get_rms)."""
     axis = -1
     # put our new within-frame axis at the end for now
     out_strides = y.strides + tuple([y.strides[axis]])
@@ -63,6 +67,63 @@ class Slicer:
         else:
             return waveform[begin * self.hop_size : min(waveform.shape[0], end * self.hop_size)]
 
+    def _find_silent_runs(self, rms_list, start, stop, silence_start):
+        """
+        Silent runs of rms_list[start:stop] found with a diff over the silence mask instead of a per-frame loop.
+        `silence_start` carries a run that was still open before `start`.
+        Returns ([(run_start, run_end), ...], open_run_start), where run_end is the first non-silent frame.
+        """
+        silent = (rms_list[start:stop] < self.threshold).astype(np.int8)
+        edges = np.diff(silent, prepend=np.int8(1 if silence_start is not None else 0))
+        starts = (np.flatnonzero(edges == 1) + start).tolist()
+        ends = (np.flatnonzero(edges == -1) + start).tolist()
+        if silence_start is not None:
+            starts.insert(0, silence_start)
+        open_start = starts.pop() if len(starts) > len(ends) else None
+        return list(zip(starts, ends)), open_start
+
+    def _cut_run(self, rms_list, silence_start, i, clip_start):
+        """Decide the cut for a silent run [silence_start, i). Returns (sil_tag or None, clip_start)."""
+        # Clear recorded silence start if interval is not enough or clip is too short
+        is_leading_silence = silence_start == 0 and i > self.max_sil_kept
+        need_slice_middle = i - silence_start >= self.min_interval and i - clip_start >= self.min_length
+        if not is_leading_silence and not need_slice_middle:
+            return None, clip_start
+        # Need slicing. Record the range of silent frames to be removed.
+        if i - silence_start <= self.max_sil_kept:
+            pos = rms_list[silence_start : i + 1].argmin() + silence_start
+            if silence_start == 0:
+                return (0, pos), pos
+            return (pos, pos), pos
+        if i - silence_start <= self.max_sil_kept * 2:
+            pos = rms_list[i - self.max_sil_kept : silence_start + self.max_sil_kept + 1].argmin()
+            pos += i - self.max_sil_kept
+            pos_l = rms_list[silence_start : silence_start + self.max_sil_kept + 1].argmin() + silence_start
+            pos_r = rms_list[i - self.max_sil_kept : i + 1].argmin() + i - self.max_sil_kept
+            if silence_start == 0:
+                return (0, pos_r), pos_r
+            return (min(pos_l, pos), max(pos_r, pos)), max(pos_r, pos)
+        pos_l = rms_list[silence_start : silence_start + self.max_sil_kept + 1].argmin() + silence_start
+        pos_r = rms_list[i - self.max_sil_kept : i + 1].argmin() + i - self.max_sil_kept
+        if silence_start == 0:
+            return (0, pos_r), pos_r
+        return (pos_l, pos_r), pos_r
+
+    def _cut_runs(self, rms_list, runs, clip_start, sil_tags):
+        for silence_start, i in runs:
+            tag, clip_start = self._cut_run(rms_list, silence_start, i, clip_start)
+            if tag is not None:
+                sil_tags.append(tag)
+        return clip_start
+
+    def _trailing_tag(self, rms_list, silence_start, total_frames):
+        # Deal with trailing silence.
+        if silence_start is not None and total_frames - silence_start >= self.min_interval:
+            silence_end = min(total_frames, silence_start + self.max_sil_kept)
+            pos = rms_list[silence_start : silence_end + 1].argmin() + silence_start
+            return (pos, total_frames + 1)
+        return None
+
     # @timeit
     def slice(self, waveform):
         if len(waveform.shape) > 1:
@@ -72,59 +133,13 @@ class Slicer:
         if samples.shape[0] <= self.min_length:
             return [waveform]
         rms_list = get_rms(y=samples, frame_length=self.win_size, hop_length=self.hop_size).squeeze(0)
-        sil_tags = []
-        silence_start = None
-        clip_start = 0
-        for i, rms in enumerate(rms_list):
-            # Keep looping while frame is silent.
-            if rms < self.threshold:
-                # Record start of silent frames.
-                if silence_start is None:
-                    silence_start = i
-                continue
-            # Keep looping while frame is not silent and silence start has not been recorded.
-            if silence_start is None:
-                continue
-            # Clear recorded silence start if interval is not enough or clip is too short
-            is_leading_silence = silence_start == 0 and i > self.max_sil_kept
-            need_slice_middle = i - silence_start >= self.min_interval and i - clip_start >= self.min_length
-            if not is_leading_silence and not need_slice_middle:
-                silence_start = None
-                continue
-            # Need slicing. Record the range of silent frames to be removed.
-            if i - silence_start <= self.max_sil_kept:
-                pos = rms_list[silence_start : i + 1].argmin() + silence_start
-                if silence_start == 0:
-                    sil_tags.append((0, pos))
-                else:
-                    sil_tags.append((pos, pos))
-                clip_start = pos
-            elif i - silence_start <= self.max_sil_kept * 2:
-                pos = rms_list[i - self.max_sil_kept : silence_start + self.max_sil_kept + 1].argmin()
-                pos += i - self.max_sil_kept
-                pos_l = rms_list[silence_start : silence_start + self.max_sil_kept + 1].argmin() + silence_start
-                pos_r = rms_list[i - self.max_sil_kept : i + 1].argmin() + i - self.max_sil_kept
-                if silence_start == 0:
-                    sil_tags.append((0, pos_r))
-                    clip_start = pos_r
-                else:
-                    sil_tags.append((min(pos_l, pos), max(pos_r, pos)))
-                    clip_start = max(pos_r, pos)
-            else:
-                pos_l = rms_list[silence_start : silence_start + self.max_sil_kept + 1].argmin() + silence_start
-                pos_r = rms_list[i - self.max_sil_kept : i + 1].argmin() + i - self.max_sil_kept
-                if silence_start == 0:
-                    sil_tags.append((0, pos_r))
-                else:
-                    sil_tags.append((pos_l, pos_r))
-                clip_start = pos_r
-            silence_start = None
-        # Deal with trailing silence.
         total_frames = rms_list.shape[0]
-        if silence_start is not None and total_frames - silence_start >= self.min_interval:
-            silence_end = min(total_frames, silence_start + self.max_sil_kept)
-            pos = rms_list[silence_start : silence_end + 1].argmin() + silence_start
-            sil_tags.append((pos, total_frames + 1))
+        sil_tags = []
+        runs, silence_start = self._find_silent_runs(rms_list, 0, total_frames, None)
+        self._cut_runs(rms_list, runs, 0, sil_tags)
+        trailing = self._trailing_tag(rms_list, silence_start, total_frames)
+        if trailing is not None:
+            sil_tags.append(trailing)
         # Apply and return slices.
         ####音频+起始时间+终止时间
         if len(sil_tags) == 0:
@@ -151,6 +166,129 @@ class Slicer:
                 )
             return chunks
 
+    def slice_stream(self, blocks):
+        """
+        Streaming version of `slice`: consumes consecutive waveform blocks (shape (n,) or (channels, n))
+        and yields the same [chunk, start, end] items as `slice` on the concatenated waveform, each as soon
+        as the silence after it has been decided. Only the audio since the last cut is kept in memory.
+        Yielded chunks are copies and may be modified in place.
+        """
+        half = self.win_size // 2
+        hop = self.hop_size
+        pad = None  # padded mono signal not yet fully framed, starts at padded index `pad_offset`
+        pad_offset = 0
+        rms_parts = []
+        rms_list = None
+        n_frames = 0
+        scanned = 0  # frames already scanned for silent runs
+        silence_start = None
+        clip_start = 0
+        sil_tags = []
+        emitted_tags = 0  # tags whose preceding chunk has been yielded
+        wave_blocks = []  # original audio since sample `wave_offset`
+        wave_offset = 0
+        total_samples = 0
+
+        def take(begin, end):
+            # samples [begin, end) of the original waveform, as a copy
+            nonlocal wave_blocks
+            buf = np.concatenate(wave_blocks, axis=-1) if len(wave_blocks) > 1 else wave_blocks[0]
+            wave_blocks = [buf]
+            return np.array(buf[..., begin - wave_offset : min(total_samples, end) - wave_offset])
+
+        def drop_before(begin):
+            nonlocal wave_blocks, wave_offset
+            if begin <= wave_offset or not wave_blocks:
+                return
+            buf = np.concatenate(wave_blocks, axis=-1) if len(wave_blocks) > 1 else wave_blocks[0]
+            wave_blocks = [buf[..., begin - wave_offset :]]
+            wave_offset = begin
+
+        def ready_chunks():
+            # yield chunks whose both boundaries are known
+            nonlocal emitted_tags
+            items = []
+            while emitted_tags < len(sil_tags):
+                k = emitted_tags
+                if k == 0:
+                    if sil_tags[0][0] > 0:
+                        items.append([take(0, sil_tags[0][0] * hop), 0, int(sil_tags[0][0] * hop)])
+                else:
+                    items.append(
+                        [
+                            take(sil_tags[k - 1][1] * hop, sil_tags[k][0] * hop),
+                            int(sil_tags[k - 1][1] * hop),
+                            int(sil_tags[k][0] * hop),
+                        ]
+                    )
+                emitted_tags += 1
+                drop_before(min(sil_tags[k][1] * hop, total_samples))
+            return items
+
+        for block in blocks:
+            block = np.asarray(block)
+            if block.shape[-1] == 0:
+                continue
+            samples = block.mean(axis=0) if block.ndim > 1 else block
+            wave_blocks.append(block)
+            total_samples += block.shape[-1]
+            if pad is None:
+                pad = np.concatenate([np.zeros(half, dtype=samples.dtype), samples])
+            else:
+                pad = np.concatenate([pad, samples])
+            # frame every window that is fully available
+            available = (pad_offset + pad.shape[0] - self.win_size) // hop + 1 - n_frames
+            if available > 0:
+                seg_start = n_frames * hop - pad_offset
+                seg = pad[seg_start : seg_start + (available - 1) * hop + self.win_size]
+                rms_parts.append(framed_rms(seg, self.win_size, hop)[0])
+                n_frames += available
+                keep_from = n_frames * hop - pad_offset
+                pad = pad[keep_from:]
+                pad_offset += keep_from
+            if total_samples <= self.min_length or (rms_list is None and not rms_parts):
+                continue
+            if rms_parts:
+                rms_list = np.concatenate(rms_parts if rms_list is None else [rms_list] + rms_parts)
+                rms_parts = []
+            runs, silence_start = self._find_silent_runs(rms_list, scanned, n_frames, silence_start)
+            scanned = n_frames
+            clip_start = self._cut_runs(rms_list, runs, clip_start, sil_tags)
+            for item in ready_chunks():
+                yield item
+
+        if pad is None:
+            return
+        # flush the tail frames with the trailing padding
+        pad = np.concatenate([pad, np.zeros(half, dtype=pad.dtype)])
+        available = (pad_offset + pad.shape[0] - self.win_size) // hop + 1 - n_frames
+        if available > 0:
+            seg_start = n_frames * hop - pad_offset
+            rms_parts.append(framed_rms(pad[seg_start:], self.win_size, hop)[0])
+            n_frames += available
+        if total_samples <= self.min_length:
+            yield np.concatenate(wave_blocks, axis=-1)
+            return
+        if rms_parts:
+            rms_list = np.concatenate(rms_parts if rms_list is None else [rms_list] + rms_parts)
+        total_frames = n_frames
+        runs, silence_start = self._find_silent_runs(rms_list, scanned, total_frames, silence_start)
+        clip_start = self._cut_runs(rms_list, runs, clip_start, sil_tags)
+        trailing = self._trailing_tag(rms_list, silence_start, total_frames)
+        if trailing is not None:
+            sil_tags.append(trailing)
+        if len(sil_tags) == 0:
+            yield [take(0, total_samples), 0, int(total_frames * hop)]
+            return
+        for item in ready_chunks():
+            yield item
+        if sil_tags[-1][1] < total_frames:
+            yield [
+                take(sil_tags[-1][1] * hop, total_frames * hop),
+                int(sil_tags[-1][1] * hop),
+                int(total_frames * hop),
+            ]
+
 
 def main():
     import os.path
@@ -197,11 +335,19 @@ def main():
         default=500,
         help="The maximum silence length kept around the sliced clip, presented in milliseconds",
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Read the audio block by block instead of loading it into memory at once",
+    )
     args = parser.parse_args()
     out = args.out
     if out is None:
         out = os.path.dirname(os.path.abspath(args.audio))
-    audio, sr = librosa.load(args.audio, sr=None, mono=False)
+    if args.stream:
+        sr = soundfile.info(args.audio).samplerate
+    else:
+        audio, sr = librosa.load(args.audio, sr=None, mono=False)
     slicer = Slicer(
         sr=sr,
         threshold=args.db_thresh,
@@ -210,10 +356,19 @@ def main():
         hop_size=args.hop_size,
         max_sil_kept=args.max_sil_kept,
     )
-    chunks = slicer.slice(audio)
+    if args.stream:
+        blocks = (
+            block[:, 0] if block.shape[1] == 1 else block.T
+            for block in soundfile.blocks(args.audio, blocksize=sr * 10, dtype="float32", always_2d=True)
+        )
+        chunks = slicer.slice_stream(blocks)
+    else:
+        chunks = slicer.slice(audio)
     if not os.path.exists(out):
         os.makedirs(out)
     for i, chunk in enumerate(chunks):
+        if isinstance(chunk, list):
+            chunk = chunk[0]
         if len(chunk.shape) > 1:
             chunk = chunk.T
         soundfile.write(
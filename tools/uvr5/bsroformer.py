@@ -1,5 +1,7 @@
 # This code is modified from https://github.com/ZFTurbo/
 import os
+import shutil
+import tempfile
 import warnings
 
 import librosa
@@ -108,20 +110,27 @@ class Roformer_Loader:
             model = None
         return model
 
-    def demix_track(self, model, mix, device):
+    def get_instruments(self):
+        if self.config["training"]["target_instrument"] is None:
+            return self.config["training"]["instruments"]
+        return [self.config["training"]["target_instrument"]]
+
+    def demix_stream(self, model, blocks, length, border, device):
+        """
+        Streaming version of demix_track with memory independent of the track length.
+        blocks yields consecutive (channels, n) float32 CPU tensors of the already reflect-padded
+        mix, length is the padded length and border the padding on each side (0 if not padded).
+        Yields (num_instruments, channels, n) numpy arrays of separated sources for consecutive
+        unpadded positions. Chunking, windows and the order of the overlap-add are the same as
+        the full-length version, so the output is identical; only the accumulator spanning one
+        batch of chunks is kept, on device.
+        """
         C = self.config["audio"]["chunk_size"]  # chunk_size
         N = self.config["inference"]["num_overlap"]
         fade_size = C // 10
         step = int(C // N)
-        border = C - step
         batch_size = self.config["inference"]["batch_size"]
-
-        length_init = mix.shape[-1]
-        progress_bar = tqdm(total=length_init // step + 1, desc="Processing", leave=False)
-
-        # Do pad from the beginning and end to account floating window results better
-        if length_init > 2 * border and (border > 0):
-            mix = nn.functional.pad(mix, (border, border), mode="reflect")
+        progress_bar = tqdm(total=(length - 2 * border) // step + 1, desc="Processing", leave=False)
 
         # Prepare windows arrays (do 1 time for speed up). This trick repairs click problems on the edges of segment
         window_size = C
@@ -134,96 +143,259 @@ class Roformer_Loader:
         window_finish[:fade_size] *= fadein  # Last audio chunk, no fadeout
         window_middle[-fade_size:] *= fadeout
         window_middle[:fade_size] *= fadein
-
+        window_start, window_middle, window_finish = (
+            window_start.to(device),
+            window_middle.to(device),
+            window_finish.to(device),
+        )
+
+        blocks = iter(blocks)
+        buffer = None  # padded mix from buffer_start on
+        buffer_start = 0
+        result = None  # accumulators from acc_start on, long enough for one batch of chunks
+        counter = None
+        acc_start = 0
         with torch.amp.autocast("cuda"):
             with torch.inference_mode():
-                if self.config["training"]["target_instrument"] is None:
-                    req_shape = (len(self.config["training"]["instruments"]),) + tuple(mix.shape)
-                else:
-                    req_shape = (1,) + tuple(mix.shape)
-
-                result = torch.zeros(req_shape, dtype=torch.float32)
-                counter = torch.zeros(req_shape, dtype=torch.float32)
                 i = 0
                 batch_data = []
                 batch_locations = []
-                while i < mix.shape[1]:
-                    part = mix[:, i : i + C].to(device)
-                    length = part.shape[-1]
-                    if length < C:
-                        if length > C // 2 + 1:
-                            part = nn.functional.pad(input=part, pad=(0, C - length), mode="reflect")
+                while i < length:
+                    end = min(i + C, length)
+                    while buffer is None or buffer_start + buffer.shape[-1] < end:
+                        block = next(blocks)
+                        buffer = block if buffer is None else torch.cat([buffer, block], dim=-1)
+                    part = buffer[:, i - buffer_start : end - buffer_start].to(device)
+                    length_part = part.shape[-1]
+                    if length_part < C:
+                        if length_part > C // 2 + 1:
+                            part = nn.functional.pad(input=part, pad=(0, C - length_part), mode="reflect")
                         else:
-                            part = nn.functional.pad(input=part, pad=(0, C - length, 0, 0), mode="constant", value=0)
+                            part = nn.functional.pad(
+                                input=part, pad=(0, C - length_part, 0, 0), mode="constant", value=0
+                            )
                     if self.is_half:
                         part = part.half()
                     batch_data.append(part)
-                    batch_locations.append((i, length))
+                    batch_locations.append((i, length_part))
                     i += step
                     progress_bar.update(1)
+                    # the next chunk starts at i, nothing before it is needed any more
+                    buffer = buffer[:, min(i, length) - buffer_start :]
+                    buffer_start = min(i, length)
 
-                    if len(batch_data) >= batch_size or (i >= mix.shape[1]):
+                    if len(batch_data) >= batch_size or (i >= length):
                         arr = torch.stack(batch_data, dim=0)
-                        # print(23333333,arr.dtype)
                         x = model(arr)
 
                         window = window_middle
                         if i - step == 0:  # First audio chunk, no fadein
                             window = window_start
-                        elif i >= mix.shape[1]:  # Last audio chunk, no fadeout
+                        elif i >= length:  # Last audio chunk, no fadeout
                             window = window_finish
 
+                        if result is None:
+                            req_shape = (len(self.get_instruments()), part.shape[0], (batch_size - 1) * step + C)
+                            result = torch.zeros(req_shape, dtype=torch.float32, device=device)
+                            counter = torch.zeros(req_shape, dtype=torch.float32, device=device)
                         for j in range(len(batch_locations)):
                             start, l = batch_locations[j]
-                            result[..., start : start + l] += x[j][..., :l].cpu() * window[..., :l]
+                            start -= acc_start
+                            result[..., start : start + l] += x[j][..., :l] * window[..., :l]
                             counter[..., start : start + l] += window[..., :l]
 
                         batch_data = []
                         batch_locations = []
 
-                estimated_sources = result / counter
-                estimated_sources = estimated_sources.cpu().numpy()
-                np.nan_to_num(estimated_sources, copy=False, nan=0.0)
-
-                if length_init > 2 * border and (border > 0):
-                    # Remove pad
-                    estimated_sources = estimated_sources[..., border:-border]
+                        # every position before the next chunk start is final
+                        done = min(i, length) - acc_start
+                        estimated_sources = result[..., :done].cpu() / counter[..., :done].cpu()
+                        estimated_sources = estimated_sources.numpy()
+                        np.nan_to_num(estimated_sources, copy=False, nan=0.0)
+                        # Remove pad
+                        lo = max(border - acc_start, 0)
+                        hi = min(length - border - acc_start, done)
+                        if hi > lo:
+                            yield estimated_sources[..., lo:hi]
+                        keep = result.shape[-1] - done
+                        result[..., :keep] = result[..., done:].clone()
+                        counter[..., :keep] = counter[..., done:].clone()
+                        result[..., keep:] = 0
+                        counter[..., keep:] = 0
+                        acc_start += done
 
         progress_bar.close()
 
-        if self.config["training"]["target_instrument"] is None:
-            return {k: v for k, v in zip(self.config["training"]["instruments"], estimated_sources)}
-        else:
-            return {k: v for k, v in zip([self.config["training"]["target_instrument"]], estimated_sources)}
+    def demix_track(self, model, mix, device):
+        C = self.config["audio"]["chunk_size"]  # chunk_size
+        N = self.config["inference"]["num_overlap"]
+        step = int(C // N)
+        border = C - step
 
-    def run_folder(self, input, vocal_root, others_root, format):
-        self.model.eval()
-        path = input
-        os.makedirs(vocal_root, exist_ok=True)
-        os.makedirs(others_root, exist_ok=True)
-        file_base_name = os.path.splitext(os.path.basename(path))[0]
+        length_init = mix.shape[-1]
+        # Do pad from the beginning and end to account floating window results better
+        if length_init > 2 * border and (border > 0):
+            mix = nn.functional.pad(mix, (border, border), mode="reflect")
+        else:
+            border = 0
 
-        sample_rate = 44100
-        if "sample_rate" in self.config["audio"]:
-            sample_rate = self.config["audio"]["sample_rate"]
+        estimated_sources = np.concatenate(
+            list(self.demix_stream(model, [mix], mix.shape[-1], border, device)), axis=-1
+        )
+        return {k: v for k, v in zip(self.get_instruments(), estimated_sources)}
 
+    def can_stream(self, path, sample_rate):
+        """Stereo wav/flac files already at the model sample rate can be demixed block by block from disk"""
+        if not self.config["model"].get("stereo", True):
+            return False
+        try:
+            info = sf.info(path)
+        except Exception:
+            return False
+        return info.samplerate == sample_rate and info.channels == 2 and info.format in self.stream_formats
+
+    def read_padded_blocks(self, path, border, block_size):
+        """Yield the reflect-padded mix (same as nn.functional.pad(..., mode="reflect")) block by block"""
+        with sf.SoundFile(path) as f:
+            length = f.frames
+            if border > 0:
+                f.seek(length - border - 1)
+                tail = torch.from_numpy(f.read(border + 1, dtype="float32", always_2d=True).T.copy())
+                f.seek(0)
+            first = True
+            for block in f.blocks(blocksize=max(block_size, border + 1), dtype="float32", always_2d=True):
+                block = torch.from_numpy(block.T.copy())
+                if first and border > 0:
+                    yield block[:, 1 : border + 1].flip(-1)
+                first = False
+                yield block
+            if border > 0:
+                yield tail[:, :-1].flip(-1)
+
+    def stem_paths(self, file_base_name, vocal_root, others_root, format):
+        target_instrument = self.config["training"]["target_instrument"]
+        if target_instrument is not None:
+            other_instruments = [i for i in self.config["training"]["instruments"] if i != target_instrument]
+            paths = [
+                "{}/{}_{}.wav".format(vocal_root, file_base_name, target_instrument),
+                "{}/{}_{}.wav".format(others_root, file_base_name, other_instruments[0]),
+            ]
+        else:
+            instruments = self.config["training"]["instruments"]
+            paths = ["{}/{}_{}.wav".format(vocal_root, file_base_name, instruments[0])] + [
+                "{}/{}_{}.wav".format(others_root, file_base_name, other) for other in instruments[1:]
+            ]
+        if format == "flac":
+            paths = [p[:-3] + "flac" for p in paths]
+        return paths
+
+    def stream_to_files(self, path, paths, subtype=None):
+        """Demix path block by block (see demix_stream) and write the stems to paths incrementally"""
+        C = self.config["audio"]["chunk_size"]
+        step = int(C // self.config["inference"]["num_overlap"])
+        border = C - step
+        info = sf.info(path)
+        length_init = info.frames
+        if not (length_init > 2 * border and border > 0):
+            border = 0
+
+        target_instrument = self.config["training"]["target_instrument"]
+        writers = [sf.SoundFile(p, "w", info.samplerate, 2, subtype=subtype) for p in paths]
+        mix_reader = sf.SoundFile(path) if target_instrument is not None else None
+        try:
+            blocks = self.read_padded_blocks(path, border, self.stream_block_size)
+            for estimated_sources in self.demix_stream(
+                self.model, blocks, length_init + 2 * border, border, self.device
+            ):
+                if target_instrument is not None:
+                    # other instruments are caculated by subtracting target instrument from mixture
+                    mix = mix_reader.read(estimated_sources.shape[-1], dtype="float32", always_2d=True).T
+                    writers[0].write(estimated_sources[0].T)
+                    writers[1].write((mix - estimated_sources[0]).T)
+                else:
+                    for writer, source in zip(writers, estimated_sources):
+                        writer.write(source.T)
+        finally:
+            for writer in writers:
+                writer.close()
+            if mix_reader is not None:
+                mix_reader.close()
+
+    def run_file_stream(self, path, vocal_root, others_root, format, file_base_name):
+        paths = self.stem_paths(file_base_name, vocal_root, others_root, format)
+        self.stream_to_files(path, paths)
+        if format not in ["wav", "flac"]:
+            for p in paths:
+                self.convert_audio(p, format)
+
+    def _load_(self, path):
+        sample_rate = self.config["audio"].get("sample_rate", 44100)
+        if self.can_stream(path, sample_rate):
+            return {"path": path, "stream": True}
         try:
             mix, sr = librosa.load(path, sr=sample_rate, mono=False)
         except Exception as e:
             print("Can read track: {}".format(path))
             print("Error message: {}".format(str(e)))
-            return
+            return None
 
         # in case if model only supports mono tracks
         isstereo = self.config["model"].get("stereo", True)
         if not isstereo and len(mix.shape) != 1:
             mix = np.mean(mix, axis=0)  # if more than 2 channels, take mean
             print("Warning: Track has more than 1 channels, but model is mono, taking mean of all channels.")
+        return {"path": path, "mix": mix, "sr": sr}
 
-        mix_orig = mix.copy()
-
-        mixture = torch.tensor(mix, dtype=torch.float32)
-        res = self.demix_track(self.model, mixture, self.device)
+    def _infer_(self, state):
+        if state is None:
+            return None
+        self.model.eval()
+        if state.get("stream"):
+            # separate into temp wav files so memory stays bounded; they are already 16-bit PCM, the same as
+            # save_audio writes, so _save_ only moves them into place for wav (and only re-encodes for flac)
+            num_stems = len(self.stem_paths("", "", "", "wav"))
+            tmp_paths = []
+            for _ in range(num_stems):
+                fd, tmp_path = tempfile.mkstemp(suffix=".wav")
+                os.close(fd)
+                tmp_paths.append(tmp_path)
+            try:
+                self.stream_to_files(state["path"], tmp_paths, subtype="PCM_16")
+            except:
+                for tmp_path in tmp_paths:
+                    os.remove(tmp_path)
+                raise
+            return dict(state, tmp_paths=tmp_paths)
+        mixture = torch.tensor(state["mix"], dtype=torch.float32)
+        return dict(state, res=self.demix_track(self.model, mixture, self.device))
+
+    def _save_(self, state, others_root, vocal_root, format, is_hp3=False):
+        if state is None:
+            return
+        os.makedirs(vocal_root, exist_ok=True)
+        os.makedirs(others_root, exist_ok=True)
+        file_base_name = os.path.splitext(os.path.basename(state["path"]))[0]
+        if state.get("stream"):
+            paths = self.stem_paths(file_base_name, vocal_root, others_root, format)
+            try:
+                for tmp_path, p in zip(state["tmp_paths"], paths):
+                    if format == "flac":
+                        with sf.SoundFile(tmp_path) as reader:
+                            with sf.SoundFile(p, "w", reader.samplerate, reader.channels) as writer:
+                                for block in reader.blocks(blocksize=self.stream_block_size, dtype="int16"):
+                                    writer.write(block)
+                    else:
+                        # a rename on the same filesystem, ffmpeg reads the wav directly for other formats
+                        shutil.move(tmp_path, p)
+                        if format != "wav":
+                            self.convert_audio(p, format)
+            finally:
+                # the temp files are removed even if a conversion fails
+                for tmp_path in state["tmp_paths"]:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+            return
+        mix_orig, sr, res = state["mix"], state["sr"], state["res"]
 
         if self.config["training"]["target_instrument"] is not None:
             # if target instrument is specified, save target instrument as vocal and other instruments as others
@@ -245,6 +417,19 @@ class Roformer_Loader:
                 path_other = "{}/{}_{}.wav".format(others_root, file_base_name, other)
                 self.save_audio(path_other, res[other].T, sr, format)
 
+    def run_folder(self, input, vocal_root, others_root, format):
+        path = input
+        os.makedirs(vocal_root, exist_ok=True)
+        os.makedirs(others_root, exist_ok=True)
+        file_base_name = os.path.splitext(os.path.basename(path))[0]
+
+        sample_rate = self.config["audio"].get("sample_rate", 44100)
+        if self.can_stream(path, sample_rate):
+            # long tracks are never fully loaded, see demix_stream
+            self.model.eval()
+            return self.run_file_stream(path, vocal_root, others_root, format, file_base_name)
+        self._save_(self._infer_(self._load_(path)), others_root, vocal_root, format)
+
     def save_audio(self, path, data, sr, format):
         # input path should be endwith '.wav'
         if format in ["wav", "flac"]:
@@ -253,15 +438,22 @@ class Roformer_Loader:
             sf.write(path, data, sr)
         else:
             sf.write(path, data, sr)
-            os.system('ffmpeg -i "{}" -vn "{}" -q:a 2 -y'.format(path, path[:-3] + format))
-            try:
-                os.remove(path)
-            except:
-                pass
+            self.convert_audio(path, format)
+
+    def convert_audio(self, path, format):
+        os.system('ffmpeg -i "{}" -vn "{}" -q:a 2 -y'.format(path, path[:-3] + format))
+        try:
+            os.remove(path)
+        except:
+            pass
+
+    stream_formats = {"WAV", "WAVEX", "W64", "RF64", "FLAC", "AIFF"}
 
     def __init__(self, model_path, config_path, device, is_half):
         self.device = device
         self.is_half = is_half
+        # samples read from disk at a time when streaming
+        self.stream_block_size = int(os.environ.get("uvr5_stream_block", 44100 * 30))
         self.model_type = None
         self.config = None
 
@@ -2,12 +2,67 @@ import hashlib
 import json
 import math
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import librosa
 import numpy as np
 import soundfile as sf
 from tqdm import tqdm
 
+# Persistent worker pool for the per-channel / per-band STFT and ISTFT (numpy FFTs release the GIL)
+STFT_WORKERS = int(os.environ.get("uvr5_stft_workers", min(8, os.cpu_count() or 1)))
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=max(2, STFT_WORKERS), thread_name_prefix="uvr5_stft")
+    return _pool
+
+
+class BufferPool:
+    """
+    Reusable Fortran-ordered spectrogram buffers. Buffers are grouped by leading shape, dtype and
+    a length class (frames rounded up to granularity), so files of similar length share them.
+    acquire returns a view of exactly the requested shape; contents are undefined until written.
+    Hand the same array back to release once it is no longer used.
+    """
+
+    def __init__(self, granularity=1024, max_free=4):
+        self.granularity = granularity
+        self.max_free = max_free
+        self._free = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, shape, dtype):
+        length = shape[-1]
+        length_class = max(1, -(-length // self.granularity)) * self.granularity
+        key = (tuple(shape[:-1]), np.dtype(dtype).str, length_class)
+        with self._lock:
+            free = self._free.get(key)
+            buf = free.pop() if free else None
+        if buf is None:
+            buf = np.empty(tuple(shape[:-1]) + (length_class,), dtype=dtype, order="F")
+        return buf[..., :length]
+
+    def release(self, arr):
+        buf = arr if arr.base is None else arr.base
+        if not isinstance(buf, np.ndarray) or not buf.flags.f_contiguous:
+            return
+        key = (buf.shape[:-1], buf.dtype.str, buf.shape[-1])
+        with self._lock:
+            free = self._free.setdefault(key, [])
+            if len(free) < self.max_free:
+                free.append(buf)
+
+
+spectrogram_buffers = BufferPool()
+
 
 def crop_center(h1, h2):
     h1_shape = h1.size()
@@ -49,9 +104,7 @@ def wave_to_spectrogram(wave, hop_length, n_fft, mid_side=False, mid_side_b2=Fal
     return spec
 
 
-def wave_to_spectrogram_mt(wave, hop_length, n_fft, mid_side=False, mid_side_b2=False, reverse=False):
-    import threading
-
+def _split_channels(wave, mid_side=False, mid_side_b2=False, reverse=False):
     if reverse:
         wave_left = np.flip(np.asfortranarray(wave[0]))
         wave_right = np.flip(np.asfortranarray(wave[1]))
@@ -64,27 +117,51 @@ def wave_to_spectrogram_mt(wave, hop_length, n_fft, mid_side=False, mid_side_b2=
     else:
         wave_left = np.asfortranarray(wave[0])
         wave_right = np.asfortranarray(wave[1])
+    return wave_left, wave_right
 
-    def run_thread(**kwargs):
-        global spec_left
-        spec_left = librosa.stft(**kwargs)
 
-    thread = threading.Thread(
-        target=run_thread,
-        kwargs={"y": wave_left, "n_fft": n_fft, "hop_length": hop_length},
-    )
-    thread.start()
+def wave_to_spectrogram_mt(wave, hop_length, n_fft, mid_side=False, mid_side_b2=False, reverse=False):
+    wave_left, wave_right = _split_channels(wave, mid_side, mid_side_b2, reverse)
+
+    future = get_pool().submit(librosa.stft, wave_left, n_fft=n_fft, hop_length=hop_length)
     spec_right = librosa.stft(wave_right, n_fft=n_fft, hop_length=hop_length)
-    thread.join()
+    spec_left = future.result()
 
     spec = np.asfortranarray([spec_left, spec_right])
 
     return spec
 
 
-def combine_spectrograms(specs, mp):
+def wave_to_spectrogram_bands(wave, mp):
+    """
+    STFT of all bands of a multiband model. wave is the high-end band (2, n) at its sample rate.
+    Lower bands are resampled one after another from the band above while the STFTs of the bands
+    that are ready already run on the worker pool. Returns {band: spec} like the per-band loop.
+    """
+    pool = get_pool()
+    bands_n = len(mp.param["band"])
+    futures = {}
+    for d in range(bands_n, 0, -1):
+        bp = mp.param["band"][d]
+        if d < bands_n:
+            wave = librosa.resample(
+                wave,
+                orig_sr=mp.param["band"][d + 1]["sr"],
+                target_sr=bp["sr"],
+                res_type=bp["res_type"],
+            )
+        channels = _split_channels(wave, mp.param["mid_side"], mp.param["mid_side_b2"], mp.param["reverse"])
+        futures[d] = [pool.submit(librosa.stft, y, n_fft=bp["n_fft"], hop_length=bp["hl"]) for y in channels]
+    return {d: np.asfortranarray([future.result() for future in futures[d]]) for d in futures}
+
+
+def combine_spectrograms(specs, mp, buffers=None):
+    """With buffers (a BufferPool) the result is taken from it, release it there when done."""
     l = min([specs[i].shape[2] for i in specs])
-    spec_c = np.zeros(shape=(2, mp.param["bins"] + 1, l), dtype=np.complex64)
+    if buffers is None:
+        spec_c = np.zeros(shape=(2, mp.param["bins"] + 1, l), dtype=np.complex64)
+    else:
+        spec_c = buffers.acquire((2, mp.param["bins"] + 1, l), np.complex64)
     offset = 0
     bands_n = len(mp.param["band"])
 
@@ -97,6 +174,8 @@ def combine_spectrograms(specs, mp):
 
     if offset > mp.param["bins"]:
         raise ValueError("Too much bins")
+    if buffers is not None:
+        spec_c[:, offset:, :] = 0
 
     # lowpass fiter
     if mp.param["pre_filter_start"] > 0:  # and mp.param['band'][bands_n]['res_type'] in ['scipy', 'polyphase']:
@@ -272,13 +351,7 @@ def cache_or_load(mix_path, inst_path, mp):
     return X_spec_m, y_spec_m
 
 
-def spectrogram_to_wave(spec, hop_length, mid_side, mid_side_b2, reverse):
-    spec_left = np.asfortranarray(spec[0])
-    spec_right = np.asfortranarray(spec[1])
-
-    wave_left = librosa.istft(spec_left, hop_length=hop_length)
-    wave_right = librosa.istft(spec_right, hop_length=hop_length)
-
+def _merge_channels(wave_left, wave_right, mid_side, mid_side_b2, reverse):
     if reverse:
         return np.asfortranarray([np.flip(wave_left), np.flip(wave_right)])
     elif mid_side:
@@ -294,45 +367,46 @@ def spectrogram_to_wave(spec, hop_length, mid_side, mid_side_b2, reverse):
         return np.asfortranarray([wave_left, wave_right])
 
 
-def spectrogram_to_wave_mt(spec, hop_length, mid_side, reverse, mid_side_b2):
-    import threading
-
+def spectrogram_to_wave(spec, hop_length, mid_side, mid_side_b2, reverse):
     spec_left = np.asfortranarray(spec[0])
     spec_right = np.asfortranarray(spec[1])
 
-    def run_thread(**kwargs):
-        global wave_left
-        wave_left = librosa.istft(**kwargs)
-
-    thread = threading.Thread(target=run_thread, kwargs={"stft_matrix": spec_left, "hop_length": hop_length})
-    thread.start()
+    wave_left = librosa.istft(spec_left, hop_length=hop_length)
     wave_right = librosa.istft(spec_right, hop_length=hop_length)
-    thread.join()
 
-    if reverse:
-        return np.asfortranarray([np.flip(wave_left), np.flip(wave_right)])
-    elif mid_side:
-        return np.asfortranarray([np.add(wave_left, wave_right / 2), np.subtract(wave_left, wave_right / 2)])
-    elif mid_side_b2:
-        return np.asfortranarray(
-            [
-                np.add(wave_right / 1.25, 0.4 * wave_left),
-                np.subtract(wave_left / 1.25, 0.4 * wave_right),
-            ]
-        )
-    else:
-        return np.asfortranarray([wave_left, wave_right])
+    return _merge_channels(wave_left, wave_right, mid_side, mid_side_b2, reverse)
+
+
+def spectrogram_to_wave_async(spec, hop_length, mid_side, mid_side_b2, reverse):
+    """Start the ISTFT of both channels on the worker pool, returns a function giving the wave"""
+    pool = get_pool()
+    futures = [pool.submit(librosa.istft, np.asfortranarray(spec[i]), hop_length=hop_length) for i in range(2)]
+
+    def result():
+        return _merge_channels(futures[0].result(), futures[1].result(), mid_side, mid_side_b2, reverse)
+
+    return result
+
+
+def spectrogram_to_wave_mt(spec, hop_length, mid_side, reverse, mid_side_b2):
+    return spectrogram_to_wave_async(spec, hop_length, mid_side, mid_side_b2, reverse)()
 
 
 def cmb_spectrogram_to_wave(spec_m, mp, extra_bins_h=None, extra_bins=None):
-    wave_band = {}
     bands_n = len(mp.param["band"])
     offset = 0
 
+    # Filter every band and start all ISTFTs on the worker pool first, the bands are then summed
+    # and resampled in the same order as before
+    band_specs = []
+    band_waves = {}
     for d in range(1, bands_n + 1):
         bp = mp.param["band"][d]
-        spec_s = np.ndarray(shape=(2, bp["n_fft"] // 2 + 1, spec_m.shape[2]), dtype=complex)
+        spec_s = spectrogram_buffers.acquire((2, bp["n_fft"] // 2 + 1, spec_m.shape[2]), complex)
+        band_specs.append(spec_s)
         h = bp["crop_stop"] - bp["crop_start"]
+        spec_s[:, : bp["crop_start"], :] = 0
+        spec_s[:, bp["crop_stop"] :, :] = 0
         spec_s[:, bp["crop_start"] : bp["crop_stop"], :] = spec_m[:, offset : offset + h, :]
 
         offset += h
@@ -342,57 +416,42 @@ def cmb_spectrogram_to_wave(spec_m, mp, extra_bins_h=None, extra_bins=None):
                 spec_s[:, max_bin - extra_bins_h : max_bin, :] = extra_bins[:, :extra_bins_h, :]
             if bp["hpf_start"] > 0:
                 spec_s = fft_hp_filter(spec_s, bp["hpf_start"], bp["hpf_stop"] - 1)
+        elif d == 1:  # lower
+            spec_s = fft_lp_filter(spec_s, bp["lpf_start"], bp["lpf_stop"])
+        else:  # mid
+            spec_s = fft_hp_filter(spec_s, bp["hpf_start"], bp["hpf_stop"] - 1)
+            spec_s = fft_lp_filter(spec_s, bp["lpf_start"], bp["lpf_stop"])
+        band_waves[d] = spectrogram_to_wave_async(
+            spec_s,
+            bp["hl"],
+            mp.param["mid_side"],
+            mp.param["mid_side_b2"],
+            mp.param["reverse"],
+        )
+
+    for d in range(1, bands_n + 1):
+        bp = mp.param["band"][d]
+        if d == bands_n:  # higher
             if bands_n == 1:
-                wave = spectrogram_to_wave(
-                    spec_s,
-                    bp["hl"],
-                    mp.param["mid_side"],
-                    mp.param["mid_side_b2"],
-                    mp.param["reverse"],
-                )
+                wave = band_waves[d]()
             else:
-                wave = np.add(
-                    wave,
-                    spectrogram_to_wave(
-                        spec_s,
-                        bp["hl"],
-                        mp.param["mid_side"],
-                        mp.param["mid_side_b2"],
-                        mp.param["reverse"],
-                    ),
-                )
+                wave = np.add(wave, band_waves[d]())
         else:
             sr = mp.param["band"][d + 1]["sr"]
             if d == 1:  # lower
-                spec_s = fft_lp_filter(spec_s, bp["lpf_start"], bp["lpf_stop"])
                 wave = librosa.resample(
-                    spectrogram_to_wave(
-                        spec_s,
-                        bp["hl"],
-                        mp.param["mid_side"],
-                        mp.param["mid_side_b2"],
-                        mp.param["reverse"],
-                    ),
+                    band_waves[d](),
                     orig_sr=bp["sr"],
                     target_sr=sr,
                     res_type="sinc_fastest",
                 )
             else:  # mid
-                spec_s = fft_hp_filter(spec_s, bp["hpf_start"], bp["hpf_stop"] - 1)
-                spec_s = fft_lp_filter(spec_s, bp["lpf_start"], bp["lpf_stop"])
-                wave2 = np.add(
-                    wave,
-                    spectrogram_to_wave(
-                        spec_s,
-                        bp["hl"],
-                        mp.param["mid_side"],
-                        mp.param["mid_side_b2"],
-                        mp.param["reverse"],
-                    ),
-                )
+                wave2 = np.add(wave, band_waves[d]())
                 # wave = librosa.core.resample(wave2, orig_sr=bp['sr'], target_sr=sr, res_type="sinc_fastest")
                 wave = librosa.core.resample(wave2, orig_sr=bp["sr"], target_sr=sr, res_type="scipy")
 
+    for spec_s in band_specs:
+        spectrogram_buffers.release(spec_s)
     return wave.T
 
 
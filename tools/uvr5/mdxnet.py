@@ -169,16 +169,20 @@ class Predictor:
         progress_bar.close()
         return _sources
 
-    def prediction(self, m, vocal_root, others_root, format):
-        os.makedirs(vocal_root, exist_ok=True)
-        os.makedirs(others_root, exist_ok=True)
-        basename = os.path.basename(m)
+    def load(self, m):
         mix, rate = librosa.load(m, mono=False, sr=44100)
         if mix.ndim == 1:
             mix = np.asfortranarray([mix, mix])
-        mix = mix.T
-        sources = self.demix(mix.T)
-        opt = sources[0].T
+        return {"basename": os.path.basename(m), "mix": mix.T, "rate": rate}
+
+    def infer(self, state):
+        sources = self.demix(state["mix"].T)
+        return dict(state, opt=sources[0].T)
+
+    def save(self, state, vocal_root, others_root, format):
+        os.makedirs(vocal_root, exist_ok=True)
+        os.makedirs(others_root, exist_ok=True)
+        basename, mix, rate, opt = state["basename"], state["mix"], state["rate"], state["opt"]
         if format in ["wav", "flac"]:
             sf.write("%s/%s_main_vocal.%s" % (vocal_root, basename, format), mix - opt, rate)
             sf.write("%s/%s_others.%s" % (others_root, basename, format), opt, rate)
@@ -204,6 +208,9 @@ class Predictor:
                     except:
                         pass
 
+    def prediction(self, m, vocal_root, others_root, format):
+        self.save(self.infer(self.load(m)), vocal_root, others_root, format)
+
 
 class MDXNetDereverb:
     def __init__(self, chunks):
@@ -219,5 +226,14 @@ class MDXNetDereverb:
         self.pred = Predictor(self)
         self.device = cpu
 
+    def _load_(self, input):
+        return self.pred.load(input)
+
+    def _infer_(self, state):
+        return self.pred.infer(state)
+
+    def _save_(self, state, others_root, vocal_root, format, is_hp3=False):
+        self.pred.save(state, vocal_root, others_root, format)
+
     def _path_audio_(self, input, others_root, vocal_root, format, is_hp3=False):
         self.pred.prediction(input, vocal_root, others_root, format)
@@ -0,0 +1,130 @@
+"""
+UVR5 多文件流水线
+
+逐个文件 解码 -> 推理 -> 写文件 时, 解码和编码期间模型是空闲的. 这里拆成三段并行:
+- 解码: decode_workers 个线程执行 separator._load_ (解码、重采样、STFT 等 CPU 工作)
+- 推理: 调用方线程串行执行 separator._infer_, 解码结果最多预取 queue_size 个
+- 编码: encode_workers 个线程执行 separator._save_ (ISTFT、写 wav/flac、ffmpeg 转码), 积压超过 queue_size 个时等待
+VR (AudioPre/AudioPreDeEcho)、MDX (MDXNetDereverb) 和 BS/Mel-Roformer (Roformer_Loader) 都实现了这三个方法,
+_save_ 的参数与各自 _path_audio_ 去掉输入路径后相同.
+成功的文件记录在 progress_path 里 (带文件大小和修改时间), 中断后用同样的设置重跑会跳过这些文件.
+"""
+
+import os
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SeparationPipeline:
+    def __init__(
+        self,
+        separator,
+        save_args,
+        prepare=None,
+        decode_workers=2,
+        encode_workers=2,
+        queue_size=2,
+        progress_path=None,
+    ):
+        """
+        save_args: 传给 separator._save_ 的参数 (输入路径之后的那些)
+        prepare(path, force): 返回实际交给 _load_ 的路径 (如先用 ffmpeg 转成 44.1k 双声道),
+            直接读取失败时会以 force=True 再调用一次
+        """
+        self.separator = separator
+        self.save_args = save_args
+        self.prepare = prepare
+        self.decode_workers = max(1, decode_workers)
+        self.encode_workers = max(1, encode_workers)
+        self.queue_size = max(1, queue_size)
+        self.progress_path = progress_path
+        self.progress_lock = threading.Lock()
+
+    @staticmethod
+    def progress_key(path):
+        stat = os.stat(path)
+        return "%s\t%s\t%s" % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+    def load_progress(self):
+        if self.progress_path is None or not os.path.exists(self.progress_path):
+            return set()
+        with open(self.progress_path, "r", encoding="utf8") as f:
+            return set(line.rstrip("\n") for line in f if line.strip())
+
+    def record_progress(self, path):
+        if self.progress_path is None:
+            return
+        with self.progress_lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.progress_path)), exist_ok=True)
+            with open(self.progress_path, "a", encoding="utf8") as f:
+                f.write(self.progress_key(path) + "\n")
+
+    def decode(self, path):
+        if self.prepare is None:
+            return self.separator._load_(path)
+        try:
+            return self.separator._load_(self.prepare(path, False))
+        except Exception:
+            traceback.print_exc()
+            return self.separator._load_(self.prepare(path, True))
+
+    def encode(self, path, state):
+        self.separator._save_(state, *self.save_args)
+        self.record_progress(path)
+
+    @staticmethod
+    def finish(path, future):
+        try:
+            future.result()
+            return path, None
+        except Exception:
+            return path, traceback.format_exc()
+
+    def run(self, paths):
+        """
+        按完成顺序逐个产出 (path, status): status 为 None 表示成功, "skipped" 表示之前已完成, 否则为错误信息
+        """
+        done = self.load_progress()
+        todo = []
+        for path in paths:
+            if self.progress_key(path) in done:
+                yield path, "skipped"
+            else:
+                todo.append(path)
+
+        decode_pool = ThreadPoolExecutor(max_workers=self.decode_workers, thread_name_prefix="uvr5_decode")
+        encode_pool = ThreadPoolExecutor(max_workers=self.encode_workers, thread_name_prefix="uvr5_encode")
+        pending = iter(todo)
+        decoding = deque()
+        encoding = deque()
+
+        def fill():
+            while len(decoding) < self.queue_size:
+                path = next(pending, None)
+                if path is None:
+                    return
+                decoding.append((path, decode_pool.submit(self.decode, path)))
+
+        try:
+            fill()
+            while decoding:
+                path, future = decoding.popleft()
+                fill()
+                try:
+                    state = self.separator._infer_(future.result())
+                except Exception:
+                    yield path, traceback.format_exc()
+                    continue
+                encoding.append((path, encode_pool.submit(self.encode, path, state)))
+                del state
+                while encoding and (encoding[0][1].done() or len(encoding) > self.queue_size):
+                    yield self.finish(*encoding.popleft())
+            while encoding:
+                yield self.finish(*encoding.popleft())
+        finally:
+            for _, future in decoding:
+                future.cancel()
+            decode_pool.shutdown(wait=True)
+            encode_pool.shutdown(wait=True)
@@ -42,56 +42,38 @@ class AudioPre:
         self.mp = mp
         self.model = model
 
-    def _path_audio_(self, music_file, ins_root=None, vocal_root=None, format="flac", is_hp3=False):
-        if ins_root is None and vocal_root is None:
-            return "No save root."
-        name = os.path.basename(music_file)
-        if ins_root is not None:
-            os.makedirs(ins_root, exist_ok=True)
-        if vocal_root is not None:
-            os.makedirs(vocal_root, exist_ok=True)
-        X_wave, y_wave, X_spec_s, y_spec_s = {}, {}, {}, {}
+    def _load_(self, music_file):
+        """解码、按频段重采样并做 STFT, 只用 CPU, 批量处理时可以和模型推理并行"""
         bands_n = len(self.mp.param["band"])
-        # print(bands_n)
-        for d in range(bands_n, 0, -1):
-            bp = self.mp.param["band"][d]
-            if d == bands_n:  # high-end band
-                (
-                    X_wave[d],
-                    _,
-                ) = librosa.core.load(  # 理论上librosa读取可能对某些音频有bug，应该上ffmpeg读取，但是太麻烦了弃坑
-                    music_file,
-                    sr=bp["sr"],
-                    mono=False,
-                    dtype=np.float32,
-                    res_type=bp["res_type"],
-                )
-                if X_wave[d].ndim == 1:
-                    X_wave[d] = np.asfortranarray([X_wave[d], X_wave[d]])
-            else:  # lower bands
-                X_wave[d] = librosa.core.resample(
-                    X_wave[d + 1],
-                    orig_sr=self.mp.param["band"][d + 1]["sr"],
-                    target_sr=bp["sr"],
-                    res_type=bp["res_type"],
-                )
-            # Stft of wave source
-            X_spec_s[d] = spec_utils.wave_to_spectrogram_mt(
-                X_wave[d],
-                bp["hl"],
-                bp["n_fft"],
-                self.mp.param["mid_side"],
-                self.mp.param["mid_side_b2"],
-                self.mp.param["reverse"],
+        bp = self.mp.param["band"][bands_n]
+        X_wave, _ = librosa.core.load(  # 理论上librosa读取可能对某些音频有bug，应该上ffmpeg读取，但是太麻烦了弃坑
+            music_file,
+            sr=bp["sr"],
+            mono=False,
+            dtype=np.float32,
+            res_type=bp["res_type"],
+        )
+        if X_wave.ndim == 1:
+            X_wave = np.asfortranarray([X_wave, X_wave])
+        # 各频段依次重采样, 已就绪频段的 STFT 同时在线程池里计算
+        X_spec_s = spec_utils.wave_to_spectrogram_bands(X_wave, self.mp)
+        del X_wave
+        if self.data["high_end_process"] != "none":
+            input_high_end_h = (bp["n_fft"] // 2 - bp["crop_stop"]) + (
+                self.mp.param["pre_filter_stop"] - self.mp.param["pre_filter_start"]
             )
-            # pdb.set_trace()
-            if d == bands_n and self.data["high_end_process"] != "none":
-                input_high_end_h = (bp["n_fft"] // 2 - bp["crop_stop"]) + (
-                    self.mp.param["pre_filter_stop"] - self.mp.param["pre_filter_start"]
-                )
-                input_high_end = X_spec_s[d][:, bp["n_fft"] // 2 - input_high_end_h : bp["n_fft"] // 2, :]
+            input_high_end = X_spec_s[bands_n][:, bp["n_fft"] // 2 - input_high_end_h : bp["n_fft"] // 2, :]
 
-        X_spec_m = spec_utils.combine_spectrograms(X_spec_s, self.mp)
+        # 合并后的频谱取自复用缓冲区, 推理完在 _infer_ 里归还
+        X_spec_m = spec_utils.combine_spectrograms(X_spec_s, self.mp, buffers=spec_utils.spectrogram_buffers)
+        state = {"name": os.path.basename(music_file), "X_spec_m": X_spec_m}
+        if self.data["high_end_process"] != "none":
+            state["input_high_end_h"] = input_high_end_h
+            state["input_high_end"] = input_high_end
+        return state
+
+    def _infer_(self, state):
+        X_spec_m = state["X_spec_m"]
         aggresive_set = float(self.data["agg"] / 100)
         aggressiveness = {
             "value": aggresive_set,
@@ -105,6 +87,21 @@ class AudioPre:
             pred = spec_utils.mask_silence(pred, pred_inv)
         y_spec_m = pred * X_phase
         v_spec_m = X_spec_m - y_spec_m
+        spec_utils.spectrogram_buffers.release(X_spec_m)
+        state = {k: v for k, v in state.items() if k != "X_spec_m"}
+        return dict(state, y_spec_m=y_spec_m, v_spec_m=v_spec_m)
+
+    def _save_(self, state, ins_root=None, vocal_root=None, format="flac", is_hp3=False):
+        """ISTFT 并写出文件, 只用 CPU"""
+        if ins_root is None and vocal_root is None:
+            return "No save root."
+        if ins_root is not None:
+            os.makedirs(ins_root, exist_ok=True)
+        if vocal_root is not None:
+            os.makedirs(vocal_root, exist_ok=True)
+        name = state["name"]
+        y_spec_m, v_spec_m = state["y_spec_m"], state["v_spec_m"]
+        input_high_end_h, input_high_end = state.get("input_high_end_h"), state.get("input_high_end")
 
         if is_hp3 == True:
             ins_root, vocal_root = vocal_root, ins_root
@@ -186,8 +183,13 @@ class AudioPre:
                         except:
                             pass
 
+    def _path_audio_(self, music_file, ins_root=None, vocal_root=None, format="flac", is_hp3=False):
+        if ins_root is None and vocal_root is None:
+            return "No save root."
+        return self._save_(self._infer_(self._load_(music_file)), ins_root, vocal_root, format, is_hp3)
+
 
-class AudioPreDeEcho:
+class AudioPreDeEcho(AudioPre):  # 解码/STFT 与推理同 AudioPre
     def __init__(self, agg, model_path, device, is_half, tta=False):
         self.model_path = model_path
         self.device = device
@@ -214,71 +216,18 @@ class AudioPreDeEcho:
         self.mp = mp
         self.model = model
 
-    def _path_audio_(
-        self, music_file, vocal_root=None, ins_root=None, format="flac", is_hp3=False
+    def _save_(
+        self, state, vocal_root=None, ins_root=None, format="flac", is_hp3=False
     ):  # 3个VR模型vocal和ins是反的
         if ins_root is None and vocal_root is None:
             return "No save root."
-        name = os.path.basename(music_file)
         if ins_root is not None:
             os.makedirs(ins_root, exist_ok=True)
         if vocal_root is not None:
             os.makedirs(vocal_root, exist_ok=True)
-        X_wave, y_wave, X_spec_s, y_spec_s = {}, {}, {}, {}
-        bands_n = len(self.mp.param["band"])
-        # print(bands_n)
-        for d in range(bands_n, 0, -1):
-            bp = self.mp.param["band"][d]
-            if d == bands_n:  # high-end band
-                (
-                    X_wave[d],
-                    _,
-                ) = librosa.core.load(  # 理论上librosa读取可能对某些音频有bug，应该上ffmpeg读取，但是太麻烦了弃坑
-                    music_file,
-                    sr=bp["sr"],
-                    mono=False,
-                    dtype=np.float32,
-                    res_type=bp["res_type"],
-                )
-                if X_wave[d].ndim == 1:
-                    X_wave[d] = np.asfortranarray([X_wave[d], X_wave[d]])
-            else:  # lower bands
-                X_wave[d] = librosa.core.resample(
-                    X_wave[d + 1],
-                    orig_sr=self.mp.param["band"][d + 1]["sr"],
-                    target_sr=bp["sr"],
-                    res_type=bp["res_type"],
-                )
-            # Stft of wave source
-            X_spec_s[d] = spec_utils.wave_to_spectrogram_mt(
-                X_wave[d],
-                bp["hl"],
-                bp["n_fft"],
-                self.mp.param["mid_side"],
-                self.mp.param["mid_side_b2"],
-                self.mp.param["reverse"],
-            )
-            # pdb.set_trace()
-            if d == bands_n and self.data["high_end_process"] != "none":
-                input_high_end_h = (bp["n_fft"] // 2 - bp["crop_stop"]) + (
-                    self.mp.param["pre_filter_stop"] - self.mp.param["pre_filter_start"]
-                )
-                input_high_end = X_spec_s[d][:, bp["n_fft"] // 2 - input_high_end_h : bp["n_fft"] // 2, :]
-
-        X_spec_m = spec_utils.combine_spectrograms(X_spec_s, self.mp)
-        aggresive_set = float(self.data["agg"] / 100)
-        aggressiveness = {
-            "value": aggresive_set,
-            "split_bin": self.mp.param["band"][1]["crop_stop"],
-        }
-        with torch.no_grad():
-            pred, X_mag, X_phase = inference(X_spec_m, self.device, self.model, aggressiveness, self.data)
-        # Postprocess
-        if self.data["postprocess"]:
-            pred_inv = np.clip(X_mag - pred, 0, np.inf)
-            pred = spec_utils.mask_silence(pred, pred_inv)
-        y_spec_m = pred * X_phase
-        v_spec_m = X_spec_m - y_spec_m
+        name = state["name"]
+        y_spec_m, v_spec_m = state["y_spec_m"], state["v_spec_m"]
+        input_high_end_h, input_high_end = state.get("input_high_end_h"), state.get("input_high_end")
 
         if ins_root is not None:
             if self.data["high_end_process"].startswith("mirroring"):
@@ -348,3 +297,10 @@ class AudioPreDeEcho:
                             os.remove(path)
                         except:
                             pass
+
+    def _path_audio_(
+        self, music_file, vocal_root=None, ins_root=None, format="flac", is_hp3=False
+    ):  # 3个VR模型vocal和ins是反的
+        if ins_root is None and vocal_root is None:
+            return "No save root."
+        return self._save_(self._infer_(self._load_(music_file)), vocal_root, ins_root, format, is_hp3)
@@ -1,3 +1,4 @@
+import hashlib
 import logging
 import os
 import traceback
@@ -16,6 +17,7 @@ import ffmpeg
 import torch
 from bsroformer import Roformer_Loader
 from mdxnet import MDXNetDereverb
+from pipeline import SeparationPipeline
 from vr import AudioPre, AudioPreDeEcho
 
 weight_uvr5_root = "tools/uvr5/uvr5_weights"
@@ -42,6 +44,23 @@ def html_center(text, label="p"):
                 </div>"""
 
 
+def prepare_input(inp_path, force=False):
+    """双声道 44.1k 的输入直接读取, 其他的 (或直接读取失败时) 先用 ffmpeg 转成 44.1k 双声道 wav"""
+    if not force:
+        try:
+            info = ffmpeg.probe(inp_path, cmd="ffprobe")
+            if info["streams"][0]["channels"] == 2 and info["streams"][0]["sample_rate"] == "44100":
+                return inp_path
+        except:
+            traceback.print_exc()
+    tmp_path = "%s/%s.reformatted.wav" % (
+        os.path.join(os.environ["TEMP"]),
+        os.path.basename(inp_path),
+    )
+    os.system(f'ffmpeg -i "{inp_path}" -vn -acodec pcm_s16le -ac 2 -ar 44100 "{tmp_path}" -y')
+    return tmp_path
+
+
 def uvr(model_name, inp_root, save_root_vocal, paths, save_root_ins, agg, format0):
     infos = []
     try:
@@ -76,36 +95,31 @@ def uvr(model_name, inp_root, save_root_vocal, paths, save_root_ins, agg, format
             paths = [os.path.join(inp_root, name) for name in os.listdir(inp_root)]
         else:
             paths = [path.name for path in paths]
-        for path in paths:
-            inp_path = os.path.join(inp_root, path)
-            if os.path.isfile(inp_path) == False:
-                continue
-            need_reformat = 1
-            done = 0
-            try:
-                info = ffmpeg.probe(inp_path, cmd="ffprobe")
-                if info["streams"][0]["channels"] == 2 and info["streams"][0]["sample_rate"] == "44100":
-                    need_reformat = 0
-                    pre_fun._path_audio_(inp_path, save_root_ins, save_root_vocal, format0, is_hp3)
-                    done = 1
-            except:
-                need_reformat = 1
-                traceback.print_exc()
-            if need_reformat == 1:
-                tmp_path = "%s/%s.reformatted.wav" % (
-                    os.path.join(os.environ["TEMP"]),
-                    os.path.basename(inp_path),
-                )
-                os.system(f'ffmpeg -i "{inp_path}" -vn -acodec pcm_s16le -ac 2 -ar 44100 "{tmp_path}" -y')
-                inp_path = tmp_path
-            try:
-                if done == 0:
-                    pre_fun._path_audio_(inp_path, save_root_ins, save_root_vocal, format0, is_hp3)
-                infos.append("%s->Success" % (os.path.basename(inp_path)))
-                yield "\n".join(infos)
-            except:
-                infos.append("%s->%s" % (os.path.basename(inp_path), traceback.format_exc()))
-                yield "\n".join(infos)
+        paths = [os.path.join(inp_root, path) for path in paths]
+        paths = [path for path in paths if os.path.isfile(path)]
+        progress_path = None
+        if os.environ.get("uvr5_resume", "1") != "0":
+            task = "|".join([model_name, str(agg), format0, save_root_vocal, save_root_ins])
+            progress_path = "%s/uvr5_progress/%s.txt" % (
+                os.path.join(os.environ["TEMP"]),
+                hashlib.md5(task.encode("utf-8")).hexdigest(),
+            )
+        pipeline = SeparationPipeline(
+            pre_fun,
+            (save_root_ins, save_root_vocal, format0, is_hp3),
+            prepare=prepare_input,
+            decode_workers=int(os.environ.get("uvr5_decode_workers", 2)),
+            encode_workers=int(os.environ.get("uvr5_encode_workers", 2)),
+            progress_path=progress_path,
+        )
+        for i, (path, status) in enumerate(pipeline.run(paths)):
+            if status is None:
+                infos.append("[%s/%s] %s->Success" % (i + 1, len(paths), os.path.basename(path)))
+            elif status == "skipped":
+                infos.append("[%s/%s] %s->Skipped (done before)" % (i + 1, len(paths), os.path.basename(path)))
+            else:
+                infos.append("[%s/%s] %s->%s" % (i + 1, len(paths), os.path.basename(path), status))
+            yield "\n".join(infos)
     except:
         infos.append(traceback.format_exc())
         yield "\n".join(infos)